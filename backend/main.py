@@ -2,25 +2,54 @@ import os
 import json
 import hmac
 import hashlib
+import gzip
 import sqlite3
 import uuid
 import re
 import asyncio
 import time
-import shutil
-from typing import Any, Dict, List, Optional, Tuple
-from urllib.parse import urlencode, urlparse
+import heapq
+import itertools
+import mimetypes
+import multiprocessing
+import queue
+import stat
+import threading
+import concurrent.futures
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import parse_qsl, quote, urlencode, urlparse
 
 import httpx
 from dotenv import load_dotenv
 from fastapi import Depends, FastAPI, Request, HTTPException, Response, UploadFile, File, status
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.staticfiles import NotModifiedResponse
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from pydantic import BaseModel, Field
 import secrets
 
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow не установлен — витрина работает на исходных картинках
+    Image = None
+    ImageOps = None
+
+try:
+    import brotli
+except ImportError:  # без Brotli отдаём только gzip
+    brotli = None
+
+try:
+    import h2
+except ImportError:  # без h2 клиенты ходят по HTTP/1.1
+    h2 = None
+
 load_dotenv(os.path.join(os.path.dirname(__file__), ".env"), override=True)
 
 def _env_str(name: str, default: str = "") -> str:
@@ -52,6 +81,12 @@ ADMIN_PASS = os.getenv("ADMIN_PASS", "").strip()
 LEADTEH_API_TOKEN = os.getenv("LEADTEH_API_TOKEN", "").strip()
 LEADTEH_BOT_ID = os.getenv("LEADTEH_BOT_ID", "").strip()
 LEADTEH_PRODUCTS_SCHEMA_ID = os.getenv("LEADTEH_PRODUCTS_SCHEMA_ID", "").strip()
+LEADTEH_RATE_PER_SEC = float(_env_str("LEADTEH_RATE_PER_SEC", "1.6"))
+LEADTEH_BURST = int(_env_str("LEADTEH_BURST", "3"))
+LEADTEH_MAX_RETRIES = int(_env_str("LEADTEH_MAX_RETRIES", "3"))
+LEADTEH_VARIABLES_TTL = int(_env_str("LEADTEH_VARIABLES_TTL", str(24 * 3600)))
+LEADTEH_CONTACTS_REFRESH_INTERVAL = float(_env_str("LEADTEH_CONTACTS_REFRESH_INTERVAL", "300"))
+LEADTEH_CONTACTS_FULL_REFRESH_INTERVAL = float(_env_str("LEADTEH_CONTACTS_FULL_REFRESH_INTERVAL", str(24 * 3600)))
 PUBLIC_BASE_URL = _env_str("PUBLIC_BASE_URL", "")
 MOYSKLAD_API_BASE = _env_str("MOYSKLAD_API_BASE", "https://api.moysklad.ru/api/remap/1.2").rstrip("/")
 MOYSKLAD_TOKEN = _env_str("MOYSKLAD_TOKEN", "")
@@ -67,9 +102,40 @@ MOYSKLAD_ATTR_IMAGE_URL = _env_str("MOYSKLAD_ATTR_IMAGE_URL", "URL изобра
 if PRODAMUS_FORM_URL and not PRODAMUS_FORM_URL.endswith("/"):
     PRODAMUS_FORM_URL += "/"
 
-DB_PATH = os.path.join(os.path.dirname(__file__), "app.db")
+# БД вместе с -wal/-shm живёт в отдельном каталоге: в docker монтируется каталог целиком, иначе WAL
+# с ещё не перенесёнными коммитами остался бы в слое контейнера и пропал при пересоздании.
+DATA_DIR = _env_str("DATA_DIR", os.path.join(os.path.dirname(__file__), "data"))
+DB_PATH = os.path.join(DATA_DIR, "app.db")
+LEGACY_DB_PATH = os.path.join(os.path.dirname(__file__), "app.db")
+DB_BUSY_TIMEOUT_MS = int(_env_str("DB_BUSY_TIMEOUT_MS", "30000"))
+DB_SYNCHRONOUS = _env_str("DB_SYNCHRONOUS", "NORMAL").upper()
+DB_CACHE_SIZE_KB = int(_env_str("DB_CACHE_SIZE_KB", "16384"))
+DB_MMAP_SIZE = int(_env_str("DB_MMAP_SIZE", str(128 * 1024 * 1024)))
+DB_WRITE_BATCH_MAX = int(_env_str("DB_WRITE_BATCH_MAX", "64"))
+RESERVATION_SWEEP_MAX_INTERVAL = float(_env_str("RESERVATION_SWEEP_MAX_INTERVAL", "60"))
+OUTBOX_WORKERS = int(_env_str("OUTBOX_WORKERS", "4"))
+OUTBOX_LEADTEH_CONCURRENCY = int(_env_str("OUTBOX_LEADTEH_CONCURRENCY", "2"))
+OUTBOX_MOYSKLAD_CONCURRENCY = int(_env_str("OUTBOX_MOYSKLAD_CONCURRENCY", "2"))
+OUTBOX_MAX_ATTEMPTS = int(_env_str("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_RETRY_BASE = float(_env_str("OUTBOX_RETRY_BASE", "10"))
+OUTBOX_RETRY_MAX = float(_env_str("OUTBOX_RETRY_MAX", "3600"))
+OUTBOX_POLL_MAX_INTERVAL = float(_env_str("OUTBOX_POLL_MAX_INTERVAL", "60"))
+OUTBOX_DONE_RETENTION = int(_env_str("OUTBOX_DONE_RETENTION", str(7 * 24 * 3600)))
+OUTBOX_SHUTDOWN_TIMEOUT = float(_env_str("OUTBOX_SHUTDOWN_TIMEOUT", "15"))
+OUTBOX_LEASE_SECONDS = int(_env_str("OUTBOX_LEASE_SECONDS", "120"))
+JSON_COMPRESS_MIN_BYTES = int(_env_str("JSON_COMPRESS_MIN_BYTES", "1024"))
+STOCK_STREAM_HEARTBEAT = float(_env_str("STOCK_STREAM_HEARTBEAT", "15"))
+STOCK_STREAM_BACKLOG = int(_env_str("STOCK_STREAM_BACKLOG", "1024"))
 UPLOADS_DIR = os.path.join(os.path.dirname(__file__), "uploads")
 PRODUCT_UPLOADS_DIR = os.path.join(UPLOADS_DIR, "products")
+MOYSKLAD_IMAGE_CACHE_DIR = os.path.join(UPLOADS_DIR, "moysklad_cache")
+MOYSKLAD_IMAGE_CACHE_MAX_BYTES = int(_env_str("MOYSKLAD_IMAGE_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+MOYSKLAD_IMAGE_FETCH_CONCURRENCY = int(_env_str("MOYSKLAD_IMAGE_FETCH_CONCURRENCY", "4"))
+PRODUCT_IMAGE_WIDTHS = [int(w) for w in _env_str("PRODUCT_IMAGE_WIDTHS", "320,640,960").split(",") if w.strip()]
+IMAGE_VARIANT_WORKERS = int(_env_str("IMAGE_VARIANT_WORKERS", "2"))
+IMAGE_WEBP_QUALITY = int(_env_str("IMAGE_WEBP_QUALITY", "80"))
+IMAGE_JPEG_QUALITY = int(_env_str("IMAGE_JPEG_QUALITY", "82"))
+PRODUCT_UPLOAD_MAX_BYTES = int(_env_str("PRODUCT_UPLOAD_MAX_BYTES", str(10 * 1024 * 1024)))
 FRONTEND_DIST_DIR = os.path.join(os.path.dirname(__file__), "webapp_dist")
 FRONTEND_INDEX_PATH = os.path.join(FRONTEND_DIST_DIR, "index.html")
 
@@ -223,16 +289,262 @@ SEED_PRODUCTS = [
 # ---------------------------
 # DB
 # ---------------------------
-def db() -> sqlite3.Connection:
-    con = sqlite3.connect(DB_PATH, timeout=30, check_same_thread=False)
+_db_local = threading.local()
+_db_connections: list[tuple[threading.Thread, sqlite3.Connection]] = []
+_db_connections_lock = threading.Lock()
+_db_generation = 0
+
+
+def _db_connect(readonly: bool = False) -> sqlite3.Connection:
+    if readonly:
+        # Читатели ходят через отдельное read-only соединение: в WAL они не ждут писателей.
+        con = sqlite3.connect(
+            f"file:{quote(DB_PATH)}?mode=ro",
+            uri=True,
+            timeout=DB_BUSY_TIMEOUT_MS / 1000,
+            check_same_thread=False,
+            isolation_level=None,
+        )
+    else:
+        con = sqlite3.connect(
+            DB_PATH,
+            timeout=DB_BUSY_TIMEOUT_MS / 1000,
+            check_same_thread=False,
+            isolation_level=None,
+        )
     con.row_factory = sqlite3.Row
+    con.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+    con.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+    con.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+    if not readonly:
+        con.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+    return con
+
+
+def _db_register(con: sqlite3.Connection) -> None:
+    with _db_connections_lock:
+        alive = []
+        for thread, other in _db_connections:
+            if thread.is_alive():
+                alive.append((thread, other))
+            else:
+                try:
+                    other.close()
+                except Exception:
+                    pass
+        alive.append((threading.current_thread(), con))
+        _db_connections[:] = alive
+
+
+def _db_thread_connection(readonly: bool = False) -> sqlite3.Connection:
+    attr = "read_con" if readonly else "write_con"
+    cached = getattr(_db_local, attr, None)
+    if cached and cached[0] == _db_generation:
+        return cached[1]
+    con = _db_connect(readonly)
+    _db_register(con)
+    setattr(_db_local, attr, (_db_generation, con))
     return con
 
 
+@contextmanager
+def db_read() -> Iterator[sqlite3.Connection]:
+    """Соединение потока только для чтения; весь блок видит один снимок БД."""
+    con = _db_thread_connection(readonly=True)
+    if con.in_transaction:
+        yield con
+        return
+    con.execute("BEGIN")
+    try:
+        yield con
+    finally:
+        con.rollback()
+
+
+@contextmanager
+def db_write() -> Iterator[sqlite3.Connection]:
+    """Транзакция BEGIN IMMEDIATE на соединении потока; вложенные вызовы входят во внешнюю."""
+    con = _db_thread_connection(readonly=False)
+    if con.in_transaction:
+        yield con
+        return
+    con.execute("BEGIN IMMEDIATE")
+    _db_local.after_commit = []
+    try:
+        yield con
+        con.commit()
+    except BaseException:
+        if con.in_transaction:
+            con.rollback()
+        _db_local.after_commit = None
+        raise
+    callbacks, _db_local.after_commit = _db_local.after_commit, None
+    for callback in callbacks:
+        try:
+            callback()
+        except Exception as e:
+            print("After-commit callback error:", repr(e))
+
+
+def db_after_commit(callback) -> None:
+    """Выполнить callback после COMMIT текущей транзакции записи (при откате он отбрасывается)."""
+    pending = getattr(_db_local, "after_commit", None)
+    if pending is None:
+        callback()
+        return
+    pending.append(callback)
+
+
+# Групповой коммит: одна нить-писатель собирает пачку задач из очереди и коммитит их одной транзакцией.
+# Каждая задача — функция fn(cur, *args) под своим SAVEPOINT: ошибка одной задачи не откатывает соседей,
+# а Future вызывающего резолвится только после COMMIT всей пачки.
+_db_write_queue: "queue.Queue[Optional[tuple]]" = queue.Queue()
+_db_writer_thread: Optional[threading.Thread] = None
+_db_writer_lock = threading.Lock()
+
+
+def _db_run_write_batch(batch: list[tuple]) -> None:
+    outcomes: list[tuple[concurrent.futures.Future, Any, Optional[BaseException]]] = []
+    try:
+        with db_write() as cur:
+            for fn, args, kwargs, future in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                cur.execute("SAVEPOINT write_job")
+                callbacks_mark = len(_db_local.after_commit)
+                try:
+                    result = fn(cur, *args, **kwargs)
+                except Exception as exc:
+                    cur.execute("ROLLBACK TO write_job")
+                    cur.execute("RELEASE write_job")
+                    del _db_local.after_commit[callbacks_mark:]
+                    outcomes.append((future, None, exc))
+                else:
+                    cur.execute("RELEASE write_job")
+                    outcomes.append((future, result, None))
+    except Exception as exc:
+        # BEGIN IMMEDIATE/COMMIT не прошли (занятая блокировка, ошибка ввода-вывода): вся пачка откатилась,
+        # резолвим и ещё не начатые задачи, иначе их вызывающие ждут вечно.
+        for _, _, _, future in batch:
+            if not future.done():
+                future.set_exception(exc)
+        return
+
+    for future, result, exc in outcomes:
+        if exc is not None:
+            future.set_exception(exc)
+        else:
+            future.set_result(result)
+
+
+def _db_writer_main() -> None:
+    while True:
+        job = _db_write_queue.get()
+        if job is None:
+            return
+        batch = [job]
+        stop = False
+        while len(batch) < DB_WRITE_BATCH_MAX:
+            try:
+                job = _db_write_queue.get_nowait()
+            except queue.Empty:
+                break
+            if job is None:
+                stop = True
+                break
+            batch.append(job)
+        _db_run_write_batch(batch)
+        if stop:
+            return
+
+
+def db_submit(fn, *args, **kwargs) -> concurrent.futures.Future:
+    global _db_writer_thread
+    future: concurrent.futures.Future = concurrent.futures.Future()
+    if threading.current_thread() is _db_writer_thread:
+        # Вызов из самой нити-писателя: ставить в очередь нельзя, выполняем во внешней транзакции.
+        with db_write() as cur:
+            future.set_result(fn(cur, *args, **kwargs))
+        return future
+    with _db_writer_lock:
+        if _db_writer_thread is None or not _db_writer_thread.is_alive():
+            _db_writer_thread = threading.Thread(target=_db_writer_main, name="db-writer", daemon=True)
+            _db_writer_thread.start()
+        _db_write_queue.put((fn, args, kwargs, future))
+    return future
+
+
+def db_call(fn, *args, **kwargs) -> Any:
+    return db_submit(fn, *args, **kwargs).result()
+
+
+async def db_call_async(fn, *args, **kwargs) -> Any:
+    return await asyncio.wrap_future(db_submit(fn, *args, **kwargs))
+
+
+def stop_db_writer() -> None:
+    global _db_writer_thread
+    with _db_writer_lock:
+        thread = _db_writer_thread
+        _db_writer_thread = None
+        if thread is None:
+            return
+        _db_write_queue.put(None)
+    thread.join(timeout=30)
+
+
+def close_db_connections() -> None:
+    global _db_generation
+    with _db_connections_lock:
+        connections = [con for _, con in _db_connections]
+        _db_connections.clear()
+        _db_generation += 1
+    for con in connections:
+        try:
+            con.close()
+        except Exception:
+            pass
+    if not os.path.exists(DB_PATH):
+        return
+    # Переносим WAL в основной файл, чтобы на диске остался один самодостаточный app.db.
+    try:
+        con = _db_connect(readonly=False)
+        try:
+            con.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+        finally:
+            con.close()
+    except sqlite3.Error as e:
+        print("WAL checkpoint error:", repr(e))
+
+
+def _move_legacy_db() -> None:
+    # Раньше app.db лежал рядом с main.py; переносим его в DATA_DIR вместе с WAL.
+    if os.path.exists(DB_PATH) or not os.path.isfile(LEGACY_DB_PATH):
+        return
+    for suffix in ("-wal", "-shm", ""):
+        if os.path.exists(LEGACY_DB_PATH + suffix):
+            os.replace(LEGACY_DB_PATH + suffix, DB_PATH + suffix)
+
+
 def init_db() -> None:
     os.makedirs(PRODUCT_UPLOADS_DIR, exist_ok=True)
-    con = db()
-    cur = con.cursor()
+    os.makedirs(DATA_DIR, exist_ok=True)
+    _move_legacy_db()
+    _db_thread_connection().execute("PRAGMA journal_mode=WAL")
+    migrate_db()
+    seed_products(insert_only=True)
+    load_stock_index()
+
+
+def _add_missing_columns(cur: sqlite3.Connection, table: str, columns: list[tuple[str, str, str]]) -> None:
+    cols = {r["name"] for r in cur.execute(f"PRAGMA table_info({table})")}
+    for name, col_type, default_sql in columns:
+        if name in cols:
+            continue
+        cur.execute(f"ALTER TABLE {table} ADD COLUMN {name} {col_type} DEFAULT {default_sql}")
+
+
+def _migrate_base_schema(cur: sqlite3.Connection) -> None:
     cur.execute(
         """
         CREATE TABLE IF NOT EXISTS orders (
@@ -275,373 +587,1229 @@ def init_db() -> None:
       qty INTEGER NOT NULL
     )
     """)
-    con.commit()
-    con.close()
-    ensure_orders_columns()
-    ensure_inventory_columns()
-    seed_products(insert_only=True)
-    return
 
-def ensure_orders_columns() -> None:
-    con = db()
-    cur = con.cursor()
-    cols = {r["name"] for r in cur.execute("PRAGMA table_info(orders)")}
+def _migrate_orders_moysklad_columns(cur: sqlite3.Connection) -> None:
+    _add_missing_columns(
+        cur,
+        "orders",
+        [
+            ("moysklad_demand_href", "TEXT", "''"),
+            ("moysklad_sync_status", "TEXT", "''"),
+            ("moysklad_sync_error", "TEXT", "''"),
+            ("moysklad_synced_at", "TEXT", "NULL"),
+        ],
+    )
 
-    def add_col(name: str, col_type: str, default_sql: str) -> None:
-        if name in cols:
-            return
-        cur.execute(f"ALTER TABLE orders ADD COLUMN {name} {col_type} DEFAULT {default_sql}")
 
-    add_col("moysklad_demand_href", "TEXT", "''")
-    add_col("moysklad_sync_status", "TEXT", "''")
-    add_col("moysklad_sync_error", "TEXT", "''")
-    add_col("moysklad_synced_at", "TEXT", "NULL")
+def _migrate_inventory_catalog_columns(cur: sqlite3.Connection) -> None:
+    _add_missing_columns(
+        cur,
+        "inventory",
+        [
+            ("price", "INTEGER", "0"),
+            ("weight", "TEXT", "''"),
+            ("shelf_life", "TEXT", "''"),
+            ("description", "TEXT", "''"),
+            ("image_url", "TEXT", "''"),
+            ("badge", "TEXT", "''"),
+            ("sort", "INTEGER", "0"),
+            ("active", "INTEGER", "1"),
+            ("catalog_override", "INTEGER", "1"),
+            ("moysklad_href", "TEXT", "''"),
+            ("moysklad_image_href", "TEXT", "''"),
+        ],
+    )
 
-    con.commit()
-    con.close()
+    # Карточки теперь храним локально, а из внешних систем подтягиваем только остатки/активность.
+    cur.execute("UPDATE inventory SET catalog_override=1 WHERE COALESCE(catalog_override, 0) <> 1")
 
 
-def ensure_inventory_columns() -> None:
-    con = db()
-    cur = con.cursor()
-    cols = {r["name"] for r in cur.execute("PRAGMA table_info(inventory)")}
+def _migrate_epoch_columns_and_indexes(cur: sqlite3.Connection) -> None:
+    # Целочисленные epoch-колонки живут рядом с текстовыми: по ним работают индексы и свипер резервов.
+    _add_missing_columns(
+        cur,
+        "reservations",
+        [
+            ("expires_epoch", "INTEGER", "0"),
+            ("created_epoch", "INTEGER", "0"),
+        ],
+    )
+    _add_missing_columns(
+        cur,
+        "orders",
+        [
+            ("created_epoch", "INTEGER", "0"),
+            ("updated_epoch", "INTEGER", "0"),
+        ],
+    )
+    cur.execute("""
+        UPDATE reservations
+        SET expires_epoch = COALESCE(CAST(strftime('%s', expires_at) AS INTEGER), 0),
+            created_epoch = COALESCE(CAST(strftime('%s', created_at) AS INTEGER), 0)
+    """)
+    cur.execute("""
+        UPDATE orders
+        SET created_epoch = COALESCE(CAST(strftime('%s', created_at) AS INTEGER), 0),
+            updated_epoch = COALESCE(CAST(strftime('%s', updated_at) AS INTEGER), 0)
+    """)
 
-    def add_col(name: str, col_type: str, default_sql: str) -> None:
-        if name in cols:
-            return
-        cur.execute(f"ALTER TABLE inventory ADD COLUMN {name} {col_type} DEFAULT {default_sql}")
-
-    add_col("price", "INTEGER", "0")
-    add_col("weight", "TEXT", "''")
-    add_col("shelf_life", "TEXT", "''")
-    add_col("description", "TEXT", "''")
-    add_col("image_url", "TEXT", "''")
-    add_col("badge", "TEXT", "''")
-    add_col("sort", "INTEGER", "0")
-    add_col("active", "INTEGER", "1")
-    add_col("catalog_override", "INTEGER", "1")
-    add_col("moysklad_href", "TEXT", "''")
-    add_col("moysklad_image_href", "TEXT", "''")
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_reservation_items_order
+        ON reservation_items(order_id, sku, qty)
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_reservations_active_expiry
+        ON reservations(expires_epoch, order_id)
+        WHERE status='active'
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_orders_status_created
+        ON orders(status, created_epoch)
+    """)
 
-    # Карточки теперь храним локально, а из внешних систем подтягиваем только остатки/активность.
-    cur.execute("UPDATE inventory SET catalog_override=1 WHERE COALESCE(catalog_override, 0) <> 1")
 
-    con.commit()
-    con.close()
+# Колонки карточки, изменение которых видно клиенту каталога (служебные поля синков сюда не входят).
+_CATALOG_CHANGE_COLUMNS = (
+    "name", "price", "weight", "shelf_life", "description", "image_url",
+    "badge", "sort", "active", "catalog_override", "stock", "reserved",
+)
 
 
-def seed_products(insert_only: bool = True) -> None:
-    con = db()
-    cur = con.cursor()
-    for p in SEED_PRODUCTS:
-        params = (
-            p["sku"],
-            p["name"],
-            int(p.get("price") or 0),
-            p.get("weight") or "",
-            p.get("shelf_life") or "",
-            p.get("description") or "",
-            p.get("image_url") or "",
-            p.get("badge") or "",
-            _fixed_sort_for_sku(p["sku"], int(p.get("sort") or 0)),
-            int(p.get("active") or 0),
+def _migrate_inventory_change_seq(cur: sqlite3.Connection) -> None:
+    # change_seq — номер последнего изменения строки из общего счётчика catalog_seq; ведётся триггерами,
+    # поэтому его не может забыть ни один пишущий путь.
+    _add_missing_columns(cur, "inventory", [("change_seq", "INTEGER NOT NULL", "0")])
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS catalog_seq (
+          id INTEGER PRIMARY KEY CHECK (id = 1),
+          seq INTEGER NOT NULL
         )
-        if insert_only:
-            cur.execute(
-                """
-                INSERT OR IGNORE INTO inventory
-                (sku, name, stock, reserved, price, weight, shelf_life, description, image_url, badge, sort, active, catalog_override)
-                VALUES (?, ?, 0, 0, ?, ?, ?, ?, ?, ?, ?, ?, 1)
-                """,
-                params,
-            )
-        else:
-            cur.execute(
-                """
-                INSERT INTO inventory
-                (sku, name, stock, reserved, price, weight, shelf_life, description, image_url, badge, sort, active, catalog_override)
-                VALUES (?, ?, 0, 0, ?, ?, ?, ?, ?, ?, ?, ?, 1)
-                ON CONFLICT(sku) DO UPDATE SET
-                  name=excluded.name,
-                  price=excluded.price,
-                  weight=excluded.weight,
-                  shelf_life=excluded.shelf_life,
-                  description=excluded.description,
-                  image_url=excluded.image_url,
-                  badge=excluded.badge,
-                  sort=excluded.sort,
-                  active=excluded.active,
-                  catalog_override=1
-                """,
-                params,
-            )
-    con.commit()
-    con.close()
-RESERVE_MINUTES = 30
+    """)
+    cur.execute("UPDATE inventory SET change_seq = rowid")
+    cur.execute("""
+        INSERT OR REPLACE INTO catalog_seq(id, seq)
+        VALUES (1, (SELECT COALESCE(MAX(change_seq), 0) FROM inventory))
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_inventory_change_seq ON inventory(change_seq)")
+
+    bump = """
+        UPDATE catalog_seq SET seq = seq + 1 WHERE id = 1;
+        UPDATE inventory SET change_seq = (SELECT seq FROM catalog_seq WHERE id = 1) WHERE rowid = NEW.rowid;
+    """
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS inventory_change_seq_insert
+        AFTER INSERT ON inventory
+        BEGIN {bump} END
+    """)
+    changed = " OR ".join(f"NEW.{col} IS NOT OLD.{col}" for col in _CATALOG_CHANGE_COLUMNS)
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS inventory_change_seq_update
+        AFTER UPDATE ON inventory
+        WHEN NEW.change_seq = OLD.change_seq AND ({changed})
+        BEGIN {bump} END
+    """)
 
-def expire_reservations() -> int:
-    con = db()
-    cur = con.cursor()
 
-    rows = cur.execute("""
-        SELECT order_id FROM reservations
-        WHERE status='active' AND datetime(expires_at) <= datetime('now')
-    """).fetchall()
+def _migrate_leadteh_contact_variables(cur: sqlite3.Connection) -> None:
+    # Последние успешно отправленные в Leadteh значения переменных контакта: повторно шлём только изменения.
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS leadteh_contact_variables (
+          contact_id INTEGER NOT NULL,
+          name TEXT NOT NULL,
+          value TEXT NOT NULL,
+          updated_epoch INTEGER NOT NULL,
+          PRIMARY KEY (contact_id, name)
+        ) WITHOUT ROWID
+    """)
 
-    released = 0
-    for r in rows:
-        order_id = r["order_id"]
-        items = cur.execute("""
-            SELECT sku, qty FROM reservation_items WHERE order_id=?
-        """, (order_id,)).fetchall()
 
-        for it in items:
-            cur.execute("""
-                UPDATE inventory
-                SET reserved = MAX(reserved - ?, 0)
-                WHERE sku=?
-            """, (it["qty"], it["sku"]))
+def _migrate_leadteh_contacts(cur: sqlite3.Connection) -> None:
+    # Локальный индекс контактов Leadteh по нормализованным телефону и email: поиск контакта для MAX
+    # не листает весь список бота. leadteh_contacts_cursor — страница, с которой продолжает фоновое обновление.
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS leadteh_contacts (
+          contact_id INTEGER PRIMARY KEY,
+          phone_key TEXT NOT NULL DEFAULT '',
+          email_key TEXT NOT NULL DEFAULT '',
+          updated_epoch INTEGER NOT NULL
+        )
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_leadteh_contacts_phone
+        ON leadteh_contacts(phone_key, contact_id)
+        WHERE phone_key <> ''
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_leadteh_contacts_email
+        ON leadteh_contacts(email_key, contact_id)
+        WHERE email_key <> ''
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS leadteh_contacts_cursor (
+          id INTEGER PRIMARY KEY CHECK (id = 1),
+          page INTEGER NOT NULL
+        )
+    """)
 
-        cur.execute("UPDATE reservations SET status='expired' WHERE order_id=?", (order_id,))
-        released += 1
 
-    con.commit()
-    con.close()
-    return released
+def _migrate_inventory_leadteh_columns(cur: sqlite3.Connection) -> None:
+    # id элемента списка товаров в Leadteh и хеш последнего отправленного туда payload строки.
+    _add_missing_columns(
+        cur,
+        "inventory",
+        [
+            ("leadteh_item_id", "TEXT", "''"),
+            ("leadteh_push_hash", "TEXT", "''"),
+        ],
+    )
 
 
-def create_reservation(order_id: str, items: list[dict]) -> None:
-    expire_reservations()
+def _migrate_outbox(cur: sqlite3.Connection) -> None:
+    # Побочные эффекты оплаты (Leadteh, МойСклад): пишутся в одной транзакции со статусом заказа,
+    # выполняются воркерами outbox. status: pending | running | done | dead.
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS outbox (
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          kind TEXT NOT NULL,
+          order_id TEXT NOT NULL,
+          status TEXT NOT NULL DEFAULT 'pending',
+          attempts INTEGER NOT NULL DEFAULT 0,
+          next_epoch INTEGER NOT NULL,
+          last_error TEXT NOT NULL DEFAULT '',
+          created_epoch INTEGER NOT NULL,
+          updated_epoch INTEGER NOT NULL,
+          UNIQUE (kind, order_id)
+        )
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_outbox_pending
+        ON outbox(next_epoch, id)
+        WHERE status='pending'
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_outbox_status ON outbox(status, kind)")
+
+
+def _migrate_outbox_lease(cur: sqlite3.Connection) -> None:
+    # Задачу running держит воркер claimed_by до lease_until (продлевается, пока задача идёт);
+    # задачи с истёкшей арендой возвращаются в очередь.
+    _add_missing_columns(
+        cur,
+        "outbox",
+        [
+            ("claimed_by", "TEXT NOT NULL", "''"),
+            ("lease_until", "INTEGER NOT NULL", "0"),
+        ],
+    )
 
-    con = db()
-    cur = con.cursor()
-    cur.execute("BEGIN IMMEDIATE")
 
-    for it in items:
-        sku = str(it["sku"]).strip()
-        qty = int(it["qty"])
+# Колонки самой карточки (без остатков): их смена делает устаревшим снимок каталога в памяти.
+# image_rev увеличивается, когда для картинки карточки готовы новые варианты.
+_CATALOG_CARD_COLUMNS = tuple(c for c in _CATALOG_CHANGE_COLUMNS if c not in ("stock", "reserved")) + ("image_rev",)
 
-        row = cur.execute("""
-            SELECT stock, reserved FROM inventory WHERE sku=?
-        """, (sku,)).fetchone()
 
-        if not row:
-            con.rollback()
-            con.close()
-            raise HTTPException(400, f"SKU not found: {sku}")
+def _migrate_catalog_card_seq(cur: sqlite3.Connection) -> None:
+    # card_seq считает только изменения карточек: по нему дельта каталога понимает, годится ли снимок в памяти.
+    _add_missing_columns(cur, "inventory", [("image_rev", "INTEGER NOT NULL", "0")])
+    _add_missing_columns(cur, "catalog_seq", [("card_seq", "INTEGER NOT NULL", "0")])
+    cur.execute("DROP TRIGGER IF EXISTS inventory_change_seq_update")
+    bump = """
+        UPDATE catalog_seq SET seq = seq + 1 WHERE id = 1;
+        UPDATE inventory SET change_seq = (SELECT seq FROM catalog_seq WHERE id = 1) WHERE rowid = NEW.rowid;
+    """
+    changed = " OR ".join(f"NEW.{col} IS NOT OLD.{col}" for col in _CATALOG_CHANGE_COLUMNS + ("image_rev",))
+    cur.execute(f"""
+        CREATE TRIGGER inventory_change_seq_update
+        AFTER UPDATE ON inventory
+        WHEN NEW.change_seq = OLD.change_seq AND ({changed})
+        BEGIN {bump} END
+    """)
+    card_bump = "UPDATE catalog_seq SET card_seq = card_seq + 1 WHERE id = 1;"
+    card_changed = " OR ".join(f"NEW.{col} IS NOT OLD.{col}" for col in _CATALOG_CARD_COLUMNS)
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS inventory_card_seq_insert
+        AFTER INSERT ON inventory
+        BEGIN {card_bump} END
+    """)
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS inventory_card_seq_update
+        AFTER UPDATE ON inventory
+        WHEN {card_changed}
+        BEGIN {card_bump} END
+    """)
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS inventory_card_seq_delete
+        AFTER DELETE ON inventory
+        BEGIN {card_bump} END
+    """)
 
-        available = int(row["stock"]) - int(row["reserved"])
-        if qty > available:
-            con.rollback()
-            con.close()
-            raise HTTPException(400, f"Not enough stock for {sku}. Available: {available}, requested: {qty}")
 
-        cur.execute("UPDATE inventory SET reserved = reserved + ? WHERE sku=?", (qty, sku))
+# Порядок не менять: номер миграции = позиция в списке, применённая версия хранится в PRAGMA user_version.
+MIGRATIONS = [
+    _migrate_base_schema,
+    _migrate_orders_moysklad_columns,
+    _migrate_inventory_catalog_columns,
+    _migrate_epoch_columns_and_indexes,
+    _migrate_inventory_change_seq,
+    _migrate_leadteh_contact_variables,
+    _migrate_leadteh_contacts,
+    _migrate_inventory_leadteh_columns,
+    _migrate_outbox,
+    _migrate_catalog_card_seq,
+    _migrate_outbox_lease,
+]
 
-    cur.execute("""
-        INSERT INTO reservations(order_id, status, expires_at)
-        VALUES (?, 'active', datetime('now', ?))
-    """, (order_id, f"+{RESERVE_MINUTES} minutes"))
 
-    for it in items:
-        cur.execute("""
-            INSERT INTO reservation_items(order_id, sku, qty)
-            VALUES (?, ?, ?)
-        """, (order_id, it["sku"], int(it["qty"])))
+def migrate_db() -> int:
+    # BEGIN IMMEDIATE сериализует воркеры, стартующие одновременно: версию читаем уже под блокировкой.
+    with db_write() as cur:
+        version = int(cur.execute("PRAGMA user_version").fetchone()[0])
+        for target, migration in enumerate(MIGRATIONS, start=1):
+            if target <= version:
+                continue
+            migration(cur)
+            cur.execute(f"PRAGMA user_version={target}")
+            version = target
+    return version
 
-    con.commit()
-    con.close()
 
+def seed_products(insert_only: bool = True) -> None:
+    with db_write() as cur:
+        for p in SEED_PRODUCTS:
+            params = (
+                p["sku"],
+                p["name"],
+                int(p.get("price") or 0),
+                p.get("weight") or "",
+                p.get("shelf_life") or "",
+                p.get("description") or "",
+                p.get("image_url") or "",
+                p.get("badge") or "",
+                _fixed_sort_for_sku(p["sku"], int(p.get("sort") or 0)),
+                int(p.get("active") or 0),
+            )
+            if insert_only:
+                cur.execute(
+                    """
+                    INSERT OR IGNORE INTO inventory
+                    (sku, name, stock, reserved, price, weight, shelf_life, description, image_url, badge, sort, active, catalog_override)
+                    VALUES (?, ?, 0, 0, ?, ?, ?, ?, ?, ?, ?, ?, 1)
+                    """,
+                    params,
+                )
+            else:
+                cur.execute(
+                    """
+                    INSERT INTO inventory
+                    (sku, name, stock, reserved, price, weight, shelf_life, description, image_url, badge, sort, active, catalog_override)
+                    VALUES (?, ?, 0, 0, ?, ?, ?, ?, ?, ?, ?, ?, 1)
+                    ON CONFLICT(sku) DO UPDATE SET
+                      name=excluded.name,
+                      price=excluded.price,
+                      weight=excluded.weight,
+                      shelf_life=excluded.shelf_life,
+                      description=excluded.description,
+                      image_url=excluded.image_url,
+                      badge=excluded.badge,
+                      sort=excluded.sort,
+                      active=excluded.active,
+                      catalog_override=1
+                    """,
+                    params,
+                )
+        _stock_index_refresh(cur, [p["sku"] for p in SEED_PRODUCTS])
+        invalidate_catalog_snapshot()
 
-def mark_reservation_paid_and_deduct_stock(order_id: str) -> None:
-    expire_reservations()
 
-    con = db()
-    cur = con.cursor()
-    cur.execute("BEGIN IMMEDIATE")
+# ---------------------------
+# Stock index
+# ---------------------------
+class StockLevel:
+    __slots__ = ("name", "stock", "reserved", "active", "seq")
+
+    def __init__(self, name: str, stock: int, reserved: int, active: int, seq: int):
+        self.name = name
+        self.stock = stock
+        self.reserved = reserved
+        self.active = active
+        self.seq = seq
+
+    @property
+    def available(self) -> int:
+        return self.stock - self.reserved
+
+
+# Копия остатков склада в памяти процесса. Пишущие пути читают изменённые строки внутри своей транзакции
+# и применяют их после COMMIT; seq выдаётся под блокировкой записи SQLite, поэтому более старый снимок
+# никогда не затрёт более новый, даже если коммиты разных потоков применятся в другом порядке.
+_stock_index: dict[str, StockLevel] = {}
+_stock_index_lock = threading.Lock()
+_stock_index_seq = itertools.count(1)
+_stock_index_version = 0
+
+_STOCK_INDEX_COLUMNS = "sku, name, stock, reserved, active"
+
+
+def _stock_index_apply(rows: list[tuple], seq: int, full: bool = False) -> None:
+    global _stock_index_version
+    changed = False
+    available: dict[str, int] = {}
+    with _stock_index_lock:
+        for sku, name, stock, reserved, active in rows:
+            entry = _stock_index.get(sku)
+            if entry is None:
+                _stock_index[sku] = StockLevel(name, stock, reserved, active, seq)
+                available[sku] = stock - reserved
+                changed = True
+            elif entry.seq < seq:
+                if (entry.name, entry.stock, entry.reserved, entry.active) != (name, stock, reserved, active):
+                    changed = True
+                if entry.available != stock - reserved:
+                    available[sku] = stock - reserved
+                entry.name, entry.stock, entry.reserved, entry.active, entry.seq = name, stock, reserved, active, seq
+        if full:
+            present = {row[0] for row in rows}
+            for sku in [sku for sku, entry in _stock_index.items() if sku not in present and entry.seq < seq]:
+                del _stock_index[sku]
+                available[sku] = 0
+                changed = True
+        if changed:
+            _stock_index_version += 1
+        if available:
+            # Под той же блокировкой, чтобы порядок событий совпадал с порядком изменений индекса.
+            _stock_feed_publish(available)
+
+
+def _stock_index_track(rows: list[sqlite3.Row], full: bool = False) -> None:
+    """Запомнить строки inventory (sku, name, stock, reserved, active), изменённые текущей транзакцией."""
+    seq = next(_stock_index_seq)
+    snapshot = [
+        (r["sku"], r["name"], int(r["stock"] or 0), int(r["reserved"] or 0), int(r["active"] or 0))
+        for r in rows
+    ]
+    db_after_commit(lambda: _stock_index_apply(snapshot, seq, full))
 
-    res = cur.execute("SELECT status FROM reservations WHERE order_id=?", (order_id,)).fetchone()
-    if not res:
-        con.rollback()
-        con.close()
-        raise HTTPException(400, "Reservation not found")
 
-    if res["status"] == "paid":
-        con.commit()
-        con.close()
+def _stock_index_refresh(cur: sqlite3.Connection, skus: Optional[list[str]] = None) -> None:
+    if skus is None:
+        rows = cur.execute(f"SELECT {_STOCK_INDEX_COLUMNS} FROM inventory").fetchall()
+        _stock_index_track(rows, full=True)
         return
+    if not skus:
+        return
+    placeholders = ",".join("?" for _ in skus)
+    rows = cur.execute(
+        f"SELECT {_STOCK_INDEX_COLUMNS} FROM inventory WHERE sku IN ({placeholders})",
+        list(skus),
+    ).fetchall()
+    _stock_index_track(rows)
 
-    if res["status"] in ("released", "expired"):
-        con.rollback()
-        con.close()
-        raise HTTPException(409, f"Reservation already {res['status']}")
 
-    items = cur.execute("SELECT sku, qty FROM reservation_items WHERE order_id=?", (order_id,)).fetchall()
+def load_stock_index() -> None:
+    seq = next(_stock_index_seq)
+    with db_read() as con:
+        rows = con.execute(f"SELECT {_STOCK_INDEX_COLUMNS} FROM inventory").fetchall()
+    _stock_index_apply(
+        [(r["sku"], r["name"], int(r["stock"] or 0), int(r["reserved"] or 0), int(r["active"] or 0)) for r in rows],
+        seq,
+        full=True,
+    )
 
-    for it in items:
-        sku = it["sku"]
-        qty = int(it["qty"])
-        row = cur.execute("SELECT stock, reserved FROM inventory WHERE sku=?", (sku,)).fetchone()
-        stock = int(row["stock"])
-        reserved = int(row["reserved"])
 
-        cur.execute("""
-            UPDATE inventory
-            SET stock=?, reserved=?
-            WHERE sku=?
-        """, (max(stock - qty, 0), max(reserved - qty, 0), sku))
+def stock_level(sku: str) -> Optional[StockLevel]:
+    return _stock_index.get(sku)
 
-    cur.execute("UPDATE reservations SET status='paid' WHERE order_id=?", (order_id,))
-    con.commit()
-    con.close()
 
+def stock_index_rows() -> list[dict]:
+    with _stock_index_lock:
+        rows = [
+            {
+                "sku": sku,
+                "name": entry.name,
+                "stock": entry.stock,
+                "reserved": entry.reserved,
+                "available": entry.available,
+            }
+            for sku, entry in _stock_index.items()
+        ]
+    rows.sort(key=lambda r: r["name"])
+    return rows
 
-def release_reservation(order_id: str, reason: str = "released") -> None:
-    con = db()
-    cur = con.cursor()
-    cur.execute("BEGIN IMMEDIATE")
 
-    res = cur.execute("SELECT status FROM reservations WHERE order_id=?", (order_id,)).fetchone()
-    if not res or res["status"] != "active":
-        con.rollback()
-        con.close()
-        return
+_inventory_body_cache: tuple[int, Optional["CompressedBody"]] = (-1, None)
 
-    items = cur.execute("SELECT sku, qty FROM reservation_items WHERE order_id=?", (order_id,)).fetchall()
-    for it in items:
-        cur.execute("""
-            UPDATE inventory SET reserved = MAX(reserved - ?, 0) WHERE sku=?
-        """, (int(it["qty"]), it["sku"]))
 
-    cur.execute("UPDATE reservations SET status=? WHERE order_id=?", (reason, order_id))
-    con.commit()
-    con.close()
+def inventory_body() -> "CompressedBody":
+    """JSON остатков; пересобирается только при изменении индекса."""
+    global _inventory_body_cache
+    version, rendered = _inventory_body_cache
+    if rendered is None or version != _stock_index_version:
+        version = _stock_index_version
+        rendered = CompressedBody(json.dumps(stock_index_rows(), ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+        _inventory_body_cache = (version, rendered)
+    return rendered
 
 
-def set_order_status(order_id: str, status: str) -> None:
-    con = db()
-    con.execute(
-        "UPDATE orders SET status=?, updated_at=datetime('now') WHERE order_id=?",
-        (status, order_id),
-    )
-    con.commit()
-    con.close()
+# ---------------------------
+# Catalog snapshot
+# ---------------------------
+class CatalogSnapshot:
+    """Каталог, заранее сериализованный в JSON: остатки дописываются к готовым байтам каждой карточки."""
+
+    __slots__ = ("version", "seq", "card_seq", "entries", "rendered")
+
+    def __init__(self, version: int, seq: int, card_seq: int, entries: list[tuple[str, bytes, int, int]]):
+        self.version = version
+        # catalog_seq на момент сборки: клиент продолжит с него через ?since=
+        self.seq = seq
+        # card_seq на момент сборки: совпадает с базой — карточки в снимке актуальны
+        self.card_seq = card_seq
+        # (sku, JSON карточки без закрывающей скобки, stock и reserved на момент сборки)
+        self.entries = entries
+        # (версия индекса остатков, готовое тело) — одна пара, чтобы читатели видели согласованное значение
+        self.rendered: tuple[int, Optional[CompressedBody]] = (-1, None)
+
+
+_catalog_version = 0
+_catalog_snapshot: Optional[CatalogSnapshot] = None
+_catalog_snapshot_lock = threading.Lock()
+
+
+def _bump_catalog_version() -> None:
+    global _catalog_version
+    with _catalog_snapshot_lock:
+        _catalog_version += 1
+
+
+def invalidate_catalog_snapshot() -> None:
+    """Сбросить снимок каталога после COMMIT текущей транзакции (или сразу, если её нет)."""
+    db_after_commit(_bump_catalog_version)
+
+
+_CATALOG_SELECT = """
+    SELECT
+      sku,
+      name,
+      price,
+      weight,
+      shelf_life AS shelfLife,
+      description,
+      image_url AS imageUrl,
+      badge,
+      sort,
+      active,
+      catalog_override AS catalogOverride,
+      stock,
+      reserved
+    FROM inventory
+"""
 
 
-def get_order_payload(order_id: str) -> Optional[dict]:
-    ensure_orders_columns()
-    con = db()
-    row = con.execute(
-        """
-        SELECT payload_json, amount, created_at, moysklad_demand_href, moysklad_sync_status,
-               moysklad_sync_error, moysklad_synced_at
-        FROM orders
-        WHERE order_id=?
-        """,
-        (order_id,),
-    ).fetchone()
-    con.close()
-    if not row:
-        return None
-    payload = json.loads(row["payload_json"])
-    payload["_amount"] = row["amount"]
-    payload["_created_at"] = row["created_at"]
-    payload["_moysklad_demand_href"] = row["moysklad_demand_href"]
-    payload["_moysklad_sync_status"] = row["moysklad_sync_status"]
-    payload["_moysklad_sync_error"] = row["moysklad_sync_error"]
-    payload["_moysklad_synced_at"] = row["moysklad_synced_at"]
-    return payload
+def _catalog_seq(con: sqlite3.Connection) -> tuple[int, int]:
+    """(catalog_seq, card_seq)."""
+    row = con.execute("SELECT seq, card_seq FROM catalog_seq WHERE id = 1").fetchone()
+    return (int(row["seq"]), int(row["card_seq"])) if row else (0, 0)
 
 
-def claim_moysklad_sync(order_id: str) -> Optional[str]:
-    ensure_orders_columns()
-    con = db()
-    cur = con.cursor()
-    cur.execute("BEGIN IMMEDIATE")
-    row = cur.execute(
-        """
-        SELECT moysklad_demand_href, moysklad_sync_status
-        FROM orders
-        WHERE order_id=?
-        """,
-        (order_id,),
-    ).fetchone()
-    if not row:
-        con.rollback()
-        con.close()
-        return "missing"
-    demand_href = str(row["moysklad_demand_href"] or "").strip()
-    sync_status = str(row["moysklad_sync_status"] or "").strip().lower()
-    if demand_href:
-        con.commit()
-        con.close()
-        return "done"
-    if sync_status == "in_progress":
-        con.commit()
-        con.close()
-        return "in_progress"
-    cur.execute(
-        """
-        UPDATE orders
-        SET moysklad_sync_status='in_progress',
-            moysklad_sync_error='',
-            updated_at=datetime('now')
-        WHERE order_id=?
-        """,
-        (order_id,),
-    )
-    con.commit()
-    con.close()
-    return None
+def _build_catalog_snapshot(version: int) -> CatalogSnapshot:
+    with db_read() as con:
+        seq, card_seq = _catalog_seq(con)
+        rows = con.execute(_CATALOG_SELECT + " ORDER BY sort ASC, name ASC").fetchall()
+    entries = []
+    for row in rows:
+        item = dict(row)
+        stock = int(item.pop("stock") or 0)
+        reserved = int(item.pop("reserved") or 0)
+        item["imageUrl"] = _normalize_storefront_asset_url(item.get("imageUrl"))
+        item["imageVariants"] = image_variants_for_url(item["imageUrl"])
+        prefix = json.dumps(item, ensure_ascii=False, separators=(",", ":")).encode("utf-8")[:-1]
+        entries.append((item["sku"], prefix, stock, reserved))
+    return CatalogSnapshot(version, seq, card_seq, entries)
+
+
+def _render_catalog(snapshot: CatalogSnapshot) -> bytes:
+    parts = []
+    for sku, prefix, stock, reserved in snapshot.entries:
+        level = stock_level(sku)
+        if level is not None:
+            stock, reserved = level.stock, level.reserved
+        parts.append(b'%s,"stock":%d,"reserved":%d,"available":%d}' % (prefix, stock, reserved, stock - reserved))
+    return b"[" + b",".join(parts) + b"]"
+
+
+def _current_catalog_snapshot(card_seq: Optional[int] = None) -> CatalogSnapshot:
+    """Снимок каталога; с card_seq — не старше этого состояния карточек в базе."""
+    global _catalog_snapshot
+    snapshot = _catalog_snapshot
+    version = _catalog_version
+    if snapshot is None or snapshot.version != version or (card_seq is not None and snapshot.card_seq != card_seq):
+        # Версию читаем до выборки: снимок может оказаться новее своей версии, но не старее.
+        snapshot = _build_catalog_snapshot(version)
+        with _catalog_snapshot_lock:
+            if _catalog_version == version:
+                _catalog_snapshot = snapshot
+    return snapshot
+
+
+def catalog_body() -> tuple["CompressedBody", int]:
+    """JSON-массив товаров для витрины и catalog_seq; SQLite читается только после смены каталога."""
+    snapshot = _current_catalog_snapshot()
+    stock_version = _stock_index_version
+    rendered_version, rendered = snapshot.rendered
+    if rendered is None or rendered_version != stock_version:
+        rendered = CompressedBody(_render_catalog(snapshot))
+        snapshot.rendered = (stock_version, rendered)
+    # Остатки могли измениться после сборки снимка — тогда seq старше фактического, и следующий
+    # запрос ?since= просто вернёт эти строки ещё раз.
+    return rendered, snapshot.seq
+
+
+def catalog_delta(since: int) -> bytes:
+    """JSON {seq, products, full}: строки каталога, изменённые после since; full=true, если клиенту
+    нужен весь каталог заново. Из базы читаются только номера и остатки изменённых строк (по индексу
+    change_seq), карточки берутся готовыми из снимка в памяти."""
+    with db_read() as con:
+        seq, card_seq = _catalog_seq(con)
+        # since больше текущего счётчика — база пересоздана, кэш клиента ни с чем не сравним.
+        full = since <= 0 or since > seq
+        rows = con.execute(
+            "SELECT sku, stock, reserved FROM inventory WHERE change_seq > ?",
+            (0 if full else since,),
+        ).fetchall()
+        # Внутри того же чтения: пересобранный снимок видит то же состояние, что и выборка выше.
+        snapshot = _current_catalog_snapshot(card_seq)
+    changed = {row["sku"]: (int(row["stock"] or 0), int(row["reserved"] or 0)) for row in rows}
+    parts = []
+    for sku, prefix, _, _ in snapshot.entries:
+        level = changed.get(sku)
+        if level is None:
+            continue
+        stock, reserved = level
+        parts.append(b'%s,"stock":%d,"reserved":%d,"available":%d}' % (prefix, stock, reserved, stock - reserved))
+    return b'{"seq":%d,"products":[%s],"full":%s}' % (seq, b",".join(parts), b"true" if full else b"false")
 
 
-def finish_moysklad_sync(order_id: str, *, demand_href: str = "", error: str = "") -> None:
-    ensure_orders_columns()
-    con = db()
-    con.execute(
-        """
-        UPDATE orders
-        SET moysklad_demand_href=?,
-            moysklad_sync_status=?,
-            moysklad_sync_error=?,
-            moysklad_synced_at=CASE WHEN ? <> '' THEN datetime('now') ELSE moysklad_synced_at END,
-            updated_at=datetime('now')
-        WHERE order_id=?
-        """,
-        (
-            demand_href,
-            "done" if demand_href else "error",
-            error[:1000],
-            demand_href,
-            order_id,
-        ),
-    )
-    con.commit()
-    con.close()
+# ---------------------------
+# Stock stream (SSE)
+# ---------------------------
+# Общая лента изменений доступности: событие кодируется в байты один раз и раздаётся всем
+# подписчикам. Подписчики ждут одно asyncio.Event, которое при публикации заменяется новым.
+_STOCK_STREAM_BOOT = uuid.uuid4().hex[:8]
+_stock_feed: deque = deque(maxlen=STOCK_STREAM_BACKLOG)
+_stock_feed_seq = 0
+_stock_stream_loop: Optional[asyncio.AbstractEventLoop] = None
+_stock_stream_event: Optional[asyncio.Event] = None
+
+
+def _stock_stream_message(event: str, seq: int, data: dict) -> bytes:
+    payload = json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+    return f"event: {event}\nid: {_STOCK_STREAM_BOOT}-{seq}\ndata: {payload}\n\n".encode("utf-8")
+
+
+def _stock_stream_notify() -> None:
+    global _stock_stream_event
+    event = _stock_stream_event
+    if event is not None:
+        _stock_stream_event = asyncio.Event()
+        event.set()
+
+
+def _stock_feed_publish(available: dict[str, int]) -> None:
+    """Вызывается под _stock_index_lock из любого потока."""
+    global _stock_feed_seq
+    _stock_feed_seq += 1
+    _stock_feed.append((_stock_feed_seq, _stock_stream_message("stock", _stock_feed_seq, available)))
+    loop = _stock_stream_loop
+    if loop is not None:
+        try:
+            loop.call_soon_threadsafe(_stock_stream_notify)
+        except RuntimeError:
+            pass
 
 
-def get_product_name_map(skus: list[str]) -> dict[str, str]:
-    if not skus:
-        return {}
-    con = db()
-    placeholders = ",".join("?" for _ in skus)
-    rows = con.execute(
-        f"SELECT sku, name FROM inventory WHERE sku IN ({placeholders})",
-        skus,
-    ).fetchall()
-    con.close()
-    return {r["sku"]: r["name"] for r in rows}
+def _stock_feed_since(cursor: int) -> tuple[Optional[list[bytes]], int]:
+    """События после cursor; None, если часть из них уже вытеснена из ленты."""
+    with _stock_index_lock:
+        if cursor >= _stock_feed_seq:
+            return [], cursor
+        first_seq = _stock_feed[0][0] if _stock_feed else _stock_feed_seq + 1
+        if cursor < first_seq - 1:
+            return None, cursor
+        return [message for seq, message in itertools.islice(_stock_feed, cursor - first_seq + 1, None)], _stock_feed_seq
 
 
-def _product_upload_public_url(filename: str) -> str:
+def _stock_stream_snapshot() -> tuple[bytes, int]:
+    with _stock_index_lock:
+        available = {sku: entry.available for sku, entry in _stock_index.items()}
+        seq = _stock_feed_seq
+    return _stock_stream_message("snapshot", seq, available), seq
+
+
+def _stock_stream_cursor(last_event_id: Optional[str]) -> Optional[int]:
+    boot, _, seq = (last_event_id or "").strip().partition("-")
+    if boot != _STOCK_STREAM_BOOT or not seq.isdigit():
+        return None
+    return int(seq)
+
+
+async def _stock_stream(cursor: Optional[int]):
+    yield f"retry: {int(STOCK_STREAM_HEARTBEAT * 1000)}\n\n".encode("utf-8")
+    while True:
+        # Событие берём до чтения ленты, чтобы публикация между чтением и ожиданием не потерялась.
+        event = _stock_stream_event
+        messages = None
+        if cursor is not None:
+            messages, cursor = _stock_feed_since(cursor)
+        if messages is None:
+            snapshot, cursor = _stock_stream_snapshot()
+            messages = [snapshot]
+        if messages:
+            yield b"".join(messages)
+            continue
+        try:
+            if event is None:
+                await asyncio.sleep(STOCK_STREAM_HEARTBEAT)
+                raise asyncio.TimeoutError
+            await asyncio.wait_for(event.wait(), timeout=STOCK_STREAM_HEARTBEAT)
+        except asyncio.TimeoutError:
+            yield b": ping\n\n"
+
+
+async def start_stock_stream() -> None:
+    global _stock_stream_loop, _stock_stream_event
+    _stock_stream_event = asyncio.Event()
+    _stock_stream_loop = asyncio.get_running_loop()
+
+
+def stop_stock_stream() -> None:
+    global _stock_stream_loop, _stock_stream_event
+    _stock_stream_loop = None
+    _stock_stream_event = None
+
+
+# ---------------------------
+# Reservations
+# ---------------------------
+RESERVE_MINUTES = 30
+
+# Мин-куча (expires_epoch, order_id) активных резервов этого процесса: по ней свипер решает, когда проснуться.
+_reservation_deadlines: list[tuple[int, str]] = []
+_reservation_deadlines_lock = threading.Lock()
+_reservation_sweeper_loop: Optional[asyncio.AbstractEventLoop] = None
+_reservation_sweeper_wakeup: Optional[asyncio.Event] = None
+_reservation_sweeper_task: Optional[asyncio.Task] = None
+
+
+def _utc_text(epoch: float) -> str:
+    # Тот же формат, что у datetime('now') в SQLite.
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(int(epoch)))
+
+
+class _ReservationFailed(Exception):
+    def __init__(self, skus: list[str]):
+        super().__init__(", ".join(skus))
+        self.skus = skus
+
+
+def _reserve_stock(cur: sqlite3.Connection, sku_qty: dict[str, int], prices: dict[str, int]) -> list[str]:
+    # Условный UPDATE проверяет остаток, активность и цену в одном операторе — без чтения под блокировкой.
+    failed: list[str] = []
+    reserved_rows: list[sqlite3.Row] = []
+    for sku, qty in sku_qty.items():
+        row = cur.execute(
+            f"""
+            UPDATE inventory
+            SET reserved = reserved + ?
+            WHERE sku=? AND active=1 AND price=? AND stock - reserved >= ?
+            RETURNING {_STOCK_INDEX_COLUMNS}
+            """,
+            (qty, sku, prices[sku], qty),
+        ).fetchone()
+        if row is None:
+            failed.append(sku)
+        else:
+            reserved_rows.append(row)
+    if not failed:
+        _stock_index_track(reserved_rows)
+    return failed
+
+
+def _deduct_reserved_stock(cur: sqlite3.Connection, order_id: str) -> None:
+    rows = cur.execute(f"""
+        UPDATE inventory
+        SET stock = MAX(inventory.stock - paid.qty, 0),
+            reserved = MAX(inventory.reserved - paid.qty, 0)
+        FROM (
+            SELECT sku, SUM(qty) AS qty FROM reservation_items WHERE order_id=? GROUP BY sku
+        ) AS paid
+        WHERE inventory.sku = paid.sku
+        RETURNING {_STOCK_INDEX_COLUMNS}
+    """, (order_id,)).fetchall()
+    _stock_index_track(rows)
+
+
+def _release_reserved_stock(cur: sqlite3.Connection, order_id: str) -> None:
+    rows = cur.execute(f"""
+        UPDATE inventory
+        SET reserved = MAX(inventory.reserved - released.qty, 0)
+        FROM (
+            SELECT sku, SUM(qty) AS qty FROM reservation_items WHERE order_id=? GROUP BY sku
+        ) AS released
+        WHERE inventory.sku = released.sku
+        RETURNING {_STOCK_INDEX_COLUMNS}
+    """, (order_id,)).fetchall()
+    _stock_index_track(rows)
+
+
+def _reservation_failure_detail(sku_qty: dict[str, int], failed: list[str], prices: dict[str, int]) -> str:
+    placeholders = ",".join("?" for _ in failed)
+    with db_read() as con:
+        rows = con.execute(
+            f"SELECT sku, price, active, stock, reserved FROM inventory WHERE sku IN ({placeholders})",
+            failed,
+        ).fetchall()
+    row_map = {r["sku"]: r for r in rows}
+    reasons = []
+    for sku in failed:
+        row = row_map.get(sku)
+        if not row or int(row["active"] or 0) == 0:
+            reasons.append(f"Unknown or inactive sku: {sku}")
+        elif int(row["price"] or 0) != prices[sku]:
+            reasons.append(f"Price changed for sku: {sku}")
+        else:
+            available = int(row["stock"]) - int(row["reserved"])
+            reasons.append(f"Not enough stock for {sku}. Available: {available}, requested: {sku_qty[sku]}")
+    return "; ".join(reasons)
+
+
+def _expire_reservations_tx(cur: sqlite3.Connection, cutoff: int) -> int:
+    rows = cur.execute(f"""
+        UPDATE inventory
+        SET reserved = MAX(inventory.reserved - expired.qty, 0)
+        FROM (
+            SELECT ri.sku, SUM(ri.qty) AS qty
+            FROM reservations r
+            JOIN reservation_items ri ON ri.order_id = r.order_id
+            WHERE r.status='active' AND r.expires_epoch <= ?
+            GROUP BY ri.sku
+        ) AS expired
+        WHERE inventory.sku = expired.sku
+        RETURNING {_STOCK_INDEX_COLUMNS}
+    """, (cutoff,)).fetchall()
+    _stock_index_track(rows)
+    return cur.execute(
+        "UPDATE reservations SET status='expired' WHERE status='active' AND expires_epoch <= ?",
+        (cutoff,),
+    ).rowcount
+
+
+def _schedule_reservation_expiry(order_id: str, expires_epoch: int) -> None:
+    with _reservation_deadlines_lock:
+        earliest = not _reservation_deadlines or expires_epoch < _reservation_deadlines[0][0]
+        heapq.heappush(_reservation_deadlines, (expires_epoch, order_id))
+    loop = _reservation_sweeper_loop
+    if earliest and loop is not None and _reservation_sweeper_wakeup is not None:
+        loop.call_soon_threadsafe(_reservation_sweeper_wakeup.set)
+
+
+def _reservation_sweep_delay() -> float:
+    with _reservation_deadlines_lock:
+        if not _reservation_deadlines:
+            return RESERVATION_SWEEP_MAX_INTERVAL
+        next_deadline = _reservation_deadlines[0][0]
+    return min(max(next_deadline - time.time(), 0.0), RESERVATION_SWEEP_MAX_INTERVAL)
+
+
+def _forget_reservation_deadlines(until_epoch: float) -> None:
+    with _reservation_deadlines_lock:
+        while _reservation_deadlines and _reservation_deadlines[0][0] <= until_epoch:
+            heapq.heappop(_reservation_deadlines)
+
+
+def _load_reservation_deadlines() -> None:
+    with db_read() as con:
+        rows = con.execute(
+            "SELECT order_id, expires_epoch FROM reservations WHERE status='active'"
+        ).fetchall()
+    with _reservation_deadlines_lock:
+        _reservation_deadlines[:] = [(int(r["expires_epoch"] or 0), r["order_id"]) for r in rows]
+        heapq.heapify(_reservation_deadlines)
+
+
+async def _reservation_sweeper() -> None:
+    while True:
+        delay = _reservation_sweep_delay()
+        if delay > 0:
+            try:
+                await asyncio.wait_for(_reservation_sweeper_wakeup.wait(), timeout=delay)
+                # Появился более ранний дедлайн — пересчитываем ожидание.
+                _reservation_sweeper_wakeup.clear()
+                continue
+            except asyncio.TimeoutError:
+                pass
+
+        now = int(time.time())
+        try:
+            released = await db_call_async(_expire_reservations_tx, now)
+        except Exception as e:
+            print("Reservation sweeper error:", repr(e))
+            await asyncio.sleep(5)
+            continue
+        _forget_reservation_deadlines(now)
+        if released:
+            print("Reservations expired:", released)
+
+
+async def start_reservation_sweeper() -> None:
+    global _reservation_sweeper_loop, _reservation_sweeper_wakeup, _reservation_sweeper_task
+    if _reservation_sweeper_task is not None:
+        return
+    await asyncio.to_thread(_load_reservation_deadlines)
+    _reservation_sweeper_loop = asyncio.get_running_loop()
+    _reservation_sweeper_wakeup = asyncio.Event()
+    _reservation_sweeper_task = asyncio.create_task(_reservation_sweeper())
+
+
+async def stop_reservation_sweeper() -> None:
+    global _reservation_sweeper_loop, _reservation_sweeper_wakeup, _reservation_sweeper_task
+    task = _reservation_sweeper_task
+    _reservation_sweeper_task = None
+    _reservation_sweeper_loop = None
+    _reservation_sweeper_wakeup = None
+    if task is None:
+        return
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+
+def _create_order_tx(
+    cur: sqlite3.Connection,
+    order_id: str,
+    items: list[dict],
+    sku_qty: dict[str, int],
+    prices: dict[str, int],
+    amount: int,
+    payload_json: str,
+    created_epoch: int,
+    expires_epoch: int,
+) -> None:
+    failed = _reserve_stock(cur, sku_qty, prices)
+    if failed:
+        # Откат SAVEPOINT вернёт уже сделанные резервы.
+        raise _ReservationFailed(failed)
+    cur.execute("""
+        INSERT INTO reservations(order_id, status, expires_at, expires_epoch, created_at, created_epoch)
+        VALUES (?, 'active', ?, ?, ?, ?)
+    """, (order_id, _utc_text(expires_epoch), expires_epoch, _utc_text(created_epoch), created_epoch))
+    cur.executemany(
+        """
+        INSERT INTO reservation_items(order_id, sku, qty)
+        VALUES (?, ?, ?)
+        """,
+        [(order_id, str(it["sku"]).strip(), int(it["qty"])) for it in items],
+    )
+    cur.execute(
+        """
+        INSERT INTO orders(order_id,status,amount,payload_json,payment_url,created_at,created_epoch,updated_at,updated_epoch)
+        VALUES (?,?,?,?,?,?,?,?,?)
+        """,
+        (
+            order_id,
+            "created",
+            amount,
+            payload_json,
+            "",
+            _utc_text(created_epoch),
+            created_epoch,
+            _utc_text(created_epoch),
+            created_epoch,
+        ),
+    )
+
+
+async def create_order_with_reservation(order_id: str, items: list[dict], payload_json: str) -> tuple[list[dict], int]:
+    """Цены, резерв и строка заказа; при нехватке хотя бы одного SKU не резервируется ничего."""
+    sku_qty: dict[str, int] = {}
+    for it in items:
+        sku = str(it["sku"]).strip()
+        sku_qty[sku] = sku_qty.get(sku, 0) + int(it["qty"])
+
+    placeholders = ",".join("?" for _ in sku_qty)
+    with db_read() as con:
+        rows = con.execute(
+            f"SELECT sku, name, price, active, stock, reserved FROM inventory WHERE sku IN ({placeholders})",
+            list(sku_qty.keys()),
+        ).fetchall()
+    row_map = {r["sku"]: r for r in rows}
+
+    prices: dict[str, int] = {}
+    for sku in sku_qty:
+        row = row_map.get(sku)
+        if not row or int(row["active"] or 0) == 0:
+            raise HTTPException(400, f"Unknown or inactive sku: {sku}")
+        prices[sku] = int(row["price"] or 0)
+        if prices[sku] <= 0:
+            raise HTTPException(400, f"Price not set for sku: {sku}")
+
+    # Заведомо невыполнимый заказ отклоняем, не вставая в очередь писателя. Смотрим строки из SQLite, а не индекс
+    # процесса: он видит только свои записи и при нескольких воркерах не знает о пополнении через соседа.
+    # Окончательно решает условный UPDATE в _create_order_tx.
+    shortages = []
+    for sku, qty in sku_qty.items():
+        available = int(row_map[sku]["stock"] or 0) - int(row_map[sku]["reserved"] or 0)
+        if available < qty:
+            shortages.append(f"Not enough stock for {sku}. Available: {available}, requested: {qty}")
+    if shortages:
+        raise HTTPException(400, "; ".join(shortages))
+
+    products: list[dict] = []
+    amount = 0
+    for it in items:
+        sku = str(it["sku"]).strip()
+        products.append(
+            {
+                "name": row_map[sku]["name"],
+                "price": prices[sku],
+                "quantity": int(it["qty"]),
+            }
+        )
+        amount += prices[sku] * int(it["qty"])
+
+    created_epoch = int(time.time())
+    expires_epoch = created_epoch + int(RESERVE_MINUTES * 60)
+    try:
+        await db_call_async(
+            _create_order_tx,
+            order_id,
+            items,
+            sku_qty,
+            prices,
+            amount,
+            payload_json,
+            created_epoch,
+            expires_epoch,
+        )
+    except _ReservationFailed as exc:
+        raise HTTPException(400, _reservation_failure_detail(sku_qty, exc.skus, prices))
+
+    _schedule_reservation_expiry(order_id, expires_epoch)
+    return products, amount
+
+
+def _mark_reservation_paid_tx(cur: sqlite3.Connection, order_id: str, now: int) -> str:
+    """Возвращает итоговый статус резерва: paid, если оплату можно принять."""
+    paid = cur.execute(
+        "UPDATE reservations SET status='paid' WHERE order_id=? AND status='active' AND expires_epoch > ?",
+        (order_id, now),
+    ).rowcount
+    if paid:
+        _deduct_reserved_stock(cur, order_id)
+        return "paid"
+
+    res = cur.execute("SELECT status FROM reservations WHERE order_id=?", (order_id,)).fetchone()
+    if not res:
+        return "missing"
+    if res["status"] != "active":
+        return res["status"]
+
+    # Резерв активен, но срок вышел, а свипер ещё не успел: освобождаем здесь же, оплату не принимаем.
+    _release_reserved_stock(cur, order_id)
+    cur.execute("UPDATE reservations SET status='expired' WHERE order_id=?", (order_id,))
+    return "expired"
+
+
+def _release_reservation_tx(cur: sqlite3.Connection, order_id: str, reason: str = "released") -> bool:
+    released = cur.execute(
+        "UPDATE reservations SET status=? WHERE order_id=? AND status='active'",
+        (reason, order_id),
+    ).rowcount
+    if released:
+        _release_reserved_stock(cur, order_id)
+    return bool(released)
+
+
+def _set_order_status_tx(cur: sqlite3.Connection, order_id: str, status: str) -> None:
+    cur.execute(
+        """
+        UPDATE orders
+        SET status=?, updated_at=datetime('now'), updated_epoch=CAST(strftime('%s', 'now') AS INTEGER)
+        WHERE order_id=?
+        """,
+        (status, order_id),
+    )
+
+
+def _mark_order_paid_tx(cur: sqlite3.Connection, order_id: str, now: int) -> str:
+    reservation_status = _mark_reservation_paid_tx(cur, order_id, now)
+    if reservation_status == "paid":
+        _set_order_status_tx(cur, order_id, "paid")
+        _enqueue_outbox_tx(cur, order_id, OUTBOX_ORDER_PAID_KINDS, now)
+    return reservation_status
+
+
+def _release_order_tx(cur: sqlite3.Connection, order_id: str, reason: str, status: str) -> None:
+    _release_reservation_tx(cur, order_id, reason)
+    _set_order_status_tx(cur, order_id, status)
+
+
+def _raise_for_reservation_status(reservation_status: str) -> None:
+    if reservation_status == "paid":
+        return
+    if reservation_status == "missing":
+        raise HTTPException(400, "Reservation not found")
+    raise HTTPException(409, f"Reservation already {reservation_status}")
+
+
+def _set_order_payment_url_tx(cur: sqlite3.Connection, order_id: str, payment_url: str) -> None:
+    cur.execute("UPDATE orders SET payment_url=? WHERE order_id=?", (payment_url, order_id))
+
+
+def get_order_payload(order_id: str) -> Optional[dict]:
+    with db_read() as con:
+        row = con.execute(
+            """
+            SELECT payload_json, amount, created_at, moysklad_demand_href, moysklad_sync_status,
+                   moysklad_sync_error, moysklad_synced_at
+            FROM orders
+            WHERE order_id=?
+            """,
+            (order_id,),
+        ).fetchone()
+    if not row:
+        return None
+    payload = json.loads(row["payload_json"])
+    payload["_amount"] = row["amount"]
+    payload["_created_at"] = row["created_at"]
+    payload["_moysklad_demand_href"] = row["moysklad_demand_href"]
+    payload["_moysklad_sync_status"] = row["moysklad_sync_status"]
+    payload["_moysklad_sync_error"] = row["moysklad_sync_error"]
+    payload["_moysklad_synced_at"] = row["moysklad_synced_at"]
+    return payload
+
+
+def claim_moysklad_sync(order_id: str) -> Optional[str]:
+    with db_write() as cur:
+        row = cur.execute(
+            """
+            SELECT moysklad_demand_href, moysklad_sync_status
+            FROM orders
+            WHERE order_id=?
+            """,
+            (order_id,),
+        ).fetchone()
+        if not row:
+            return "missing"
+        demand_href = str(row["moysklad_demand_href"] or "").strip()
+        sync_status = str(row["moysklad_sync_status"] or "").strip().lower()
+        if demand_href:
+            return "done"
+        if sync_status == "in_progress":
+            return "in_progress"
+        cur.execute(
+            """
+            UPDATE orders
+            SET moysklad_sync_status='in_progress',
+                moysklad_sync_error='',
+                updated_at=datetime('now'),
+                updated_epoch=CAST(strftime('%s', 'now') AS INTEGER)
+            WHERE order_id=?
+            """,
+            (order_id,),
+        )
+    return None
+
+
+def finish_moysklad_sync(order_id: str, *, demand_href: str = "", error: str = "") -> None:
+    with db_write() as con:
+        con.execute(
+            """
+            UPDATE orders
+            SET moysklad_demand_href=?,
+                moysklad_sync_status=?,
+                moysklad_sync_error=?,
+                moysklad_synced_at=CASE WHEN ? <> '' THEN datetime('now') ELSE moysklad_synced_at END,
+                updated_at=datetime('now'),
+                updated_epoch=CAST(strftime('%s', 'now') AS INTEGER)
+            WHERE order_id=?
+            """,
+            (
+                demand_href,
+                "done" if demand_href else "error",
+                error[:1000],
+                demand_href,
+                order_id,
+            ),
+        )
+
+
+def get_product_name_map(skus: list[str]) -> dict[str, str]:
+    if not skus:
+        return {}
+    placeholders = ",".join("?" for _ in skus)
+    with db_read() as con:
+        rows = con.execute(
+            f"SELECT sku, name FROM inventory WHERE sku IN ({placeholders})",
+            skus,
+        ).fetchall()
+    return {r["sku"]: r["name"] for r in rows}
+
+
+def _product_upload_public_url(filename: str) -> str:
     return f"/uploads/products/{filename}"
 
 
-def _safe_product_upload_name(filename: str) -> str:
+PRODUCT_UPLOAD_EXTENSIONS = (".jpg", ".png", ".webp")
+# Загрузки называются sha256 содержимого (варианты — с суффиксом _w<ширина>), поэтому файл
+# по такому адресу никогда не меняется.
+_HASHED_UPLOAD_RE = re.compile(r"^[0-9a-f]{64}(_w\d+_[0-9a-f]{8})?\.(jpg|png|webp)$")
+
+
+def _product_upload_ext(filename: str) -> str:
     ext = os.path.splitext(filename or "")[1].lower()
-    if ext not in (".jpg", ".jpeg", ".png", ".webp"):
+    if ext == ".jpeg":
+        ext = ".jpg"
+    if ext not in PRODUCT_UPLOAD_EXTENSIONS:
         raise HTTPException(400, "Поддерживаются только .jpg, .jpeg, .png, .webp")
-    return f"{uuid.uuid4().hex}{ext}"
+    return ext
+
+
+def _upload_too_large() -> HTTPException:
+    return HTTPException(413, f"Файл слишком большой: максимум {PRODUCT_UPLOAD_MAX_BYTES} байт")
+
+
+def _store_product_upload(src, ext: str) -> str:
+    """Скопировать загрузку на диск под именем sha256 содержимого; одинаковые файлы хранятся один раз."""
+    os.makedirs(PRODUCT_UPLOADS_DIR, exist_ok=True)
+    tmp_path = os.path.join(PRODUCT_UPLOADS_DIR, f".upload.{uuid.uuid4().hex}.tmp")
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(tmp_path, "wb") as out:
+            while True:
+                chunk = src.read(1024 * 1024)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > PRODUCT_UPLOAD_MAX_BYTES:
+                    raise _upload_too_large()
+                digest.update(chunk)
+                out.write(chunk)
+
+        stem = digest.hexdigest()
+        for existing_ext in PRODUCT_UPLOAD_EXTENSIONS:
+            existing = f"{stem}{existing_ext}"
+            if os.path.isfile(os.path.join(PRODUCT_UPLOADS_DIR, existing)):
+                return existing
+        filename = f"{stem}{ext}"
+        os.replace(tmp_path, os.path.join(PRODUCT_UPLOADS_DIR, filename))
+        return filename
+    finally:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
 
 
 def _normalize_storefront_asset_url(value: Any) -> str:
@@ -664,56 +1832,113 @@ def _normalize_storefront_asset_url(value: Any) -> str:
 
 
 def upsert_product_card(payload: "ProductCardUpsert") -> None:
-    ensure_inventory_columns()
-    con = db()
-    cur = con.cursor()
-    cur.execute("BEGIN IMMEDIATE")
+    with db_write() as cur:
+        existing = cur.execute("SELECT sku, stock, reserved FROM inventory WHERE sku=?", (payload.sku,)).fetchone()
+        if existing:
+            cur.execute(
+                """
+                UPDATE inventory
+                SET name=?, price=?, weight=?, shelf_life=?, description=?, image_url=?,
+                    badge=?, sort=?, active=?, catalog_override=1
+                WHERE sku=?
+                """,
+                (
+                    payload.name.strip(),
+                    int(payload.price),
+                    payload.weight.strip(),
+                    payload.shelfLife.strip(),
+                    payload.description.strip(),
+                    payload.imageUrl.strip(),
+                    payload.badge.strip(),
+                    int(payload.sort),
+                    int(payload.active),
+                    payload.sku.strip(),
+                ),
+            )
+        else:
+            cur.execute(
+                """
+                INSERT INTO inventory
+                (sku, name, stock, reserved, price, weight, shelf_life, description, image_url, badge, sort, active, catalog_override)
+                VALUES (?, ?, 0, 0, ?, ?, ?, ?, ?, ?, ?, ?, 1)
+                """,
+                (
+                    payload.sku.strip(),
+                    payload.name.strip(),
+                    int(payload.price),
+                    payload.weight.strip(),
+                    payload.shelfLife.strip(),
+                    payload.description.strip(),
+                    payload.imageUrl.strip(),
+                    payload.badge.strip(),
+                    int(payload.sort),
+                    int(payload.active),
+                ),
+            )
+        _stock_index_refresh(cur, [payload.sku.strip()])
+        invalidate_catalog_snapshot()
 
-    existing = cur.execute("SELECT sku, stock, reserved FROM inventory WHERE sku=?", (payload.sku,)).fetchone()
-    if existing:
-        cur.execute(
-            """
-            UPDATE inventory
-            SET name=?, price=?, weight=?, shelf_life=?, description=?, image_url=?,
-                badge=?, sort=?, active=?, catalog_override=1
-            WHERE sku=?
-            """,
-            (
-                payload.name.strip(),
-                int(payload.price),
-                payload.weight.strip(),
-                payload.shelfLife.strip(),
-                payload.description.strip(),
-                payload.imageUrl.strip(),
-                payload.badge.strip(),
-                int(payload.sort),
-                int(payload.active),
-                payload.sku.strip(),
-            ),
-        )
-    else:
-        cur.execute(
-            """
-            INSERT INTO inventory
-            (sku, name, stock, reserved, price, weight, shelf_life, description, image_url, badge, sort, active, catalog_override)
-            VALUES (?, ?, 0, 0, ?, ?, ?, ?, ?, ?, ?, ?, 1)
-            """,
-            (
-                payload.sku.strip(),
-                payload.name.strip(),
-                int(payload.price),
-                payload.weight.strip(),
-                payload.shelfLife.strip(),
-                payload.description.strip(),
-                payload.imageUrl.strip(),
-                payload.badge.strip(),
-                int(payload.sort),
-                int(payload.active),
-            ),
-        )
 
-    con.commit()
-    con.close()
+# ---------------------------
+# HTTP clients
+# ---------------------------
+# Один долгоживущий клиент на внешний сервис (синхронный для кода в потоках, асинхронный для
+# event loop): соединения переиспользуются, TLS-рукопожатие не повторяется на каждый заказ.
+HTTP_UPSTREAMS = {
+    "leadteh": httpx.Timeout(20, connect=5),
+    "moysklad": httpx.Timeout(30, connect=5),
+    "prodamus": httpx.Timeout(20, connect=5),
+}
+HTTP_LIMITS = httpx.Limits(
+    max_connections=int(_env_str("HTTP_MAX_CONNECTIONS", "20")),
+    max_keepalive_connections=int(_env_str("HTTP_MAX_KEEPALIVE_CONNECTIONS", "10")),
+    keepalive_expiry=float(_env_str("HTTP_KEEPALIVE_EXPIRY", "30")),
+)
+HTTP2_ENABLED = _env_str("HTTP2_ENABLED", "1") not in ("0", "false", "no") and h2 is not None
+
+_http_clients: dict[str, httpx.Client] = {}
+_http_async_clients: dict[str, httpx.AsyncClient] = {}
+_http_clients_lock = threading.Lock()
+
+
+def http_client(upstream: str) -> httpx.Client:
+    client = _http_clients.get(upstream)
+    if client is None:
+        with _http_clients_lock:
+            client = _http_clients.get(upstream)
+            if client is None:
+                client = httpx.Client(timeout=HTTP_UPSTREAMS[upstream], limits=HTTP_LIMITS, http2=HTTP2_ENABLED)
+                _http_clients[upstream] = client
+    return client
+
+
+def http_async_client(upstream: str) -> httpx.AsyncClient:
+    client = _http_async_clients.get(upstream)
+    if client is None:
+        with _http_clients_lock:
+            client = _http_async_clients.get(upstream)
+            if client is None:
+                client = httpx.AsyncClient(timeout=HTTP_UPSTREAMS[upstream], limits=HTTP_LIMITS, http2=HTTP2_ENABLED)
+                _http_async_clients[upstream] = client
+    return client
+
+
+def open_http_clients() -> None:
+    for upstream in HTTP_UPSTREAMS:
+        http_client(upstream)
+        http_async_client(upstream)
+
+
+async def close_http_clients() -> None:
+    with _http_clients_lock:
+        clients = list(_http_clients.values())
+        async_clients = list(_http_async_clients.values())
+        _http_clients.clear()
+        _http_async_clients.clear()
+    for client in clients:
+        client.close()
+    for async_client in async_clients:
+        await async_client.aclose()
 
 
 def _leadteh_enabled() -> bool:
@@ -724,13 +1949,77 @@ def _leadteh_products_enabled() -> bool:
     return bool(LEADTEH_API_TOKEN and LEADTEH_PRODUCTS_SCHEMA_ID)
 
 
+class _TokenBucket:
+    """Общий на процесс лимит запросов: до burst запросов сразу, дальше rate в секунду."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = max(rate, 0.01)
+        self.burst = max(burst, 1)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now > self._updated:
+                    self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                if now >= self._blocked_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                delay = max(self._blocked_until - now, (1 - self._tokens) / self.rate)
+            time.sleep(delay)
+
+    def block(self, seconds: float) -> None:
+        # 429: сервер сказал подождать — ждут все потоки, а не только получивший ответ.
+        with self._lock:
+            now = time.monotonic()
+            self._blocked_until = max(self._blocked_until, now + seconds)
+            # После паузы бюджет копится заново, без всплеска на весь burst.
+            self._tokens = 0.0
+            self._updated = self._blocked_until
+
+
+_leadteh_bucket = _TokenBucket(LEADTEH_RATE_PER_SEC, LEADTEH_BURST)
+
+
+def _retry_after_seconds(r: httpx.Response, attempt: int) -> float:
+    raw = (r.headers.get("retry-after") or "").strip()
+    if raw:
+        try:
+            return max(float(raw), 0.0)
+        except ValueError:
+            pass
+        try:
+            return max(parsedate_to_datetime(raw).timestamp() - time.time(), 0.0)
+        except (TypeError, ValueError):
+            pass
+    return min(2.0 ** attempt, 30.0)
+
+
+def _leadteh_call(client: httpx.Client, method: str, url: str, **kwargs: Any) -> httpx.Response:
+    """Единая точка для всех запросов к Leadteh: лимит, повтор на 429 с учётом Retry-After."""
+    attempt = 0
+    while True:
+        _leadteh_bucket.acquire()
+        r = client.request(method, url, **kwargs)
+        if r.status_code != 429 or attempt >= LEADTEH_MAX_RETRIES:
+            return r
+        attempt += 1
+        _leadteh_bucket.block(_retry_after_seconds(r, attempt))
+
+
 def _leadteh_request(client: httpx.Client, url: str, data: dict) -> dict:
-    r = client.post(
+    r = _leadteh_call(
+        client,
+        "POST",
         url,
         params={"api_token": LEADTEH_API_TOKEN},
         data=data,
         headers={"X-Requested-With": "XMLHttpRequest"},
-        timeout=20,
     )
     try:
         return r.json()
@@ -742,24 +2031,23 @@ def _leadteh_get_list_items(schema_id: str) -> list[dict]:
     items: list[dict] = []
     if not schema_id:
         return items
-    with httpx.Client() as client:
-        page = 1
-        while True:
-            data = _leadteh_request(
-                client,
-                "https://app.leadteh.ru/api/v1/getListItems",
-                {"schema_id": schema_id, "page": page},
-            )
-            chunk = data.get("data") or []
-            if isinstance(chunk, dict):
-                chunk = [chunk]
-            items.extend(chunk)
-            meta = data.get("meta") or {}
-            last_page = meta.get("last_page") or meta.get("lastPage")
-            if not last_page or page >= int(last_page):
-                break
-            page += 1
-            time.sleep(0.6)
+    client = http_client("leadteh")
+    page = 1
+    while True:
+        data = _leadteh_request(
+            client,
+            "https://app.leadteh.ru/api/v1/getListItems",
+            {"schema_id": schema_id, "page": page},
+        )
+        chunk = data.get("data") or []
+        if isinstance(chunk, dict):
+            chunk = [chunk]
+        items.extend(chunk)
+        meta = data.get("meta") or {}
+        last_page = meta.get("last_page") or meta.get("lastPage")
+        if not last_page or page >= int(last_page):
+            break
+        page += 1
     return items
 
 
@@ -797,90 +2085,86 @@ def sync_leadteh_products() -> dict:
     if not items:
         return {"ok": True, "updated": 0, "created": 0, "skipped": 0}
 
-    con = db()
-    cur = con.cursor()
-    cur.execute("BEGIN IMMEDIATE")
-
     updated = 0
     created = 0
     skipped = 0
 
-    for item in items:
-        sku = _leadteh_str(item.get("sku")).strip()
-        if not sku:
-            skipped += 1
-            continue
-
-        name = _leadteh_str(item.get("name"))
-        price = _leadteh_int(item.get("price"))
-        weight = _leadteh_str(item.get("weight"))
-        shelf_life = _leadteh_str(item.get("shelf_life"))
-        description = _leadteh_str(item.get("description"))
-        image_url = _leadteh_str(item.get("image_url") or item.get("image"))
-        badge = _leadteh_str(item.get("badge"))
-        stock = _leadteh_int(item.get("stock"))
-        sort = _leadteh_int(item.get("sort"))
-        active = _leadteh_bool(item.get("active", 1))
+    with db_write() as cur:
+        for item in items:
+            sku = _leadteh_str(item.get("sku")).strip()
+            if not sku:
+                skipped += 1
+                continue
 
-        row = cur.execute(
-            """
-            SELECT sku, name, price, weight, shelf_life, description, image_url, badge, sort, active, catalog_override
-            FROM inventory
-            WHERE sku=?
-            """,
-            (sku,),
-        ).fetchone()
-        preserve_local_catalog = _catalog_override_enabled(row, sku)
-        if row:
-            name_value = _leadteh_str(row["name"]) if preserve_local_catalog else name
-            price_value = _leadteh_int(row["price"]) if preserve_local_catalog else price
-            weight_value = _leadteh_str(row["weight"]) if preserve_local_catalog else weight
-            shelf_life_value = _leadteh_str(row["shelf_life"]) if preserve_local_catalog else shelf_life
-            description_value = _leadteh_str(row["description"]) if preserve_local_catalog else description
-            image_url_value = _leadteh_str(row["image_url"]) if preserve_local_catalog else image_url
-            badge_value = _leadteh_str(row["badge"]) if preserve_local_catalog else badge
-            sort_value = _leadteh_int(row["sort"]) if preserve_local_catalog else sort
-            cur.execute(
+            name = _leadteh_str(item.get("name"))
+            price = _leadteh_int(item.get("price"))
+            weight = _leadteh_str(item.get("weight"))
+            shelf_life = _leadteh_str(item.get("shelf_life"))
+            description = _leadteh_str(item.get("description"))
+            image_url = _leadteh_str(item.get("image_url") or item.get("image"))
+            badge = _leadteh_str(item.get("badge"))
+            stock = _leadteh_int(item.get("stock"))
+            sort = _leadteh_int(item.get("sort"))
+            active = _leadteh_bool(item.get("active", 1))
+
+            row = cur.execute(
                 """
-                UPDATE inventory
-                SET name=?, price=?, weight=?, shelf_life=?, description=?, image_url=?,
-                    badge=?, stock=?, sort=?, active=?
+                SELECT sku, name, price, weight, shelf_life, description, image_url, badge, sort, active, catalog_override
+                FROM inventory
                 WHERE sku=?
                 """,
-                (
-                    name_value,
-                    price_value,
-                    weight_value,
-                    shelf_life_value,
-                    description_value,
-                    image_url_value,
-                    badge_value,
-                    stock,
-                    sort_value,
-                    active,
-                    sku,
-                ),
-            )
-            updated += 1
-        else:
-            cur.execute(
-                """
-                INSERT INTO inventory
-                (sku, name, stock, reserved, price, weight, shelf_life, description, image_url, badge, sort, active, catalog_override)
-                VALUES (?, ?, ?, 0, ?, ?, ?, ?, ?, ?, ?, ?, 1)
-                """,
-                (sku, name, stock, price, weight, shelf_life, description, image_url, badge, sort, active),
-            )
-            created += 1
+                (sku,),
+            ).fetchone()
+            preserve_local_catalog = _catalog_override_enabled(row, sku)
+            if row:
+                name_value = _leadteh_str(row["name"]) if preserve_local_catalog else name
+                price_value = _leadteh_int(row["price"]) if preserve_local_catalog else price
+                weight_value = _leadteh_str(row["weight"]) if preserve_local_catalog else weight
+                shelf_life_value = _leadteh_str(row["shelf_life"]) if preserve_local_catalog else shelf_life
+                description_value = _leadteh_str(row["description"]) if preserve_local_catalog else description
+                image_url_value = _leadteh_str(row["image_url"]) if preserve_local_catalog else image_url
+                badge_value = _leadteh_str(row["badge"]) if preserve_local_catalog else badge
+                sort_value = _leadteh_int(row["sort"]) if preserve_local_catalog else sort
+                cur.execute(
+                    """
+                    UPDATE inventory
+                    SET name=?, price=?, weight=?, shelf_life=?, description=?, image_url=?,
+                        badge=?, stock=?, sort=?, active=?
+                    WHERE sku=?
+                    """,
+                    (
+                        name_value,
+                        price_value,
+                        weight_value,
+                        shelf_life_value,
+                        description_value,
+                        image_url_value,
+                        badge_value,
+                        stock,
+                        sort_value,
+                        active,
+                        sku,
+                    ),
+                )
+                updated += 1
+            else:
+                cur.execute(
+                    """
+                    INSERT INTO inventory
+                    (sku, name, stock, reserved, price, weight, shelf_life, description, image_url, badge, sort, active, catalog_override)
+                    VALUES (?, ?, ?, 0, ?, ?, ?, ?, ?, ?, ?, ?, 1)
+                    """,
+                    (sku, name, stock, price, weight, shelf_life, description, image_url, badge, sort, active),
+                )
+                created += 1
+        _stock_index_refresh(cur)
+        invalidate_catalog_snapshot()
 
-    con.commit()
-    con.close()
     return {"ok": True, "updated": updated, "created": created, "skipped": skipped}
 
 
 def _inventory_rows_for_skus(skus: Optional[list[str]] = None) -> list[sqlite3.Row]:
-    con = db()
-    try:
+    with db_read() as con:
         if skus:
             normalized = [str(sku).strip() for sku in skus if str(sku).strip()]
             if not normalized:
@@ -888,7 +2172,8 @@ def _inventory_rows_for_skus(skus: Optional[list[str]] = None) -> list[sqlite3.R
             placeholders = ",".join("?" for _ in normalized)
             rows = con.execute(
                 f"""
-                SELECT sku, name, price, weight, shelf_life, description, image_url, badge, sort, active, stock
+                SELECT sku, name, price, weight, shelf_life, description, image_url, badge, sort, active, stock,
+                       leadteh_item_id, leadteh_push_hash
                 FROM inventory
                 WHERE sku IN ({placeholders})
                 """,
@@ -898,32 +2183,92 @@ def _inventory_rows_for_skus(skus: Optional[list[str]] = None) -> list[sqlite3.R
 
         rows = con.execute(
             """
-            SELECT sku, name, price, weight, shelf_life, description, image_url, badge, sort, active, stock
+            SELECT sku, name, price, weight, shelf_life, description, image_url, badge, sort, active, stock,
+                   leadteh_item_id, leadteh_push_hash
             FROM inventory
             """
         ).fetchall()
         return rows
-    finally:
-        con.close()
 
 
-def _push_inventory_rows_to_leadteh(rows: list[sqlite3.Row]) -> dict:
-    if not _leadteh_products_enabled():
-        raise HTTPException(500, "Set LEADTEH_API_TOKEN and LEADTEH_PRODUCTS_SCHEMA_ID in backend/.env")
+def _leadteh_product_payload(r: sqlite3.Row) -> dict:
+    return {
+        "sku": r["sku"],
+        "name": r["name"],
+        "price": int(r["price"] or 0),
+        "stock": int(r["stock"] or 0),
+        "weight": r["weight"] or "",
+        "shelf_life": r["shelf_life"] or "",
+        "description": r["description"] or "",
+        "image_url": r["image_url"] or "",
+        "badge": r["badge"] or "",
+        "sort": int(r["sort"] or 0),
+        "active": int(r["active"] or 0),
+    }
 
-    if not rows:
-        return {"ok": True, "created": 0, "updated": 0}
 
-    existing = _leadteh_get_list_items(LEADTEH_PRODUCTS_SCHEMA_ID)
-    sku_to_id = {}
-    for item in existing:
+def _leadteh_payload_hash(payload: dict) -> str:
+    raw = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:32]
+
+
+def _save_leadteh_item_ids_tx(cur: sqlite3.Connection, sku_to_id: dict[str, str]) -> None:
+    cur.executemany(
+        "UPDATE inventory SET leadteh_item_id=? WHERE sku=? AND leadteh_item_id IS NOT ?",
+        [(item_id, sku, item_id) for sku, item_id in sku_to_id.items()],
+    )
+
+
+def _save_leadteh_push_tx(cur: sqlite3.Connection, pushed: list[tuple[str, str, str]]) -> None:
+    # (sku, item_id, hash); пустой item_id сбрасывает привязку — элемент будет найден заново при следующем пуше.
+    cur.executemany(
+        "UPDATE inventory SET leadteh_item_id=?, leadteh_push_hash=? WHERE sku=?",
+        [(item_id, push_hash, sku) for sku, item_id, push_hash in pushed],
+    )
+
+
+def _leadteh_fetch_item_ids() -> dict[str, str]:
+    sku_to_id: dict[str, str] = {}
+    for item in _leadteh_get_list_items(LEADTEH_PRODUCTS_SCHEMA_ID):
         sku = _leadteh_str(item.get("sku")).strip()
         item_id = item.get("id") or item.get("_id")
         if sku and item_id:
-            sku_to_id[sku] = item_id
+            sku_to_id[sku] = str(item_id)
+    if sku_to_id:
+        db_call(_save_leadteh_item_ids_tx, sku_to_id)
+    return sku_to_id
+
+
+def _push_inventory_rows_to_leadteh(rows: list[sqlite3.Row], force: bool = False) -> dict:
+    """Отправить в Leadteh строки, чей payload изменился с прошлого пуша; список товаров перечитывается,
+    только если у какой-то строки ещё нет id элемента."""
+    if not _leadteh_products_enabled():
+        raise HTTPException(500, "Set LEADTEH_API_TOKEN and LEADTEH_PRODUCTS_SCHEMA_ID in backend/.env")
+
+    pending = []
+    for r in rows:
+        payload = _leadteh_product_payload(r)
+        push_hash = _leadteh_payload_hash(payload)
+        item_id = r["leadteh_item_id"] or ""
+        if not force and item_id and r["leadteh_push_hash"] == push_hash:
+            continue
+        pending.append((payload, push_hash, item_id))
+
+    skipped = len(rows) - len(pending)
+    if not pending:
+        return {"ok": True, "created": 0, "updated": 0, "skipped": skipped, "failed": 0}
+
+    if any(not item_id for _, _, item_id in pending):
+        sku_to_id = _leadteh_fetch_item_ids()
+        pending = [
+            (payload, push_hash, item_id or sku_to_id.get(payload["sku"], ""))
+            for payload, push_hash, item_id in pending
+        ]
 
     created = 0
     updated = 0
+    failed = 0
+    pushed: list[tuple[str, str, str]] = []
 
     def to_form(data: dict) -> dict:
         out = {}
@@ -931,39 +2276,39 @@ def _push_inventory_rows_to_leadteh(rows: list[sqlite3.Row]) -> dict:
             out[f"data[{k}]"] = "" if v is None else str(v)
         return out
 
-    with httpx.Client() as client:
-        for r in rows:
-            payload = {
-                "sku": r["sku"],
-                "name": r["name"],
-                "price": int(r["price"] or 0),
-                "stock": int(r["stock"] or 0),
-                "weight": r["weight"] or "",
-                "shelf_life": r["shelf_life"] or "",
-                "description": r["description"] or "",
-                "image_url": r["image_url"] or "",
-                "badge": r["badge"] or "",
-                "sort": int(r["sort"] or 0),
-                "active": int(r["active"] or 0),
-            }
-            sku = r["sku"]
-            if sku in sku_to_id:
-                data = {"item_id": sku_to_id[sku], **to_form(payload)}
-                resp = _leadteh_request(client, "https://app.leadteh.ru/api/v1/updateListItem", data)
-                if resp.get("data"):
-                    updated += 1
+    client = http_client("leadteh")
+    for payload, push_hash, item_id in pending:
+        sku = payload["sku"]
+        if item_id:
+            data = {"item_id": item_id, **to_form(payload)}
+            resp = _leadteh_request(client, "https://app.leadteh.ru/api/v1/updateListItem", data)
+            if resp.get("data"):
+                updated += 1
+                pushed.append((sku, item_id, push_hash))
+            else:
+                # Элемент могли удалить в Leadteh: забываем id, в следующий раз строка найдётся или создастся заново.
+                failed += 1
+                pushed.append((sku, "", ""))
+        else:
+            data = {"schema_id": LEADTEH_PRODUCTS_SCHEMA_ID, **to_form(payload)}
+            resp = _leadteh_request(client, "https://app.leadteh.ru/api/v1/addListItem", data)
+            item = resp.get("data")
+            if item:
+                created += 1
+                new_id = (item.get("id") or item.get("_id")) if isinstance(item, dict) else None
+                # Без id в ответе хеш не сохраняем: строка уйдёт ещё раз и привяжется через список.
+                if new_id:
+                    pushed.append((sku, str(new_id), push_hash))
             else:
-                data = {"schema_id": LEADTEH_PRODUCTS_SCHEMA_ID, **to_form(payload)}
-                resp = _leadteh_request(client, "https://app.leadteh.ru/api/v1/addListItem", data)
-                if resp.get("data"):
-                    created += 1
-            time.sleep(0.6)
+                failed += 1
 
-    return {"ok": True, "created": created, "updated": updated}
+    if pushed:
+        db_call(_save_leadteh_push_tx, pushed)
+    return {"ok": not failed, "created": created, "updated": updated, "skipped": skipped, "failed": failed}
 
 
-def push_products_to_leadteh() -> dict:
-    return _push_inventory_rows_to_leadteh(_inventory_rows_for_skus())
+def push_products_to_leadteh(force: bool = False) -> dict:
+    return _push_inventory_rows_to_leadteh(_inventory_rows_for_skus(), force=force)
 
 
 def _sync_order_stocks_to_leadteh_sync(order_id: str) -> None:
@@ -986,13 +2331,8 @@ def _sync_order_stocks_to_leadteh_sync(order_id: str) -> None:
     rows = _inventory_rows_for_skus(skus)
     result = _push_inventory_rows_to_leadteh(rows)
     print("Leadteh stock sync:", order_id, result)
-
-
-async def sync_order_stocks_to_leadteh(order_id: str) -> None:
-    try:
-        await asyncio.to_thread(_sync_order_stocks_to_leadteh_sync, order_id)
-    except Exception as e:
-        print("Leadteh stock sync error:", repr(e))
+    if result["failed"]:
+        raise RuntimeError(f"Leadteh stock sync: {result['failed']} item(s) not pushed for order {order_id}")
 
 
 def _sync_order_stocks_to_moysklad_sync(order_id: str) -> None:
@@ -1000,7 +2340,9 @@ def _sync_order_stocks_to_moysklad_sync(order_id: str) -> None:
         return
 
     claim_state = claim_moysklad_sync(order_id)
-    if claim_state in ("done", "in_progress"):
+    # in_progress остаётся от попытки, оборвавшейся вместе с процессом: задача outbox по заказу выполняется
+    # одна, а уже созданную отгрузку найдём по externalCode ниже.
+    if claim_state == "done":
         return
     if claim_state == "missing":
         raise ValueError(f"Order not found: {order_id}")
@@ -1022,17 +2364,16 @@ def _sync_order_stocks_to_moysklad_sync(order_id: str) -> None:
         finish_moysklad_sync(order_id, error="Order has no items for MoySklad sync")
         return
 
-    con = db()
     placeholders = ",".join("?" for _ in sku_qty)
-    rows = con.execute(
-        f"""
-        SELECT sku, name, price, moysklad_href
-        FROM inventory
-        WHERE sku IN ({placeholders})
-        """,
-        list(sku_qty.keys()),
-    ).fetchall()
-    con.close()
+    with db_read() as con:
+        rows = con.execute(
+            f"""
+            SELECT sku, name, price, moysklad_href
+            FROM inventory
+            WHERE sku IN ({placeholders})
+            """,
+            list(sku_qty.keys()),
+        ).fetchall()
 
     row_map = {str(row["sku"]): row for row in rows}
     missing_skus = [sku for sku in sku_qty if sku not in row_map]
@@ -1045,35 +2386,43 @@ def _sync_order_stocks_to_moysklad_sync(order_id: str) -> None:
         return
 
     try:
-        with httpx.Client() as client:
-            organization_href, store_href = _moysklad_document_context(client)
-            positions = []
-            for sku, qty in sku_qty.items():
-                row = row_map[sku]
-                positions.append(
-                    {
-                        "quantity": qty,
-                        "price": max(int(row["price"] or 0), 0) * 100,
-                        "assortment": _moysklad_meta(_moysklad_string(row["moysklad_href"]), "product"),
-                    }
-                )
+        client = http_client("moysklad")
+        existing_href = _moysklad_find_demand(client, order_id)
+        if existing_href:
+            # Прошлая попытка создала отгрузку, но не дождалась ответа (таймаут, рестарт).
+            finish_moysklad_sync(order_id, demand_href=existing_href)
+            print("MoySklad stock sync: demand already exists", order_id, existing_href)
+            return
 
-            customer = payload.get("customer") or {}
-            delivery = payload.get("delivery") or {}
-            demand_body = {
-                "applicable": True,
-                "moment": time.strftime("%Y-%m-%d %H:%M:%S"),
-                "organization": _moysklad_meta(organization_href, "organization"),
-                "store": _moysklad_meta(store_href, "store"),
-                "description": (
-                    f"Оплаченный заказ miniapp {order_id}. "
-                    f"Клиент: {customer.get('name') or '-'}, "
-                    f"телефон: {customer.get('phone') or '-'}, "
-                    f"доставка: {delivery.get('method') or '-'}."
-                ),
-                "positions": positions,
-            }
-            result = _moysklad_request(client, "POST", "/entity/demand", json_body=demand_body)
+        organization_href, store_href = _moysklad_document_context(client)
+        positions = []
+        for sku, qty in sku_qty.items():
+            row = row_map[sku]
+            positions.append(
+                {
+                    "quantity": qty,
+                    "price": max(int(row["price"] or 0), 0) * 100,
+                    "assortment": _moysklad_meta(_moysklad_string(row["moysklad_href"]), "product"),
+                }
+            )
+
+        customer = payload.get("customer") or {}
+        delivery = payload.get("delivery") or {}
+        demand_body = {
+            "externalCode": order_id,
+            "applicable": True,
+            "moment": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "organization": _moysklad_meta(organization_href, "organization"),
+            "store": _moysklad_meta(store_href, "store"),
+            "description": (
+                f"Оплаченный заказ miniapp {order_id}. "
+                f"Клиент: {customer.get('name') or '-'}, "
+                f"телефон: {customer.get('phone') or '-'}, "
+                f"доставка: {delivery.get('method') or '-'}."
+            ),
+            "positions": positions,
+        }
+        result = _moysklad_request(client, "POST", "/entity/demand", json_body=demand_body)
     except Exception as exc:
         finish_moysklad_sync(order_id, error=repr(exc))
         raise
@@ -1087,11 +2436,15 @@ def _sync_order_stocks_to_moysklad_sync(order_id: str) -> None:
     print("MoySklad stock sync:", order_id, demand_href)
 
 
-async def sync_order_stocks_to_moysklad(order_id: str) -> None:
-    try:
-        await asyncio.to_thread(_sync_order_stocks_to_moysklad_sync, order_id)
-    except Exception as e:
-        print("MoySklad stock sync error:", repr(e))
+def _moysklad_find_demand(client: httpx.Client, order_id: str) -> str:
+    data = _moysklad_request(
+        client,
+        "GET",
+        "/entity/demand",
+        params={"filter": f"externalCode={order_id}", "limit": 1},
+    )
+    rows = data.get("rows") or []
+    return _moysklad_meta_href(rows[0]) if rows else ""
 
 
 def _moysklad_enabled() -> bool:
@@ -1132,7 +2485,6 @@ def _moysklad_request(
         params=params,
         json=json_body,
         headers=_moysklad_headers(),
-        timeout=30,
     )
     try:
         r.raise_for_status()
@@ -1406,167 +2758,155 @@ def sync_moysklad_products() -> dict:
     if not _moysklad_enabled():
         raise HTTPException(500, "Set MOYSKLAD_TOKEN in backend/.env")
 
-    ensure_inventory_columns()
-
-    con = None
     try:
-        with httpx.Client() as client:
-            items = _moysklad_get_rows(client, "/entity/product", params={"expand": "images"})
+        client = http_client("moysklad")
+        items = _moysklad_get_rows(client, "/entity/product", params={"expand": "images"})
 
         if not items:
             return {"ok": True, "updated": 0, "created": 0, "skipped": 0}
 
-        con = db()
-        cur = con.cursor()
-        cur.execute("BEGIN IMMEDIATE")
-
         updated = 0
         created = 0
         skipped = 0
 
-        for item in items:
-            sku = _moysklad_sku(item)
-            name = _moysklad_string(item.get("name"))
-            if not sku or not name:
-                skipped += 1
-                continue
-
-            existing = cur.execute(
-                """
-                SELECT sku, name, price, stock, weight, shelf_life, description, image_url, badge, sort, active, catalog_override
-                FROM inventory
-                WHERE sku=?
-                """,
-                (sku,),
-            ).fetchone()
-            preserve_local_catalog = _catalog_override_enabled(existing, sku)
-
-            attr_weight = _moysklad_attr_value(item, MOYSKLAD_ATTR_WEIGHT)
-            attr_shelf_life = _moysklad_attr_value(item, MOYSKLAD_ATTR_SHELF_LIFE)
-            attr_badge = _moysklad_attr_value(item, MOYSKLAD_ATTR_BADGE)
-            attr_sort = _moysklad_attr_value(item, MOYSKLAD_ATTR_SORT)
-            attr_active = _moysklad_attr_value(item, MOYSKLAD_ATTR_ACTIVE)
-            attr_image_url = _moysklad_attr_value(item, MOYSKLAD_ATTR_IMAGE_URL)
-
-            name_value = name
-            if preserve_local_catalog:
-                name_value = _moysklad_string(existing["name"]) or name
-
-            weight_value = attr_weight or ""
-            if not weight_value:
-                standard_weight = _moysklad_int_or_none(item.get("weight"))
-                if standard_weight:
-                    weight_value = f"{standard_weight} г"
-            if not weight_value and existing:
-                weight_value = _moysklad_string(existing["weight"])
-            if preserve_local_catalog:
-                weight_value = _moysklad_string(existing["weight"]) or weight_value
-
-            shelf_life_value = attr_shelf_life or (_moysklad_string(existing["shelf_life"]) if existing else "")
-            badge_value = attr_badge or (_moysklad_string(existing["badge"]) if existing else "")
-            if preserve_local_catalog:
-                shelf_life_value = _moysklad_string(existing["shelf_life"]) or shelf_life_value
-                badge_value = _moysklad_string(existing["badge"]) or badge_value
-
-            sort_value = _moysklad_int_or_none(attr_sort)
-            if sort_value is None:
-                existing_sort = _moysklad_int(existing["sort"]) if existing else 0
-                sort_value = _fixed_sort_for_sku(sku, existing_sort)
-
-            active_value = _moysklad_bool_or_none(attr_active)
-            if active_value is None:
-                active_value = 0 if item.get("archived") else 1
-
-            stock_value = _moysklad_int_or_none(item.get("stock"))
-            if stock_value is None:
-                stock_value = _moysklad_int_or_none(item.get("quantity"))
-            if stock_value is None:
-                stock_value = _moysklad_int(existing["stock"]) if existing else 0
-
-            existing_image_url = _moysklad_string(existing["image_url"]) if existing else ""
-            image_href = _moysklad_image_href(item)
-            if preserve_local_catalog:
-                image_url = existing_image_url or attr_image_url or _moysklad_proxy_image_url(image_href)
-            elif existing_image_url and _is_local_storefront_image_url(existing_image_url) and not attr_image_url:
-                image_url = existing_image_url
-            else:
-                image_url = attr_image_url or _moysklad_proxy_image_url(image_href) or existing_image_url
-
-            description_value = _moysklad_string(item.get("description"))
-            if not description_value and existing:
-                description_value = _moysklad_string(existing["description"])
-            if preserve_local_catalog:
-                description_value = _moysklad_string(existing["description"]) or description_value
+        with db_write() as cur:
+            for item in items:
+                sku = _moysklad_sku(item)
+                name = _moysklad_string(item.get("name"))
+                if not sku or not name:
+                    skipped += 1
+                    continue
 
-            moysklad_href = _moysklad_string(((item.get("meta") or {}).get("href")))
-            price_value = _moysklad_price(item)
-            if preserve_local_catalog:
-                price_value = _moysklad_int(existing["price"]) or price_value
-
-            if existing:
-                cur.execute(
+                existing = cur.execute(
                     """
-                    UPDATE inventory
-                    SET name=?, price=?, weight=?, shelf_life=?, description=?, image_url=?,
-                        badge=?, stock=?, sort=?, active=?, moysklad_href=?, moysklad_image_href=?
+                    SELECT sku, name, price, stock, weight, shelf_life, description, image_url, badge, sort, active, catalog_override
+                    FROM inventory
                     WHERE sku=?
                     """,
-                    (
-                        name_value,
-                        price_value,
-                        weight_value,
-                        shelf_life_value,
-                        description_value,
-                        image_url,
-                        badge_value,
-                        stock_value,
-                        sort_value,
-                        active_value,
-                        moysklad_href,
-                        image_href,
-                        sku,
-                    ),
-                )
-                updated += 1
-            else:
-                cur.execute(
-                    """
-                    INSERT INTO inventory
-                    (sku, name, stock, reserved, price, weight, shelf_life, description, image_url, badge, sort, active, catalog_override, moysklad_href, moysklad_image_href)
-                    VALUES (?, ?, ?, 0, ?, ?, ?, ?, ?, ?, ?, ?, 1, ?, ?)
-                    """,
-                    (
-                        sku,
-                        name,
-                        stock_value,
-                        price_value,
-                        weight_value,
-                        shelf_life_value,
-                        description_value,
-                        image_url,
-                        badge_value,
-                        sort_value,
-                        active_value,
-                        moysklad_href,
-                        image_href,
-                    ),
-                )
-                created += 1
+                    (sku,),
+                ).fetchone()
+                preserve_local_catalog = _catalog_override_enabled(existing, sku)
+
+                attr_weight = _moysklad_attr_value(item, MOYSKLAD_ATTR_WEIGHT)
+                attr_shelf_life = _moysklad_attr_value(item, MOYSKLAD_ATTR_SHELF_LIFE)
+                attr_badge = _moysklad_attr_value(item, MOYSKLAD_ATTR_BADGE)
+                attr_sort = _moysklad_attr_value(item, MOYSKLAD_ATTR_SORT)
+                attr_active = _moysklad_attr_value(item, MOYSKLAD_ATTR_ACTIVE)
+                attr_image_url = _moysklad_attr_value(item, MOYSKLAD_ATTR_IMAGE_URL)
+
+                name_value = name
+                if preserve_local_catalog:
+                    name_value = _moysklad_string(existing["name"]) or name
+
+                weight_value = attr_weight or ""
+                if not weight_value:
+                    standard_weight = _moysklad_int_or_none(item.get("weight"))
+                    if standard_weight:
+                        weight_value = f"{standard_weight} г"
+                if not weight_value and existing:
+                    weight_value = _moysklad_string(existing["weight"])
+                if preserve_local_catalog:
+                    weight_value = _moysklad_string(existing["weight"]) or weight_value
+
+                shelf_life_value = attr_shelf_life or (_moysklad_string(existing["shelf_life"]) if existing else "")
+                badge_value = attr_badge or (_moysklad_string(existing["badge"]) if existing else "")
+                if preserve_local_catalog:
+                    shelf_life_value = _moysklad_string(existing["shelf_life"]) or shelf_life_value
+                    badge_value = _moysklad_string(existing["badge"]) or badge_value
+
+                sort_value = _moysklad_int_or_none(attr_sort)
+                if sort_value is None:
+                    existing_sort = _moysklad_int(existing["sort"]) if existing else 0
+                    sort_value = _fixed_sort_for_sku(sku, existing_sort)
+
+                active_value = _moysklad_bool_or_none(attr_active)
+                if active_value is None:
+                    active_value = 0 if item.get("archived") else 1
+
+                stock_value = _moysklad_int_or_none(item.get("stock"))
+                if stock_value is None:
+                    stock_value = _moysklad_int_or_none(item.get("quantity"))
+                if stock_value is None:
+                    stock_value = _moysklad_int(existing["stock"]) if existing else 0
+
+                existing_image_url = _moysklad_string(existing["image_url"]) if existing else ""
+                image_href = _moysklad_image_href(item)
+                if preserve_local_catalog:
+                    image_url = existing_image_url or attr_image_url or _moysklad_proxy_image_url(image_href)
+                elif existing_image_url and _is_local_storefront_image_url(existing_image_url) and not attr_image_url:
+                    image_url = existing_image_url
+                else:
+                    image_url = attr_image_url or _moysklad_proxy_image_url(image_href) or existing_image_url
+
+                description_value = _moysklad_string(item.get("description"))
+                if not description_value and existing:
+                    description_value = _moysklad_string(existing["description"])
+                if preserve_local_catalog:
+                    description_value = _moysklad_string(existing["description"]) or description_value
+
+                moysklad_href = _moysklad_string(((item.get("meta") or {}).get("href")))
+                price_value = _moysklad_price(item)
+                if preserve_local_catalog:
+                    price_value = _moysklad_int(existing["price"]) or price_value
+
+                if existing:
+                    cur.execute(
+                        """
+                        UPDATE inventory
+                        SET name=?, price=?, weight=?, shelf_life=?, description=?, image_url=?,
+                            badge=?, stock=?, sort=?, active=?, moysklad_href=?, moysklad_image_href=?
+                        WHERE sku=?
+                        """,
+                        (
+                            name_value,
+                            price_value,
+                            weight_value,
+                            shelf_life_value,
+                            description_value,
+                            image_url,
+                            badge_value,
+                            stock_value,
+                            sort_value,
+                            active_value,
+                            moysklad_href,
+                            image_href,
+                            sku,
+                        ),
+                    )
+                    updated += 1
+                else:
+                    cur.execute(
+                        """
+                        INSERT INTO inventory
+                        (sku, name, stock, reserved, price, weight, shelf_life, description, image_url, badge, sort, active, catalog_override, moysklad_href, moysklad_image_href)
+                        VALUES (?, ?, ?, 0, ?, ?, ?, ?, ?, ?, ?, ?, 1, ?, ?)
+                        """,
+                        (
+                            sku,
+                            name,
+                            stock_value,
+                            price_value,
+                            weight_value,
+                            shelf_life_value,
+                            description_value,
+                            image_url,
+                            badge_value,
+                            sort_value,
+                            active_value,
+                            moysklad_href,
+                            image_href,
+                        ),
+                    )
+                    created += 1
+            _stock_index_refresh(cur)
+            invalidate_catalog_snapshot()
 
-        con.commit()
         return {"ok": True, "updated": updated, "created": created, "skipped": skipped}
     except HTTPException:
-        if con is not None:
-            con.rollback()
         raise
     except Exception as e:
-        if con is not None:
-            con.rollback()
         print("MoySklad sync error:", repr(e))
         raise HTTPException(500, f"MoySklad sync error: {repr(e)}")
-    finally:
-        if con is not None:
-            con.close()
 
 def _normalize_phone(raw: str) -> str:
     digits = re.sub(r"\D+", "", raw or "")
@@ -1593,7 +2933,9 @@ def _leadteh_email_key(raw: str) -> str:
 
 
 def _leadteh_get_contacts_page(client: httpx.Client, page: int, count: int = 500) -> dict:
-    r = client.get(
+    r = _leadteh_call(
+        client,
+        "GET",
         "https://app.leadteh.ru/api/v1/getContacts",
         params={
             "api_token": LEADTEH_API_TOKEN,
@@ -1602,29 +2944,101 @@ def _leadteh_get_contacts_page(client: httpx.Client, page: int, count: int = 500
             "count": count,
         },
         headers={"X-Requested-With": "XMLHttpRequest"},
-        timeout=20,
     )
+    # Ошибку не выдаём за пустую страницу: обновление приняло бы её за конец списка и удалило остальное.
+    if not r.is_success:
+        raise RuntimeError(f"Leadteh getContacts page {page} failed: {r.status_code} {(r.text or '')[:200]}")
     try:
-        return r.json()
+        data = r.json()
     except Exception:
-        return {"_status": r.status_code, "_text": r.text}
+        data = None
+    if not isinstance(data, dict) or not isinstance(data.get("data"), list) or not isinstance(data.get("meta"), dict):
+        raise RuntimeError(f"Leadteh getContacts page {page}: unexpected response {(r.text or '')[:200]}")
+    return data
 
 
-def _leadteh_find_contact_by_phone_or_email(client: httpx.Client, phone: str, email: str) -> Optional[int]:
-    phone_key = _leadteh_phone_key(phone)
-    email_key = _leadteh_email_key(email)
-    if not phone_key and not email_key:
-        return None
+def _leadteh_index_contacts_tx(cur: sqlite3.Connection, contacts: list[tuple[int, str, str]]) -> None:
+    now = int(time.time())
+    cur.executemany(
+        """
+        INSERT INTO leadteh_contacts(contact_id, phone_key, email_key, updated_epoch)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(contact_id) DO UPDATE SET
+          phone_key=excluded.phone_key,
+          email_key=excluded.email_key,
+          updated_epoch=excluded.updated_epoch
+        """,
+        [(contact_id, phone_key, email_key, now) for contact_id, phone_key, email_key in contacts],
+    )
 
-    page = 1
+
+def _leadteh_finish_contacts_refresh_tx(cur: sqlite3.Connection, page: int, seen: Optional[set[int]]) -> None:
+    cur.execute(
+        """
+        INSERT INTO leadteh_contacts_cursor(id, page) VALUES (1, ?)
+        ON CONFLICT(id) DO UPDATE SET page=excluded.page
+        """,
+        (page,),
+    )
+    if seen is not None:
+        # Полный проход не встретил этих контактов — в Leadteh их больше нет.
+        stale = [
+            (row["contact_id"],)
+            for row in cur.execute("SELECT contact_id FROM leadteh_contacts").fetchall()
+            if row["contact_id"] not in seen
+        ]
+        cur.executemany("DELETE FROM leadteh_contacts WHERE contact_id=?", stale)
+
+
+def _leadteh_forget_contact_tx(cur: sqlite3.Connection, contact_id: int) -> None:
+    cur.execute("DELETE FROM leadteh_contacts WHERE contact_id=?", (contact_id,))
+    cur.execute("DELETE FROM leadteh_contact_variables WHERE contact_id=?", (contact_id,))
+
+
+def _leadteh_lookup_contact(phone_key: str, email_key: str) -> tuple[Optional[int], Optional[int]]:
+    """(совпадение по телефону, совпадение по email) в локальном индексе."""
+    matches: list[Optional[int]] = []
+    with db_read() as con:
+        for column, key in (("phone_key", phone_key), ("email_key", email_key)):
+            row = None
+            if key:
+                row = con.execute(
+                    f"SELECT contact_id FROM leadteh_contacts WHERE {column}=? ORDER BY contact_id LIMIT 1",
+                    (key,),
+                ).fetchone()
+            matches.append(int(row["contact_id"]) if row else None)
+    return matches[0], matches[1]
+
+
+def _leadteh_contacts_cursor() -> Optional[int]:
+    with db_read() as con:
+        row = con.execute("SELECT page FROM leadteh_contacts_cursor WHERE id=1").fetchone()
+    return int(row["page"]) if row else None
+
+
+def _leadteh_scan_contacts(
+    client: httpx.Client,
+    page: int = 1,
+    phone_key: str = "",
+    email_key: str = "",
+    seen: Optional[set[int]] = None,
+) -> tuple[Optional[int], Optional[int], Optional[int]]:
+    """Листает контакты бота с page, складывая каждую страницу в индекс; останавливается на совпадении
+    по телефону. Возвращает (совпадение по телефону, по email, last_page из ответа — None при досрочной остановке)."""
     email_match: Optional[int] = None
 
     while True:
         data = _leadteh_get_contacts_page(client, page=page)
-        rows = data.get("data") or []
-        if not isinstance(rows, list):
-            rows = []
+        rows = data["data"]
+        meta = data["meta"]
+        try:
+            current_page = int(meta.get("current_page") or page)
+            last_page = int(meta.get("last_page") or current_page)
+        except Exception:
+            raise RuntimeError(f"Leadteh getContacts page {page}: bad meta {meta!r}")
 
+        contacts: list[tuple[int, str, str]] = []
+        phone_match: Optional[int] = None
         for row in rows:
             try:
                 contact_id = int(row.get("id"))
@@ -1633,31 +3047,101 @@ def _leadteh_find_contact_by_phone_or_email(client: httpx.Client, phone: str, em
 
             row_phone = _leadteh_phone_key(str(row.get("phone") or ""))
             row_email = _leadteh_email_key(row.get("email") or "")
+            contacts.append((contact_id, row_phone, row_email))
 
-            if phone_key and row_phone and row_phone == phone_key:
-                return contact_id
+            if phone_key and row_phone and row_phone == phone_key and phone_match is None:
+                phone_match = contact_id
             if email_key and row_email and row_email == email_key and email_match is None:
                 email_match = contact_id
 
-        meta = data.get("meta") or {}
-        try:
-            current_page = int(meta.get("current_page") or page)
-        except Exception:
-            current_page = page
+        if contacts:
+            db_call(_leadteh_index_contacts_tx, contacts)
+        if seen is not None:
+            seen.update(contact_id for contact_id, _, _ in contacts)
+        if phone_match is not None:
+            return phone_match, email_match, None
+        if current_page >= last_page:
+            # Дошли до последней страницы (или курсор оказался за концом сократившегося списка).
+            return None, email_match, max(last_page, 1)
+        if not rows:
+            raise RuntimeError(f"Leadteh getContacts page {current_page} of {last_page} is empty")
+        page = current_page + 1
+
+
+def _leadteh_find_contact_by_phone_or_email(client: httpx.Client, phone: str, email: str) -> Optional[int]:
+    phone_key = _leadteh_phone_key(phone)
+    email_key = _leadteh_email_key(email)
+    if not phone_key and not email_key:
+        return None
+
+    phone_hit, email_hit = _leadteh_lookup_contact(phone_key, email_key)
+    if phone_hit is not None:
+        return phone_hit
+    if email_hit is not None and not phone_key:
+        return email_hit
+    # Промах индекса или совпадение только по email: контакт с этим телефоном мог появиться после
+    # последнего обновления, а телефон, как и раньше, важнее email — полный проход.
+    phone_match, email_match, _ = _leadteh_scan_contacts(client, 1, phone_key, email_key)
+    return phone_match if phone_match is not None else email_match
+
+
+def refresh_leadteh_contacts(full: bool = False) -> None:
+    """Дочитать в индекс новые контакты (с сохранённой страницы до конца). Полный проход заново
+    переписывает все строки и удаляет контакты, которых в Leadteh больше нет."""
+    if not _leadteh_enabled():
+        return
+    cursor = _leadteh_contacts_cursor()
+    if cursor is None:
+        full = True
+    seen: Optional[set[int]] = set() if full else None
+    _, _, last_page = _leadteh_scan_contacts(http_client("leadteh"), 1 if full else cursor, seen=seen)
+    # Курсор двигает только обновление: last_page из ответа верен и когда список вырос, и когда сократился.
+    db_call(_leadteh_finish_contacts_refresh_tx, last_page or 1, seen)
+
+
+_leadteh_contacts_task: Optional[asyncio.Task] = None
+
+
+async def _leadteh_contacts_refresher() -> None:
+    last_full = time.monotonic()
+    while True:
+        full = time.monotonic() - last_full >= LEADTEH_CONTACTS_FULL_REFRESH_INTERVAL
         try:
-            last_page = int(meta.get("last_page") or current_page)
-        except Exception:
-            last_page = current_page
+            await asyncio.to_thread(refresh_leadteh_contacts, full)
+            if full:
+                last_full = time.monotonic()
+        except Exception as e:
+            print("Leadteh contacts refresh error:", repr(e))
+        await asyncio.sleep(LEADTEH_CONTACTS_REFRESH_INTERVAL)
+
+
+async def start_leadteh_contacts_refresh() -> None:
+    global _leadteh_contacts_task
+    if _leadteh_contacts_task is not None or not _leadteh_enabled() or LEADTEH_CONTACTS_REFRESH_INTERVAL <= 0:
+        return
+    _leadteh_contacts_task = asyncio.create_task(_leadteh_contacts_refresher())
+
+
+async def stop_leadteh_contacts_refresh() -> None:
+    global _leadteh_contacts_task
+    task, _leadteh_contacts_task = _leadteh_contacts_task, None
+    if task is None:
+        return
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
 
-        if not rows or current_page >= last_page:
-            break
-        page = current_page + 1
 
-    return email_match
+class _LeadtehContactMissing(Exception):
+    pass
 
 
-def _leadteh_set_variable_sync(client: httpx.Client, contact_id: int, name: str, value: str) -> None:
-    r = client.post(
+def _leadteh_set_variable_sync(client: httpx.Client, contact_id: int, name: str, value: str) -> bool:
+    r = _leadteh_call(
+        client,
+        "POST",
         "https://app.leadteh.ru/api/v1/setContactVariable",
         params={
             "api_token": LEADTEH_API_TOKEN,
@@ -1670,6 +3154,74 @@ def _leadteh_set_variable_sync(client: httpx.Client, contact_id: int, name: str,
         timeout=10,
     )
     print("Leadteh setVariable:", name, "status=", r.status_code, "body=", (r.text or "")[:200])
+    if r.status_code == 404:
+        raise _LeadtehContactMissing(contact_id)
+    return r.is_success
+
+
+# Переменные заказа и статуса оплаты уходят один раз на каждый новый заказ, даже если значение не изменилось:
+# на их установку завязаны триггеры бота. Повтор того же заказа их не шлёт, иначе клиент получит дубли.
+LEADTEH_ALWAYS_SENT_VARIABLES = frozenset({"order_id", "payment_status", "payment_note"})
+
+
+def _leadteh_changed_variables(contact_id: int, variables: list[tuple[str, str]]) -> list[tuple[str, str]]:
+    with db_read() as con:
+        sent = {
+            r["name"]: (r["value"], int(r["updated_epoch"]))
+            for r in con.execute(
+                "SELECT name, value, updated_epoch FROM leadteh_contact_variables WHERE contact_id=?",
+                (contact_id,),
+            )
+        }
+
+    # Переменные заказа уже ушли для этого заказа, если order_id совпадает и они запомнены не раньше него
+    # (повтор задачи после частичной отправки).
+    order_id = dict(variables).get("order_id")
+    remembered_order = sent.get("order_id")
+    same_order = remembered_order is not None and remembered_order[0] == order_id
+
+    def order_variable_sent(name: str) -> bool:
+        return same_order and name in sent and sent[name][1] >= remembered_order[1]
+
+    # Запомненное значение старше LEADTEH_VARIABLES_TTL не доверяем: его могли сменить в Leadteh.
+    fresh_since = int(time.time()) - LEADTEH_VARIABLES_TTL
+    changed = []
+    for name, value in variables:
+        if name in LEADTEH_ALWAYS_SENT_VARIABLES:
+            if not order_variable_sent(name):
+                changed.append((name, value))
+        elif name not in sent or sent[name][0] != value or sent[name][1] < fresh_since:
+            changed.append((name, value))
+    return changed
+
+
+def _leadteh_remember_variables_tx(cur: sqlite3.Connection, contact_id: int, variables: list[tuple[str, str]]) -> None:
+    now = int(time.time())
+    cur.executemany(
+        """
+        INSERT INTO leadteh_contact_variables(contact_id, name, value, updated_epoch)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(contact_id, name) DO UPDATE SET value=excluded.value, updated_epoch=excluded.updated_epoch
+        """,
+        [(contact_id, name, value, now) for name, value in variables],
+    )
+
+
+def _leadteh_push_variables(client: httpx.Client, contact_id: int, variables: list[tuple[str, str]]) -> bool:
+    """Отправить контакту изменившиеся переменные по одной в порядке списка: триггеры бота срабатывают
+    на каждую. На первой ошибке останавливаемся; False — отправлено не всё."""
+    sent: list[tuple[str, str]] = []
+    ok = True
+    try:
+        for name, value in _leadteh_changed_variables(contact_id, variables):
+            if not _leadteh_set_variable_sync(client, contact_id, name, value):
+                ok = False
+                break
+            sent.append((name, value))
+    finally:
+        if sent:
+            db_call(_leadteh_remember_variables_tx, contact_id, sent)
+    return ok
 
 
 def _send_to_leadteh_sync(order_id: str) -> None:
@@ -1697,90 +3249,399 @@ def _send_to_leadteh_sync(order_id: str) -> None:
         if it.get("sku")
     )
 
-    with httpx.Client() as client:
-        phone = _normalize_phone(customer.get("phone", ""))
-        contact_id = None
-        contact_debug: Any = {}
-
-        if messenger_platform == "telegram" and telegram_id:
-            data_items = {
-                "bot_id": LEADTEH_BOT_ID,
-                "messenger": "telegram",
-                "name": customer.get("name", "") or "Клиент",
-                "email": customer.get("email", ""),
-                "telegram_id": str(telegram_id),
-                "telegram_username": telegram_username or "",
-                "address": delivery.get("pickup_point", ""),
-                "tags[]": "Оплата прошла",
-            }
-            if phone:
-                data_items["phone"] = phone
-
-            r = client.post(
-                "https://app.leadteh.ru/api/v1/createOrUpdateContact",
-                params={"api_token": LEADTEH_API_TOKEN},
-                data=data_items,
-                headers={"X-Requested-With": "XMLHttpRequest"},
-                timeout=10,
-            )
-            print("Leadteh createOrUpdate:", r.status_code, (r.text or "")[:200])
-            try:
-                data = r.json()
-            except Exception:
-                data = {}
-            contact_debug = data
-            contact_id = data.get("data", {}).get("id")
-        elif messenger_platform == "max":
-            contact_id = _leadteh_find_contact_by_phone_or_email(
-                client,
-                phone,
-                customer.get("email", ""),
-            )
-            contact_debug = {
-                "phone": phone,
-                "email": customer.get("email", ""),
-                "contact_id": contact_id,
-            }
-            print(
-                "Leadteh MAX contact lookup:",
-                contact_debug,
-            )
-        else:
-            return
+    client = http_client("leadteh")
+    phone = _normalize_phone(customer.get("phone", ""))
+    contact_id = None
+    contact_debug: Any = {}
+
+    if messenger_platform == "telegram" and telegram_id:
+        data_items = {
+            "bot_id": LEADTEH_BOT_ID,
+            "messenger": "telegram",
+            "name": customer.get("name", "") or "Клиент",
+            "email": customer.get("email", ""),
+            "telegram_id": str(telegram_id),
+            "telegram_username": telegram_username or "",
+            "address": delivery.get("pickup_point", ""),
+            "tags[]": "Оплата прошла",
+        }
+        if phone:
+            data_items["phone"] = phone
+
+        r = _leadteh_call(
+            client,
+            "POST",
+            "https://app.leadteh.ru/api/v1/createOrUpdateContact",
+            params={"api_token": LEADTEH_API_TOKEN},
+            data=data_items,
+            headers={"X-Requested-With": "XMLHttpRequest"},
+            timeout=10,
+        )
+        print("Leadteh createOrUpdate:", r.status_code, (r.text or "")[:200])
+        if not r.is_success:
+            raise RuntimeError(f"Leadteh createOrUpdateContact failed: {r.status_code}")
+        try:
+            data = r.json()
+        except Exception:
+            data = {}
+        contact_debug = data
+        contact_id = data.get("data", {}).get("id")
+    elif messenger_platform == "max":
+        contact_id = _leadteh_find_contact_by_phone_or_email(
+            client,
+            phone,
+            customer.get("email", ""),
+        )
+        contact_debug = {
+            "phone": phone,
+            "email": customer.get("email", ""),
+            "contact_id": contact_id,
+        }
+        print(
+            "Leadteh MAX contact lookup:",
+            contact_debug,
+        )
+    else:
+        return
+
+    if not contact_id:
+        # Ошибка, а не тихий выход: задача outbox повторится с backoff, контакт MAX мог ещё не появиться.
+        raise RuntimeError(f"Leadteh: no contact_id for order {order_id}: {contact_debug}")
+
+    variables = [
+        ("customer_name", customer.get("name", "")),
+        ("customer_email", customer.get("email", "")),
+        ("customer_phone", phone or customer.get("phone", "")),
+        ("customer_address", delivery.get("pickup_point", "")),
+        ("messenger_platform", messenger_platform),
+        ("messenger_user_id", messenger_user_id),
+        ("messenger_username", messenger_username or (telegram_username or "")),
+        ("order_id", order_id),
+        ("amount", str(payload.get("_amount", ""))),
+        ("items", items_text),
+        ("delivery_method", delivery.get("method", "")),
+        ("pickup_point", delivery.get("pickup_point", "")),
+        ("comment", payload.get("comment", "")),
+        ("payment_status", "success"),
+        ("payment_note", "Оплачено"),
+        ("order_created_at", str(payload.get("_created_at", ""))),
+    ]
 
+    variables = [(name, str(value or "")) for name, value in variables]
+    try:
+        ok = _leadteh_push_variables(client, int(contact_id), variables)
+    except _LeadtehContactMissing:
+        # Контакт удалён в Leadteh: убираем его из индекса, а для MAX ищем заново полным проходом.
+        db_call(_leadteh_forget_contact_tx, int(contact_id))
+        if messenger_platform != "max":
+            raise
+        contact_id = _leadteh_find_contact_by_phone_or_email(client, phone, customer.get("email", ""))
+        print("Leadteh MAX contact re-lookup:", contact_id)
         if not contact_id:
-            print("Leadteh: no contact_id in response", contact_debug)
-            return
+            raise RuntimeError(f"Leadteh: contact for order {order_id} was deleted and not found again")
+        ok = _leadteh_push_variables(client, int(contact_id), variables)
+    if not ok:
+        # Отправленное уже запомнено, при повторе уйдёт только оставшееся.
+        raise RuntimeError(f"Leadteh: not all variables were set for order {order_id}")
+
+
+# ---------------------------
+# Outbox
+# ---------------------------
+# Задачи после оплаты лежат в таблице outbox и переживают рестарт. Воркер забирает созревшие задачи,
+# держит не больше заданного числа одновременных вызовов на интеграцию и выполняет их в своём пуле
+# потоков; ошибка откладывает повтор с экспоненциальной паузой, после OUTBOX_MAX_ATTEMPTS задача — dead.
+OUTBOX_HANDLERS = {
+    "leadteh_contact": _send_to_leadteh_sync,
+    "leadteh_stock": _sync_order_stocks_to_leadteh_sync,
+    "moysklad_stock": _sync_order_stocks_to_moysklad_sync,
+}
+OUTBOX_INTEGRATIONS = {
+    "leadteh_contact": "leadteh",
+    "leadteh_stock": "leadteh",
+    "moysklad_stock": "moysklad",
+}
+OUTBOX_CONCURRENCY = {
+    "leadteh": OUTBOX_LEADTEH_CONCURRENCY,
+    "moysklad": OUTBOX_MOYSKLAD_CONCURRENCY,
+}
+OUTBOX_ORDER_PAID_KINDS = ("leadteh_contact", "leadteh_stock", "moysklad_stock")
+
+_outbox_task: Optional[asyncio.Task] = None
+_outbox_loop: Optional[asyncio.AbstractEventLoop] = None
+_outbox_wakeup: Optional[asyncio.Event] = None
+_outbox_executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+_outbox_inflight: dict[str, int] = {}
+_outbox_jobs: set[asyncio.Task] = set()
+_outbox_owner = ""
+
+
+def _enqueue_outbox_tx(cur: sqlite3.Connection, order_id: str, kinds: tuple[str, ...], now: int) -> None:
+    # UNIQUE(kind, order_id): повторный вебхук оплаты не ставит задачу второй раз.
+    cur.executemany(
+        """
+        INSERT OR IGNORE INTO outbox(kind, order_id, next_epoch, created_epoch, updated_epoch)
+        VALUES (?, ?, ?, ?, ?)
+        """,
+        [(kind, order_id, now, now, now) for kind in kinds],
+    )
+    db_after_commit(wake_outbox)
+
+
+def wake_outbox() -> None:
+    loop, wakeup = _outbox_loop, _outbox_wakeup
+    if loop is None or wakeup is None:
+        return
+    try:
+        loop.call_soon_threadsafe(wakeup.set)
+    except RuntimeError:
+        pass
+
+
+def _outbox_retry_delay(attempts: int) -> float:
+    delay = min(OUTBOX_RETRY_BASE * 2 ** max(attempts - 1, 0), OUTBOX_RETRY_MAX)
+    return delay * (0.8 + 0.4 * secrets.randbelow(1001) / 1000)
+
+
+def _requeue_expired_outbox_tx(cur: sqlite3.Connection, now: int) -> None:
+    # Аренда истекла: воркер упал или завис — задачу может забрать любой.
+    cur.execute(
+        """
+        UPDATE outbox SET status='pending', claimed_by='', next_epoch=?, updated_epoch=?
+        WHERE status='running' AND lease_until < ?
+        """,
+        (now, now, now),
+    )
+
+
+def _claim_outbox_jobs_tx(
+    cur: sqlite3.Connection,
+    now: int,
+    capacity: dict[str, int],
+    owner: str,
+) -> list[sqlite3.Row]:
+    kinds = [kind for kind, integration in OUTBOX_INTEGRATIONS.items() if capacity.get(integration, 0) > 0]
+    if not kinds:
+        return []
+    _requeue_expired_outbox_tx(cur, now)
+    placeholders = ",".join("?" for _ in kinds)
+    rows = cur.execute(
+        f"""
+        SELECT id, kind, order_id, attempts
+        FROM outbox
+        WHERE status='pending' AND next_epoch <= ? AND kind IN ({placeholders})
+        ORDER BY next_epoch, id
+        LIMIT ?
+        """,
+        (now, *kinds, sum(capacity.values())),
+    ).fetchall()
+    left = dict(capacity)
+    claimed = []
+    for row in rows:
+        integration = OUTBOX_INTEGRATIONS[row["kind"]]
+        if left.get(integration, 0) <= 0:
+            continue
+        left[integration] -= 1
+        claimed.append(row)
+    cur.executemany(
+        "UPDATE outbox SET status='running', claimed_by=?, lease_until=?, updated_epoch=? WHERE id=?",
+        [(owner, now + OUTBOX_LEASE_SECONDS, now, row["id"]) for row in claimed],
+    )
+    return claimed
+
+
+def _renew_outbox_lease_tx(cur: sqlite3.Connection, job_id: int, owner: str, now: int) -> None:
+    cur.execute(
+        "UPDATE outbox SET lease_until=? WHERE id=? AND status='running' AND claimed_by=?",
+        (now + OUTBOX_LEASE_SECONDS, job_id, owner),
+    )
+
+
+def _finish_outbox_job_tx(
+    cur: sqlite3.Connection,
+    job_id: int,
+    owner: str,
+    attempts: int,
+    error: str,
+    now: int,
+) -> None:
+    # Аренду могли потерять (истекла, задачу забрал другой воркер): тогда строку не трогаем.
+    if not error:
+        cur.execute(
+            """
+            UPDATE outbox SET status='done', claimed_by='', attempts=?, last_error='', updated_epoch=?
+            WHERE id=? AND status='running' AND claimed_by=?
+            """,
+            (attempts, now, job_id, owner),
+        )
+        return
+    if attempts >= OUTBOX_MAX_ATTEMPTS:
+        status_value, next_epoch = "dead", now
+    else:
+        status_value, next_epoch = "pending", now + int(_outbox_retry_delay(attempts))
+    cur.execute(
+        """
+        UPDATE outbox
+        SET status=?, claimed_by='', attempts=?, next_epoch=?, last_error=?, updated_epoch=?
+        WHERE id=? AND status='running' AND claimed_by=?
+        """,
+        (status_value, attempts, next_epoch, error[:1000], now, job_id, owner),
+    )
+
+
+def _recover_outbox_tx(cur: sqlite3.Connection, now: int) -> None:
+    # running с живой арендой может выполнять другой воркер: в очередь возвращаем только истёкшие.
+    _requeue_expired_outbox_tx(cur, now)
+    cur.execute("DELETE FROM outbox WHERE status='done' AND updated_epoch < ?", (now - OUTBOX_DONE_RETENTION,))
+
+
+def _outbox_next_due(kinds: list[str]) -> Optional[int]:
+    if not kinds:
+        return None
+    placeholders = ",".join("?" for _ in kinds)
+    with db_read() as con:
+        # Для running сроком считается конец аренды: после него задачу можно забрать заново.
+        row = con.execute(
+            f"""
+            SELECT MIN(CASE status WHEN 'pending' THEN next_epoch ELSE lease_until END) AS due
+            FROM outbox
+            WHERE status IN ('pending', 'running') AND kind IN ({placeholders})
+            """,
+            kinds,
+        ).fetchone()
+    return None if row is None or row["due"] is None else int(row["due"])
+
+
+async def _run_outbox_job(job: sqlite3.Row) -> None:
+    integration = OUTBOX_INTEGRATIONS[job["kind"]]
+    attempts = int(job["attempts"]) + 1
+    error = ""
+    owner = _outbox_owner
+    try:
+        handler = asyncio.get_running_loop().run_in_executor(_outbox_executor, OUTBOX_HANDLERS[job["kind"]], job["order_id"])
+        # Пока обработчик работает, продлеваем аренду, чтобы другой воркер не счёл задачу брошенной.
+        while not (await asyncio.wait({handler}, timeout=OUTBOX_LEASE_SECONDS / 3))[0]:
+            try:
+                await db_call_async(_renew_outbox_lease_tx, job["id"], owner, int(time.time()))
+            except Exception as e:
+                print("Outbox lease renew error:", job["kind"], job["order_id"], repr(e))
+        handler.result()
+    except Exception as e:
+        error = repr(e)
+        print("Outbox job failed:", job["kind"], job["order_id"], "attempt", attempts, error)
+    try:
+        await db_call_async(_finish_outbox_job_tx, job["id"], owner, attempts, error, int(time.time()))
+    finally:
+        _outbox_inflight[integration] -= 1
+        _outbox_wakeup.set()
+
+
+async def _outbox_worker() -> None:
+    while True:
+        _outbox_wakeup.clear()
+        capacity = {
+            integration: max(limit - _outbox_inflight.get(integration, 0), 0)
+            for integration, limit in OUTBOX_CONCURRENCY.items()
+        }
+        # Срок смотрим только у видов со свободными слотами: созревшие задачи упёршейся в лимит интеграции
+        # ждут _outbox_wakeup от завершившейся задачи, а не гоняют claim-транзакции по кругу.
+        free_kinds = [kind for kind, integration in OUTBOX_INTEGRATIONS.items() if capacity.get(integration, 0) > 0]
+        try:
+            jobs = await db_call_async(_claim_outbox_jobs_tx, int(time.time()), capacity, _outbox_owner)
+            due = await asyncio.to_thread(_outbox_next_due, free_kinds)
+        except Exception as e:
+            print("Outbox worker error:", repr(e))
+            await asyncio.sleep(5)
+            continue
+        for job in jobs:
+            integration = OUTBOX_INTEGRATIONS[job["kind"]]
+            _outbox_inflight[integration] = _outbox_inflight.get(integration, 0) + 1
+            task = asyncio.create_task(_run_outbox_job(job))
+            _outbox_jobs.add(task)
+            task.add_done_callback(_outbox_jobs.discard)
+        if jobs:
+            continue
+
+        delay = OUTBOX_POLL_MAX_INTERVAL
+        if due is not None:
+            delay = min(delay, max(due - time.time(), 0.0))
+        try:
+            await asyncio.wait_for(_outbox_wakeup.wait(), timeout=max(delay, 0.05))
+        except asyncio.TimeoutError:
+            pass
 
-        variables = [
-            ("customer_name", customer.get("name", "")),
-            ("customer_email", customer.get("email", "")),
-            ("customer_phone", phone or customer.get("phone", "")),
-            ("customer_address", delivery.get("pickup_point", "")),
-            ("messenger_platform", messenger_platform),
-            ("messenger_user_id", messenger_user_id),
-            ("messenger_username", messenger_username or (telegram_username or "")),
-            ("order_id", order_id),
-            ("amount", str(payload.get("_amount", ""))),
-            ("items", items_text),
-            ("delivery_method", delivery.get("method", "")),
-            ("pickup_point", delivery.get("pickup_point", "")),
-            ("comment", payload.get("comment", "")),
-            ("payment_status", "success"),
-            ("payment_note", "Оплачено"),
-            ("order_created_at", str(payload.get("_created_at", ""))),
-        ]
 
-        for name, value in variables:
-            _leadteh_set_variable_sync(client, contact_id, name, value or "")
-            time.sleep(0.6)
+async def start_outbox() -> None:
+    global _outbox_task, _outbox_loop, _outbox_wakeup, _outbox_executor, _outbox_owner
+    if _outbox_task is not None:
+        return
+    _outbox_owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+    await db_call_async(_recover_outbox_tx, int(time.time()))
+    _outbox_loop = asyncio.get_running_loop()
+    _outbox_wakeup = asyncio.Event()
+    _outbox_executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(OUTBOX_WORKERS, 1), thread_name_prefix="outbox")
+    _outbox_inflight.clear()
+    _outbox_task = asyncio.create_task(_outbox_worker())
+
+
+async def stop_outbox() -> None:
+    global _outbox_task, _outbox_loop, _outbox_wakeup, _outbox_executor
+    task, _outbox_task = _outbox_task, None
+    if task is not None:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+    # Идущим задачам даём дописать результат, остальные останутся pending. Не успевшие за
+    # OUTBOX_SHUTDOWN_TIMEOUT остаются running и возвращаются в очередь, когда истечёт их аренда.
+    if _outbox_jobs:
+        running = list(_outbox_jobs)
+        try:
+            await asyncio.wait_for(asyncio.gather(*running, return_exceptions=True), OUTBOX_SHUTDOWN_TIMEOUT)
+        except asyncio.TimeoutError:
+            print("Outbox: jobs still running at shutdown:", sum(1 for task in running if task.cancelled()))
+    _outbox_loop = None
+    _outbox_wakeup = None
+    executor, _outbox_executor = _outbox_executor, None
+    if executor is not None:
+        executor.shutdown(wait=False)
+
+
+def outbox_stats() -> dict:
+    now = int(time.time())
+    with db_read() as con:
+        counts = con.execute("SELECT kind, status, COUNT(*) AS n FROM outbox GROUP BY kind, status").fetchall()
+        oldest = con.execute("SELECT MIN(created_epoch) AS oldest FROM outbox WHERE status IN ('pending', 'running')").fetchone()
+        dead = con.execute(
+            """
+            SELECT id, kind, order_id, attempts, last_error, updated_epoch
+            FROM outbox
+            WHERE status='dead'
+            ORDER BY updated_epoch DESC
+            LIMIT 50
+            """
+        ).fetchall()
+    by_kind: dict[str, dict[str, int]] = {}
+    for row in counts:
+        by_kind.setdefault(row["kind"], {})[row["status"]] = int(row["n"])
+    return {
+        "depth": sum(n for statuses in by_kind.values() for st, n in statuses.items() if st in ("pending", "running")),
+        "oldest_pending_age": now - int(oldest["oldest"]) if oldest and oldest["oldest"] is not None else None,
+        "kinds": by_kind,
+        "inflight": dict(_outbox_inflight),
+        "dead": [dict(row) for row in dead],
+    }
 
 
-async def send_to_leadteh(order_id: str) -> None:
-    try:
-        await asyncio.to_thread(_send_to_leadteh_sync, order_id)
-    except Exception as e:
-        print("Leadteh error:", repr(e))
+def _retry_outbox_job_tx(cur: sqlite3.Connection, job_id: int, now: int) -> bool:
+    retried = cur.execute(
+        "UPDATE outbox SET status='pending', attempts=0, next_epoch=?, updated_epoch=? WHERE id=? AND status='dead'",
+        (now, now, job_id),
+    ).rowcount
+    if retried:
+        db_after_commit(wake_outbox)
+    return bool(retried)
 
 
 # ---------------------------
@@ -1889,8 +3750,7 @@ async def _prodamus_link_seems_valid(url: str) -> bool:
     if not url:
         return False
     try:
-        async with httpx.AsyncClient(timeout=PRODAMUS_AUTO_SIGN_TIMEOUT, follow_redirects=False) as client:
-            r = await client.get(url)
+        r = await http_async_client("prodamus").get(url, timeout=PRODAMUS_AUTO_SIGN_TIMEOUT)
     except Exception as exc:
         print("Prodamus validate error:", repr(exc))
         return False
@@ -1967,7 +3827,11 @@ def unflatten_brackets(flat: dict) -> dict:
 # FastAPI app
 # ---------------------------
 app = FastAPI(title="MiniApp Shop Backend")
-init_db()
+# Процессы пула картинок (spawn) импортируют этот модуль ради _render_image_variants: базу они не трогают,
+# иначе каждый гонял бы миграции, seed и загрузку индекса остатков (а с другим DATA_DIR создал бы свою app.db).
+# _inheriting выставлен, пока дочерний процесс заново импортирует __main__ родителя, parent_process() — после.
+if multiprocessing.parent_process() is None and not getattr(multiprocessing.current_process(), "_inheriting", False):
+    init_db()
 security = HTTPBasic()
 
 
@@ -1996,27 +3860,351 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Catalog-Seq"],
 )
 
 
+# ---------------------------
+# HTTP caching
+# ---------------------------
+# Данные витрины меняются в любой момент: клиент хранит копию, но каждый раз сверяет ETag.
+REVALIDATE_CACHE_CONTROL = "no-cache"
+# Картинки по одному адресу не меняются (у МойСклад свой href на файл), но старые загрузки
+# именовались uuid и могли быть перезаписаны вручную — им час.
+IMAGE_CACHE_CONTROL = "public, max-age=3600"
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+def _content_etag(body: bytes) -> str:
+    return '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+
+
+def _file_etag(st: os.stat_result) -> str:
+    return f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in header.split(","))
+
+
+def _not_modified(request: Request, etag: str, cache_control: str) -> Optional[Response]:
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": cache_control})
+    return None
+
+
+def _compress(data: bytes, coding: str, cached: bool = False) -> bytes:
+    # Закэшированное тело сжимается один раз на версию, поэтому можно сжимать сильнее.
+    if coding == "br":
+        return brotli.compress(data, quality=9 if cached else 5)
+    return gzip.compress(data, compresslevel=9 if cached else 6, mtime=0)
+
+
+def _negotiate_encoding(accept_encoding: str, size: int) -> Optional[str]:
+    if size < JSON_COMPRESS_MIN_BYTES:
+        return None
+    accepted = _accepted_encodings(accept_encoding)
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+
+class CompressedBody:
+    """Готовое тело ответа с ETag; сжатые варианты считаются при первом запросе и живут вместе с телом."""
+
+    __slots__ = ("body", "etag", "_encoded", "_lock")
+
+    def __init__(self, body: bytes):
+        self.body = body
+        self.etag = _content_etag(body)
+        self._encoded: dict[str, bytes] = {}
+        self._lock = threading.Lock()
+
+    def encoded(self, coding: str) -> bytes:
+        data = self._encoded.get(coding)
+        if data is None:
+            with self._lock:
+                data = self._encoded.get(coding)
+                if data is None:
+                    data = _compress(self.body, coding, cached=True)
+                    self._encoded[coding] = data
+        return data
+
+
+def _cached_json_response(request: Request, rendered: CompressedBody) -> Response:
+    coding = _negotiate_encoding(request.headers.get("accept-encoding", ""), len(rendered.body))
+    # У каждого кодирования свой ETag: байты разные, а кэши между клиентом и нами сверяют их побайтно.
+    etag = rendered.etag if coding is None else f'{rendered.etag[:-1]}-{coding}"'
+    headers = {"ETag": etag, "Cache-Control": REVALIDATE_CACHE_CONTROL, "Vary": "Accept-Encoding"}
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    if coding is None:
+        return Response(content=rendered.body, media_type="application/json", headers=headers)
+    headers["Content-Encoding"] = coding
+    return Response(content=rendered.encoded(coding), media_type="application/json", headers=headers)
+
+
+class JSONCompressionMiddleware:
+    """Сжимает JSON-ответы, которые маршрут не сжал сам (тела из кэша приходят уже сжатыми)."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        accept_encoding = Headers(scope=scope).get("accept-encoding", "")
+        if not accept_encoding:
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+        chunks: list[bytes] = []
+
+        async def send_wrapper(message):
+            nonlocal start_message
+            if message["type"] == "http.response.start":
+                headers = Headers(raw=message["headers"])
+                content_type = headers.get("content-type", "")
+                if content_type.startswith("application/json") and "content-encoding" not in headers:
+                    start_message = message
+                    return
+                await send(message)
+                return
+            if message["type"] != "http.response.body" or start_message is None:
+                await send(message)
+                return
+            chunks.append(message.get("body", b""))
+            if message.get("more_body", False):
+                return
+            body = b"".join(chunks)
+            coding = _negotiate_encoding(accept_encoding, len(body))
+            headers = MutableHeaders(raw=start_message["headers"])
+            if coding is not None:
+                body = _compress(body, coding)
+                headers["Content-Encoding"] = coding
+                headers["Content-Length"] = str(len(body))
+                headers.add_vary_header("Accept-Encoding")
+            await send(start_message)
+            await send({"type": "http.response.body", "body": body})
+
+        await self.app(scope, receive, send_wrapper)
+
+
+app.add_middleware(JSONCompressionMiddleware)
+
+
+# Маршруты с загрузкой файла и запас на заголовки частей multipart сверх PRODUCT_UPLOAD_MAX_BYTES.
+_UPLOAD_PATHS = frozenset({"/api/products/image"})
+_UPLOAD_MULTIPART_OVERHEAD = 64 * 1024
+
+
+class UploadSizeLimitMiddleware:
+    """Ограничивает тело загрузки до разбора multipart: иначе Starlette успевает выложить на диск файл любого
+    размера, а UploadFile.size известен только после этого."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in _UPLOAD_PATHS:
+            await self.app(scope, receive, send)
+            return
+        limit = PRODUCT_UPLOAD_MAX_BYTES + _UPLOAD_MULTIPART_OVERHEAD
+        try:
+            declared = int(Headers(scope=scope).get("content-length") or 0)
+        except ValueError:
+            declared = 0
+        if declared > limit:
+            error = _upload_too_large()
+            await JSONResponse({"detail": error.detail}, status_code=error.status_code)(scope, receive, send)
+            return
+
+        # Без Content-Length (chunked) считаем байты по мере чтения; FastAPI пробрасывает HTTPException из разбора тела.
+        received = 0
+
+        async def receive_limited():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    raise _upload_too_large()
+            return message
+
+        await self.app(scope, receive_limited, send)
+
+
+app.add_middleware(UploadSizeLimitMiddleware)
+
+
+def _accepted_encodings(header: str) -> set[str]:
+    accepted = set()
+    for part in (header or "").split(","):
+        coding, _, params = part.strip().partition(";")
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                if float(q[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        if coding:
+            accepted.add(coding.strip().lower())
+    return accepted
+
+
+# ---------------------------
+# Frontend static files
+# ---------------------------
+# Сборка Vite не меняется после старта, поэтому .br/.gz рядом с файлами строятся один раз при запуске,
+# а ответ выбирается по Accept-Encoding без сжатия на лету. Файлы в assets/ содержат хэш в имени
+# и кэшируются навсегда; index.html и прочее клиент перепроверяет по ETag.
+STATIC_PRECOMPRESS_EXTENSIONS = (".html", ".js", ".mjs", ".css", ".svg", ".json", ".txt", ".map", ".webmanifest", ".ico")
+STATIC_PRECOMPRESS_MIN_BYTES = 1024
+
+
+def _precompress_file(path: str, st: os.stat_result) -> dict[str, str]:
+    with open(path, "rb") as f:
+        data = f.read()
+    encoders = {"gzip": (".gz", lambda raw: gzip.compress(raw, compresslevel=9, mtime=0))}
+    if brotli is not None:
+        encoders["br"] = (".br", lambda raw: brotli.compress(raw, quality=11))
+    variants = {}
+    for coding, (suffix, compress) in encoders.items():
+        target = path + suffix
+        try:
+            fresh = os.stat(target).st_mtime_ns >= st.st_mtime_ns
+        except OSError:
+            fresh = False
+        if not fresh:
+            packed = compress(data)
+            if len(packed) >= len(data):
+                continue
+            tmp = f"{target}.{uuid.uuid4().hex}.tmp"
+            with open(tmp, "wb") as out:
+                out.write(packed)
+            os.replace(tmp, target)
+        variants[coding] = target
+    return variants
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # абсолютный путь файла -> {"br": путь, "gzip": путь}
+        self.precompressed: dict[str, dict[str, str]] = {}
+
+    def precompress(self) -> None:
+        found = {}
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.lower().endswith(STATIC_PRECOMPRESS_EXTENSIONS):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                    if st.st_size < STATIC_PRECOMPRESS_MIN_BYTES:
+                        continue
+                    variants = _precompress_file(path, st)
+                except OSError as e:
+                    # Каталог сборки может быть только для чтения — тогда отдаём несжатое.
+                    print("Static precompress error:", path, repr(e))
+                    continue
+                if variants:
+                    found[os.path.realpath(path)] = variants
+        self.precompressed = found
+
+    def file_response(self, full_path, stat_result: os.stat_result, scope, status_code: int = 200) -> Response:
+        request_headers = Headers(scope=scope)
+        real_path = os.path.realpath(full_path)
+        relative = os.path.relpath(real_path, os.path.realpath(self.directory)).replace(os.sep, "/")
+        headers = {
+            "Cache-Control": IMMUTABLE_CACHE_CONTROL if relative.startswith("assets/") else REVALIDATE_CACHE_CONTROL,
+        }
+        path, media_type = full_path, None
+        variants = self.precompressed.get(real_path)
+        if variants:
+            headers["Vary"] = "Accept-Encoding"
+            accepted = _accepted_encodings(request_headers.get("accept-encoding", ""))
+            for coding in ("br", "gzip"):
+                if coding in variants and coding in accepted:
+                    try:
+                        stat_result = os.stat(variants[coding])
+                    except OSError:
+                        continue
+                    path = variants[coding]
+                    media_type = mimetypes.guess_type(str(full_path))[0] or "application/octet-stream"
+                    headers["Content-Encoding"] = coding
+                    break
+
+        response = FileResponse(path, status_code=status_code, stat_result=stat_result, media_type=media_type, headers=headers)
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
+
+
+_frontend_static: Optional[PrecompressedStaticFiles] = None
+
+
 @app.middleware("http")
-async def disable_client_cache(request: Request, call_next):
+async def default_cache_policy(request: Request, call_next):
     response = await call_next(request)
-    response.headers["Cache-Control"] = "no-store, no-cache, must-revalidate, max-age=0"
-    response.headers["Pragma"] = "no-cache"
-    response.headers["Expires"] = "0"
+    # Маршрут, выставивший свою политику, её сохраняет; остальное браузеру кэшировать нельзя.
+    if "cache-control" not in response.headers:
+        response.headers["Cache-Control"] = "no-store, no-cache, must-revalidate, max-age=0"
+        response.headers["Pragma"] = "no-cache"
+        response.headers["Expires"] = "0"
     return response
 
 
 @app.on_event("startup")
 def _startup():
     init_db()
+    open_http_clients()
+    load_moysklad_image_cache()
+    threading.Thread(target=backfill_upload_image_variants, name="image-variants-backfill", daemon=True).start()
+    if _frontend_static is not None:
+        threading.Thread(target=_frontend_static.precompress, name="static-precompress", daemon=True).start()
+
+
+@app.on_event("startup")
+async def _start_background_tasks():
+    await start_stock_stream()
+    await start_reservation_sweeper()
+    await start_leadteh_contacts_refresh()
+    await start_outbox()
+
+
+@app.on_event("shutdown")
+async def _stop_background_tasks():
+    await stop_outbox()
+    await stop_leadteh_contacts_refresh()
+    await stop_reservation_sweeper()
+    stop_stock_stream()
+    cancel_image_downloads()
+    await close_http_clients()
+    stop_image_variant_pool()
+
+
+@app.on_event("shutdown")
+def _shutdown():
+    stop_db_writer()
+    close_db_connections()
 
 
 @app.get("/")
-def root():
-    if os.path.isfile(FRONTEND_INDEX_PATH):
-        return FileResponse(FRONTEND_INDEX_PATH)
+def root(request: Request):
+    if _frontend_static is not None and os.path.isfile(FRONTEND_INDEX_PATH):
+        return _frontend_static.file_response(FRONTEND_INDEX_PATH, os.stat(FRONTEND_INDEX_PATH), request.scope)
     return {"ok": True, "hint": "Use /docs or /health"}
 
 
@@ -2025,37 +4213,674 @@ def health():
     return {"status": "ok"}
 
 
+# ---------------------------
+# Image variants
+# ---------------------------
+# Уменьшенные копии картинок товара: <stem>_w{ширина}.webp и .jpg рядом с исходником и манифест
+# <stem>.variants.json. Ресайз идёт в пуле процессов, чтобы не занимать event loop и GIL.
+# Без Pillow варианты не строятся и витрина получает только исходные картинки.
+IMAGE_VARIANT_FORMATS = {"webp": "image/webp", "jpg": "image/jpeg"}
+IMAGE_VARIANT_OPTIONS = {
+    "webp": {"format": "WEBP", "quality": IMAGE_WEBP_QUALITY, "method": 4},
+    "jpg": {"format": "JPEG", "quality": IMAGE_JPEG_QUALITY, "optimize": True, "progressive": True},
+}
+# Версия настроек кодирования входит в имя файла варианта: загрузки с хешем в имени отдаются как immutable,
+# и другие байты под тем же URL клиент бы уже не перезапросил.
+IMAGE_VARIANT_VERSION = hashlib.sha256(json.dumps(IMAGE_VARIANT_OPTIONS, sort_keys=True).encode("utf-8")).hexdigest()[:8]
+_image_variant_pool: Optional[concurrent.futures.ProcessPoolExecutor] = None
+_image_variant_pool_lock = threading.Lock()
+
+
+def image_variants_enabled() -> bool:
+    return Image is not None and bool(PRODUCT_IMAGE_WIDTHS)
+
+
+def _image_variant_name(stem: str, width: int, ext: str, version: Optional[str] = IMAGE_VARIANT_VERSION) -> str:
+    # version=None — имена до появления версии.
+    return f"{stem}_w{width}_{version}.{ext}" if version else f"{stem}_w{width}.{ext}"
+
+
+def _read_variant_manifest(directory: str, stem: str) -> Optional[dict]:
+    try:
+        with open(_image_variant_manifest_path(directory, stem), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _image_variant_manifest_path(directory: str, stem: str) -> str:
+    return os.path.join(directory, f"{stem}.variants.json")
+
+
+def _render_image_variants(
+    src_path: str,
+    directory: str,
+    stem: str,
+    widths: list[int],
+    options: dict[str, dict],
+    version: str,
+) -> int:
+    """Выполняется в процессе пула. Возвращает суммарный размер записанных файлов."""
+    previous = _read_variant_manifest(directory, stem)
+    with Image.open(src_path) as src:
+        src = ImageOps.exif_transpose(src)
+        has_alpha = src.mode in ("RGBA", "LA") or (src.mode == "P" and "transparency" in src.info)
+        base = src.convert("RGBA" if has_alpha else "RGB")
+
+    written = 0
+    rendered = []
+    for width in sorted(set(widths)):
+        # Не увеличиваем: узкий исходник просто перекодируется в своём размере.
+        target = min(width, base.width)
+        height = max(1, round(base.height * target / base.width))
+        img = base if target == base.width else base.resize((target, height), Image.LANCZOS)
+        flat = img
+        if has_alpha:
+            flat = Image.new("RGB", img.size, (255, 255, 255))
+            flat.paste(img, mask=img.getchannel("A"))
+        for ext, image in (("webp", img), ("jpg", flat)):
+            path = os.path.join(directory, _image_variant_name(stem, width, ext, version))
+            tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+            image.save(tmp, **options[ext])
+            os.replace(tmp, path)
+            written += os.path.getsize(path)
+        rendered.append({"width": width, "actualWidth": target})
+
+    manifest_path = _image_variant_manifest_path(directory, stem)
+    tmp = f"{manifest_path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"source": os.path.basename(src_path), "version": version, "variants": rendered}, f)
+    os.replace(tmp, manifest_path)
+
+    # Файлы прежней версии настроек больше не нужны.
+    if previous and previous.get("version") != version:
+        for v in previous.get("variants") or []:
+            for ext in IMAGE_VARIANT_FORMATS:
+                try:
+                    os.remove(os.path.join(directory, _image_variant_name(stem, int(v["width"]), ext, previous.get("version"))))
+                except (OSError, KeyError, ValueError):
+                    pass
+    return written
+
+
+def _image_pool() -> concurrent.futures.ProcessPoolExecutor:
+    global _image_variant_pool
+    with _image_variant_pool_lock:
+        if _image_variant_pool is None:
+            # spawn: дочерние процессы не наследуют потоки и блокировки приложения.
+            _image_variant_pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=max(IMAGE_VARIANT_WORKERS, 1),
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _image_variant_pool
+
+
+def submit_image_variants(src_path: str, directory: str, stem: str) -> concurrent.futures.Future:
+    return _image_pool().submit(
+        _render_image_variants,
+        src_path,
+        directory,
+        stem,
+        PRODUCT_IMAGE_WIDTHS,
+        IMAGE_VARIANT_OPTIONS,
+        IMAGE_VARIANT_VERSION,
+    )
+
+
+def stop_image_variant_pool() -> None:
+    global _image_variant_pool
+    with _image_variant_pool_lock:
+        pool, _image_variant_pool = _image_variant_pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+async def render_product_image_variants(filename: str) -> list[dict]:
+    if not image_variants_enabled():
+        return []
+    stem = os.path.splitext(filename)[0]
+    try:
+        await asyncio.wrap_future(submit_image_variants(os.path.join(PRODUCT_UPLOADS_DIR, filename), PRODUCT_UPLOADS_DIR, stem))
+    except Exception as e:
+        # Битая или неподдерживаемая картинка остаётся без вариантов, исходник всё равно доступен.
+        print("Image variants error:", filename, repr(e))
+        return []
+    return _upload_image_variants(filename)
+
+
+def _rendered_image_variants(directory: str, stem: str) -> list[tuple[int, int]]:
+    """Готовые варианты из манифеста: (запрошенная ширина, фактическая). Узкий исходник даёт несколько
+    одинаковых по ширине файлов — в srcset идёт один, иначе дескрипторы Nw повторятся."""
+    manifest = _read_variant_manifest(directory, stem)
+    if not manifest or manifest.get("version") != IMAGE_VARIANT_VERSION:
+        # Варианты под прежние настройки будут пересобраны.
+        return []
+    seen = set()
+    out = []
+    for v in sorted(manifest.get("variants") or [], key=lambda v: int(v["width"])):
+        actual = int(v["actualWidth"])
+        if actual in seen:
+            continue
+        seen.add(actual)
+        out.append((int(v["width"]), actual))
+    return out
+
+
+def _upload_image_variants(filename: str) -> list[dict]:
+    stem = os.path.splitext(filename)[0]
+    return [
+        {
+            "width": actual,
+            **{ext: _product_upload_public_url(_image_variant_name(stem, width, ext)) for ext in IMAGE_VARIANT_FORMATS},
+        }
+        for width, actual in _rendered_image_variants(PRODUCT_UPLOADS_DIR, stem)
+    ]
+
+
+def _image_variant_source(image_url: str) -> Optional[tuple[str, str]]:
+    """(каталог, stem) файлов вариантов для imageUrl карточки."""
+    parsed = urlparse(_normalize_storefront_asset_url(image_url))
+    if parsed.path.startswith("/uploads/products/"):
+        return PRODUCT_UPLOADS_DIR, os.path.splitext(os.path.basename(parsed.path))[0]
+    if parsed.path.startswith("/api/moysklad/image"):
+        href = dict(parse_qsl(parsed.query)).get("href") or ""
+        if href:
+            return MOYSKLAD_IMAGE_CACHE_DIR, _image_cache_key(href)
+    return None
+
+
+def _touch_catalog_images_tx(cur: sqlite3.Connection, directory: str, stems: list[str]) -> None:
+    # Набор вариантов картинки изменился: image_rev продвигает change_seq строки, и клиенты с
+    # локальным каталогом получат новые imageVariants через ?since=.
+    wanted = {(directory, stem) for stem in stems}
+    skus = [
+        row["sku"]
+        for row in cur.execute("SELECT sku, image_url FROM inventory WHERE image_url <> ''")
+        if _image_variant_source(row["image_url"]) in wanted
+    ]
+    if not skus:
+        return
+    cur.executemany("UPDATE inventory SET image_rev = image_rev + 1 WHERE sku=?", [(sku,) for sku in skus])
+    invalidate_catalog_snapshot()
+
+
+def touch_catalog_images(directory: str, stems: list[str]) -> None:
+    """Не ждёт записи: вызывается и из event loop, и из потоков пула."""
+    if not stems:
+        return
+
+    def done(f: concurrent.futures.Future) -> None:
+        if f.exception() is not None:
+            print("Catalog image touch error:", repr(f.exception()))
+
+    db_submit(_touch_catalog_images_tx, directory, list(stems)).add_done_callback(done)
+
+
+def image_variants_for_url(image_url: str) -> list[dict]:
+    """Варианты для imageUrl карточки в том же виде, в каком витрина получает сам imageUrl."""
+    if not image_url or not image_variants_enabled():
+        return []
+    parsed = urlparse(image_url)
+    if parsed.path.startswith("/uploads/products/"):
+        return _upload_image_variants(os.path.basename(parsed.path))
+    if parsed.path.startswith("/api/moysklad/image") and MOYSKLAD_IMAGE_CACHE_MAX_BYTES > 0:
+        # Только уже построенные варианты картинки из кэша: до этого витрина показывает исходник.
+        href = dict(parse_qsl(parsed.query)).get("href") or ""
+        if not href:
+            return []
+        key = _image_cache_key(href)
+        rendered = _rendered_image_variants(MOYSKLAD_IMAGE_CACHE_DIR, key)
+        if not rendered:
+            _image_cache_render_variants(key)
+        return [
+            {
+                "width": actual,
+                **{ext: f"{parsed.path}?{urlencode({'href': href, 'w': width, 'ext': ext})}" for ext in IMAGE_VARIANT_FORMATS},
+            }
+            for width, actual in rendered
+        ]
+    return []
+
+
+def backfill_upload_image_variants() -> None:
+    """Достроить варианты для загрузок, сделанных до появления пайплайна."""
+    if not image_variants_enabled() or not os.path.isdir(PRODUCT_UPLOADS_DIR):
+        return
+    futures = []
+    for entry in os.scandir(PRODUCT_UPLOADS_DIR):
+        stem, ext = os.path.splitext(entry.name)
+        if ext.lower() not in (".jpg", ".jpeg", ".png", ".webp") or "_w" in stem or not entry.is_file():
+            continue
+        manifest = _read_variant_manifest(PRODUCT_UPLOADS_DIR, stem)
+        if manifest and manifest.get("version") == IMAGE_VARIANT_VERSION:
+            continue
+        futures.append((stem, submit_image_variants(entry.path, PRODUCT_UPLOADS_DIR, stem)))
+    rendered = []
+    for stem, future in futures:
+        try:
+            future.result()
+        except Exception as e:
+            print("Image variants error:", stem, repr(e))
+        else:
+            rendered.append(stem)
+    touch_catalog_images(PRODUCT_UPLOADS_DIR, rendered)
+
+
+# ---------------------------
+# MoySklad image cache
+# ---------------------------
+# Картинка лежит в <sha256(href)>, рядом <sha256(href)>.json с типом и размером. Метаданные пишутся
+# последними, поэтому файл без .json — недокачанный мусор. Порядок LRU — в памяти, а mtime файла
+# обновляется при каждом попадании, чтобы после рестарта порядок восстановился по диску.
+_image_cache_lock = threading.Lock()
+_image_cache_entries: "OrderedDict[str, int]" = OrderedDict()
+# Часть размера записи, приходящаяся на варианты: при перезаписи исходника и пересборке вариантов
+# каждая часть заменяется своей, а не добавляется поверх.
+_image_cache_variant_bytes: dict[str, int] = {}
+_image_cache_bytes = 0
+
+
+def _image_cache_key(href: str) -> str:
+    return hashlib.sha256(href.encode("utf-8")).hexdigest()
+
+
+def _image_cache_paths(key: str) -> tuple[str, str]:
+    path = os.path.join(MOYSKLAD_IMAGE_CACHE_DIR, key)
+    return path, path + ".json"
+
+
+def load_moysklad_image_cache() -> None:
+    global _image_cache_bytes
+    if MOYSKLAD_IMAGE_CACHE_MAX_BYTES <= 0:
+        return
+    os.makedirs(MOYSKLAD_IMAGE_CACHE_DIR, exist_ok=True)
+    found = []
+    variant_sizes: dict[str, int] = {}
+    for entry in os.scandir(MOYSKLAD_IMAGE_CACHE_DIR):
+        name = entry.name
+        if name.endswith(".json") or not entry.is_file():
+            continue
+        if name.endswith(".tmp"):
+            _image_cache_remove_path(entry.path)
+            continue
+        if "_w" in name:
+            # Вариант картинки учитывается в размере её записи.
+            key = name.split("_w", 1)[0]
+            variant_sizes[key] = variant_sizes.get(key, 0) + entry.stat().st_size
+            continue
+        if not os.path.isfile(entry.path + ".json"):
+            # Запись прервалась до метаданных.
+            _image_cache_remove_files(name)
+            continue
+        st = entry.stat()
+        found.append((st.st_mtime, name, st.st_size))
+    found.sort()
+    with _image_cache_lock:
+        _image_cache_entries.clear()
+        _image_cache_variant_bytes.clear()
+        _image_cache_bytes = 0
+        for _, name, size in found:
+            variants = variant_sizes.pop(name, 0)
+            if variants:
+                _image_cache_variant_bytes[name] = variants
+            _image_cache_entries[name] = size + variants
+            _image_cache_bytes += size + variants
+    for key in variant_sizes:
+        # Варианты без исходника.
+        _image_cache_remove_files(key)
+    _image_cache_evict()
+
+
+def _image_cache_remove_path(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _image_cache_remove_files(key: str) -> None:
+    manifest = _read_variant_manifest(MOYSKLAD_IMAGE_CACHE_DIR, key) or {}
+    names = {_image_variant_name(key, width, ext) for width in PRODUCT_IMAGE_WIDTHS for ext in IMAGE_VARIANT_FORMATS}
+    for v in manifest.get("variants") or []:
+        for ext in IMAGE_VARIANT_FORMATS:
+            names.add(_image_variant_name(key, int(v["width"]), ext, manifest.get("version")))
+    for path in _image_cache_paths(key):
+        _image_cache_remove_path(path)
+    _image_cache_remove_path(_image_variant_manifest_path(MOYSKLAD_IMAGE_CACHE_DIR, key))
+    for name in names:
+        _image_cache_remove_path(os.path.join(MOYSKLAD_IMAGE_CACHE_DIR, name))
+
+
+def _image_cache_evict() -> None:
+    global _image_cache_bytes
+    victims = []
+    with _image_cache_lock:
+        while _image_cache_bytes > MOYSKLAD_IMAGE_CACHE_MAX_BYTES and _image_cache_entries:
+            key, size = _image_cache_entries.popitem(last=False)
+            _image_cache_variant_bytes.pop(key, None)
+            _image_cache_bytes -= size
+            victims.append(key)
+    for key in victims:
+        _image_cache_remove_files(key)
+    touch_catalog_images(MOYSKLAD_IMAGE_CACHE_DIR, victims)
+
+
+def _image_cache_get(href: str) -> Optional[tuple[str, os.stat_result, dict]]:
+    """Путь к закэшированной картинке, её stat и метаданные; None при промахе."""
+    if MOYSKLAD_IMAGE_CACHE_MAX_BYTES <= 0:
+        return None
+    key = _image_cache_key(href)
+    with _image_cache_lock:
+        if key not in _image_cache_entries:
+            return None
+        _image_cache_entries.move_to_end(key)
+    path, meta_path = _image_cache_paths(key)
+    try:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        os.utime(path)
+        st = os.stat(path)
+    except (OSError, ValueError):
+        _image_cache_forget(key)
+        return None
+    if meta.get("href") != href or st.st_size != meta.get("size"):
+        _image_cache_forget(key)
+        return None
+    return path, st, meta
+
+
+_image_variant_jobs: set = set()
+
+
+def _image_cache_render_variants(key: str) -> None:
+    """Поставить в пул построение вариантов для записи кэша, если их ещё нет и они не строятся."""
+    if not image_variants_enabled():
+        return
+    with _image_cache_lock:
+        if key in _image_variant_jobs or key not in _image_cache_entries:
+            return
+        _image_variant_jobs.add(key)
+    path, _ = _image_cache_paths(key)
+    try:
+        future = submit_image_variants(path, MOYSKLAD_IMAGE_CACHE_DIR, key)
+    except RuntimeError:
+        # Пул уже остановлен.
+        with _image_cache_lock:
+            _image_variant_jobs.discard(key)
+        return
+
+    def done(f: concurrent.futures.Future) -> None:
+        global _image_cache_bytes
+        with _image_cache_lock:
+            _image_variant_jobs.discard(key)
+            if f.cancelled() or f.exception() is not None or key not in _image_cache_entries:
+                written = 0
+            else:
+                written = f.result()
+                delta = written - _image_cache_variant_bytes.get(key, 0)
+                _image_cache_variant_bytes[key] = written
+                _image_cache_entries[key] += delta
+                _image_cache_bytes += delta
+        if f.cancelled():
+            return
+        if f.exception() is not None:
+            print("Image variants error:", key, repr(f.exception()))
+        elif written:
+            _image_cache_evict()
+            # Витрина начинает отдавать srcset с готовыми вариантами.
+            touch_catalog_images(MOYSKLAD_IMAGE_CACHE_DIR, [key])
+
+    future.add_done_callback(done)
+
+
+def _image_cache_variant(href: str, width: int, ext: str) -> Optional[tuple[str, os.stat_result]]:
+    key = _image_cache_key(href)
+    path = os.path.join(MOYSKLAD_IMAGE_CACHE_DIR, _image_variant_name(key, width, ext))
+    try:
+        return path, os.stat(path)
+    except OSError:
+        _image_cache_render_variants(key)
+        return None
+
+
+def _image_cache_forget(key: str) -> None:
+    global _image_cache_bytes
+    with _image_cache_lock:
+        size = _image_cache_entries.pop(key, None)
+        _image_cache_variant_bytes.pop(key, None)
+        if size is not None:
+            _image_cache_bytes -= size
+    _image_cache_remove_files(key)
+
+
+def _image_cache_commit(href: str, spool_path: str, size: int, media_type: str) -> bool:
+    """Переименовать докачанный spool-файл в запись кэша; False — файл остаётся вызывающему."""
+    global _image_cache_bytes
+    if MOYSKLAD_IMAGE_CACHE_MAX_BYTES <= 0 or size > MOYSKLAD_IMAGE_CACHE_MAX_BYTES:
+        return False
+    key = _image_cache_key(href)
+    path, meta_path = _image_cache_paths(key)
+    meta = {"href": href, "content_type": media_type, "size": size, "fetched_at": int(time.time())}
+    meta_tmp = f"{meta_path}.{uuid.uuid4().hex}.tmp"
+    try:
+        os.replace(spool_path, path)
+        with open(meta_tmp, "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(meta_tmp, meta_path)
+    except OSError as e:
+        print("MoySklad image cache write error:", repr(e))
+        for tmp in (path, meta_tmp):
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+        return True
+    with _image_cache_lock:
+        # Старые варианты остаются на диске, пока пересборка не перезапишет их.
+        previous = _image_cache_entries.pop(key, 0)
+        total = size + _image_cache_variant_bytes.get(key, 0)
+        _image_cache_entries[key] = total
+        _image_cache_bytes += total - previous
+    _image_cache_evict()
+    _image_cache_render_variants(key)
+    return True
+
+
+# ---------------------------
+# MoySklad image download
+# ---------------------------
+# Промах по href запускает одну фоновую закачку в spool-файл; все запросы этого href (и пришедшие
+# позже, пока закачка идёт) читают тот же файл по мере роста, поэтому память не зависит от размера
+# картинок и числа клиентов. Закачка не привязана к соединению клиента, который её начал.
+# Одновременно к МойСклад уходит не больше MOYSKLAD_IMAGE_FETCH_CONCURRENCY закачек.
+IMAGE_STREAM_CHUNK = 64 * 1024
+
+
+class _ImageDownload:
+    __slots__ = ("href", "spool_path", "media_type", "size", "done", "error", "ready", "changed")
+
+    def __init__(self, href: str, spool_path: str):
+        self.href = href
+        self.spool_path = spool_path
+        self.media_type = "application/octet-stream"
+        self.size = 0
+        self.done = False
+        self.error: Optional[BaseException] = None
+        # ready — известны статус и тип ответа; changed заменяется новым при каждой порции данных.
+        self.ready = asyncio.Event()
+        self.changed = asyncio.Event()
+
+    def notify(self) -> None:
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+
+_image_downloads: dict[str, _ImageDownload] = {}
+_image_download_tasks: set = set()
+_image_fetch_slots: Optional[asyncio.Semaphore] = None
+
+
+def cancel_image_downloads() -> None:
+    for task in list(_image_download_tasks):
+        task.cancel()
+
+
+async def _open_moysklad_image(client: httpx.AsyncClient, href: str) -> httpx.Response:
+    r = await client.send(
+        client.build_request("GET", href, headers=_moysklad_binary_headers()),
+        stream=True,
+        follow_redirects=True,
+    )
+
+    # Some MoySklad image links first return JSON metadata, not the file itself.
+    if (r.headers.get("content-type") or "").lower().startswith("application/json"):
+        try:
+            await r.aread()
+            payload = r.json()
+        except Exception:
+            payload = {}
+        resolved_href = _moysklad_download_href(payload)
+        if resolved_href and resolved_href != href:
+            await r.aclose()
+            r = await client.send(
+                client.build_request("GET", resolved_href, headers=_moysklad_binary_headers()),
+                stream=True,
+                follow_redirects=True,
+            )
+    return r
+
+
+async def _run_image_download(download: _ImageDownload) -> None:
+    global _image_fetch_slots
+    if _image_fetch_slots is None:
+        _image_fetch_slots = asyncio.Semaphore(max(MOYSKLAD_IMAGE_FETCH_CONCURRENCY, 1))
+    keep_spool = False
+    try:
+        try:
+            await asyncio.wait_for(_image_fetch_slots.acquire(), timeout=30)
+        except asyncio.TimeoutError:
+            raise HTTPException(503, "MoySklad image fetch queue is full")
+        try:
+            r = await _open_moysklad_image(http_async_client("moysklad"), download.href)
+            try:
+                if r.status_code >= 400:
+                    raise HTTPException(r.status_code, "MoySklad image fetch failed")
+                download.media_type = r.headers.get("content-type") or "application/octet-stream"
+                download.ready.set()
+                with open(download.spool_path, "ab", buffering=0) as spool:
+                    async for chunk in r.aiter_bytes(IMAGE_STREAM_CHUNK):
+                        spool.write(chunk)
+                        download.size += len(chunk)
+                        download.notify()
+            finally:
+                await r.aclose()
+        finally:
+            _image_fetch_slots.release()
+        download.done = True
+        # Неразрешённые JSON-метаданные отдаём как есть, но не кэшируем.
+        if not download.media_type.lower().startswith("application/json"):
+            keep_spool = _image_cache_commit(download.href, download.spool_path, download.size, download.media_type)
+    except BaseException as e:
+        download.error = e
+        if isinstance(e, asyncio.CancelledError):
+            raise
+        if not isinstance(e, HTTPException):
+            print("MoySklad image fetch error:", repr(e))
+    finally:
+        # Снятие с учёта и переименование spool происходят без await между ними: новый запрос
+        # либо присоединится к закачке, либо найдёт готовую запись кэша.
+        _image_downloads.pop(download.href, None)
+        if not keep_spool:
+            # Читатели держат файл открытым, поэтому удаление им не мешает.
+            try:
+                os.remove(download.spool_path)
+            except OSError:
+                pass
+        download.ready.set()
+        download.notify()
+
+
+def _join_image_download(href: str) -> tuple[_ImageDownload, Any]:
+    """Присоединиться к закачке href (или начать её) и открыть её spool-файл на чтение."""
+    download = _image_downloads.get(href)
+    if download is None:
+        os.makedirs(MOYSKLAD_IMAGE_CACHE_DIR, exist_ok=True)
+        spool_path = os.path.join(MOYSKLAD_IMAGE_CACHE_DIR, f"{_image_cache_key(href)}.{uuid.uuid4().hex}.tmp")
+        open(spool_path, "wb").close()
+        download = _ImageDownload(href, spool_path)
+        _image_downloads[href] = download
+        task = asyncio.create_task(_run_image_download(download))
+        _image_download_tasks.add(task)
+        task.add_done_callback(_image_download_tasks.discard)
+    return download, open(download.spool_path, "rb")
+
+
+async def _stream_image_download(download: _ImageDownload, spool):
+    fd = spool.fileno()
+    try:
+        position = 0
+        while True:
+            changed = download.changed
+            if position < download.size:
+                chunk = os.pread(fd, min(IMAGE_STREAM_CHUNK, download.size - position), position)
+                position += len(chunk)
+                yield chunk
+                continue
+            if download.error is not None:
+                # Заголовки уже ушли — остаётся оборвать ответ.
+                raise RuntimeError(f"MoySklad image download failed: {download.error!r}")
+            if download.done:
+                return
+            await changed.wait()
+    finally:
+        spool.close()
+
+
 @app.get("/api/moysklad/image")
-def moysklad_image_proxy(href: str):
+async def moysklad_image_proxy(href: str, request: Request, w: Optional[int] = None, ext: Optional[str] = None):
     if not _moysklad_enabled():
         raise HTTPException(500, "Set MOYSKLAD_TOKEN in backend/.env")
     if not href or not _moysklad_host_allowed(href):
         raise HTTPException(400, "Invalid image href")
 
-    with httpx.Client(timeout=30, follow_redirects=True) as client:
-        current_href = href
-        r = client.get(current_href, headers=_moysklad_binary_headers())
-
-        # Some MoySklad image links first return JSON metadata, not the file itself.
-        if (r.headers.get("content-type") or "").lower().startswith("application/json"):
-            try:
-                payload = r.json()
-            except Exception:
-                payload = {}
-            resolved_href = _moysklad_download_href(payload)
-            if resolved_href and resolved_href != current_href:
-                current_href = resolved_href
-                r = client.get(current_href, headers=_moysklad_binary_headers())
-
-    if r.status_code >= 400:
-        raise HTTPException(r.status_code, "MoySklad image fetch failed")
-
-    media_type = r.headers.get("content-type") or "application/octet-stream"
-    return Response(
-        content=r.content,
-        media_type=media_type,
-        headers={"Cache-Control": "public, max-age=3600"},
-    )
+    cache_control = IMAGE_CACHE_CONTROL
+    if w is not None or ext is not None:
+        if w not in PRODUCT_IMAGE_WIDTHS or ext not in IMAGE_VARIANT_FORMATS:
+            raise HTTPException(400, "Unknown image variant")
+        variant = _image_cache_variant(href, w, ext)
+        if variant is not None:
+            path, st = variant
+            etag = _content_etag(f"{href}|w{w}_{IMAGE_VARIANT_VERSION}.{ext}".encode("utf-8"))
+            not_modified = _not_modified(request, etag, IMAGE_CACHE_CONTROL)
+            if not_modified is not None:
+                return not_modified
+            headers = {"ETag": etag, "Cache-Control": IMAGE_CACHE_CONTROL}
+            return FileResponse(path, stat_result=st, media_type=IMAGE_VARIANT_FORMATS[ext], headers=headers)
+        # Вариант ещё строится — отдаём исходник, но без долгого кэша, чтобы клиент потом взял вариант.
+        cache_control = REVALIDATE_CACHE_CONTROL
+
+    etag = _content_etag(href.encode("utf-8"))
+    not_modified = _not_modified(request, etag, cache_control)
+    if not_modified is not None:
+        return not_modified
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+
+    cached = _image_cache_get(href)
+    if cached is not None:
+        path, st, meta = cached
+        return FileResponse(path, stat_result=st, media_type=meta.get("content_type"), headers=headers)
+
+    download, spool = _join_image_download(href)
+    try:
+        await download.ready.wait()
+        if download.error is not None and download.size == 0:
+            if isinstance(download.error, HTTPException):
+                raise download.error
+            raise HTTPException(502, "MoySklad image fetch failed")
+    except BaseException:
+        spool.close()
+        raise
+    return StreamingResponse(_stream_image_download(download, spool), media_type=download.media_type, headers=headers)
 
 
 # ---------------------------
@@ -2124,35 +4949,11 @@ async def create_order(order: OrderIn):
         )
 
     order_uuid = str(uuid.uuid4())  # это ваш order_num в Prodamus webhook
-    create_reservation(
+    products, amount = await create_order_with_reservation(
         order_uuid,
-        [{"sku": it.sku, "qty": it.qty} for it in order.items]
+        [{"sku": it.sku, "qty": it.qty} for it in order.items],
+        json.dumps(order.model_dump(), ensure_ascii=False),
     )
-    products: List[Dict[str, Any]] = []
-    amount = 0
-
-    con = db()
-    for it in order.items:
-        row = con.execute(
-            "SELECT name, price, active FROM inventory WHERE sku=?",
-            (it.sku,),
-        ).fetchone()
-        if not row or int(row["active"] or 0) == 0:
-            con.close()
-            raise HTTPException(400, f"Unknown or inactive sku: {it.sku}")
-        price = int(row["price"] or 0)
-        if price <= 0:
-            con.close()
-            raise HTTPException(400, f"Price not set for sku: {it.sku}")
-        products.append(
-            {
-                "name": row["name"],
-                "price": price,
-                "quantity": it.qty,
-            }
-        )
-        amount += price * it.qty
-    con.close()
 
     customer_extra = (
         f"Имя: {order.customer.name}\n"
@@ -2214,8 +5015,7 @@ async def create_order(order: OrderIn):
         form_data = flatten_for_prodamus(data_for_sign)
 
         try:
-            async with httpx.AsyncClient(timeout=20, follow_redirects=False) as client:
-                r = await client.post(PRODAMUS_FORM_URL, data=form_data)
+            r = await http_async_client("prodamus").post(PRODAMUS_FORM_URL, data=form_data)
 
             body = (r.text or "").strip()
             if r.status_code in (301, 302, 303, 307, 308):
@@ -2263,13 +5063,7 @@ async def create_order(order: OrderIn):
     if not payment_url or is_empty_payform_link(payment_url):
         payment_url = payment_url_direct
 
-    con = db()
-    con.execute(
-        "INSERT INTO orders(order_id,status,amount,payload_json,payment_url) VALUES (?,?,?,?,?)",
-        (order_uuid, "created", amount, json.dumps(order.model_dump(), ensure_ascii=False), payment_url_direct or payment_url),
-    )
-    con.commit()
-    con.close()
+    await db_call_async(_set_order_payment_url_tx, order_uuid, payment_url_direct or payment_url)
 
     return {
         "order_id": order_uuid,
@@ -2280,12 +5074,11 @@ async def create_order(order: OrderIn):
 
 @app.get("/api/orders/{order_id}")
 def get_order(order_id: str):
-    con = db()
-    row = con.execute(
-        "SELECT order_id, status, amount, payment_url, created_at, updated_at FROM orders WHERE order_id=?",
-        (order_id,),
-    ).fetchone()
-    con.close()
+    with db_read() as con:
+        row = con.execute(
+            "SELECT order_id, status, amount, payment_url, created_at, updated_at FROM orders WHERE order_id=?",
+            (order_id,),
+        ).fetchone()
 
     if not row:
         raise HTTPException(404, "Order not found")
@@ -2377,90 +5170,68 @@ async def prodamus_webhook(request: Request):
 
     try:
         if payment_status == "success":
-            mark_reservation_paid_and_deduct_stock(order_uuid)
-            set_order_status(order_uuid, "paid")
-            asyncio.create_task(send_to_leadteh(order_uuid))
-            asyncio.create_task(sync_order_stocks_to_leadteh(order_uuid))
-            asyncio.create_task(sync_order_stocks_to_moysklad(order_uuid))
+            _raise_for_reservation_status(await db_call_async(_mark_order_paid_tx, order_uuid, int(time.time())))
         else:
-            release_reservation(order_uuid, reason=payment_status or "released")
-            set_order_status(order_uuid, payment_status or "unknown")
+            await db_call_async(_release_order_tx, order_uuid, payment_status or "released", payment_status or "unknown")
     except Exception as e:
         print("DB ERROR:", repr(e))
         raise HTTPException(500, f"DB error: {repr(e)}")
 
     return {"ok": True}
 @app.get("/api/inventory")
-def get_inventory():
-    expire_reservations()
-    con = db()
-    rows = con.execute("""
-        SELECT sku, name, stock, reserved, (stock - reserved) AS available
-        FROM inventory
-        ORDER BY name
-    """).fetchall()
-    con.close()
-    return [dict(r) for r in rows]
+def get_inventory(request: Request):
+    return _cached_json_response(request, inventory_body())
 
 
-@app.patch("/api/inventory")
-def update_inventory(payload: InventoryUpdateBulk, _: None = Depends(require_admin)):
-    con = db()
-    cur = con.cursor()
-    cur.execute("BEGIN IMMEDIATE")
+@app.get("/api/stock/stream")
+def stock_stream(request: Request):
+    cursor = _stock_stream_cursor(request.headers.get("last-event-id"))
+    return StreamingResponse(
+        _stock_stream(cursor),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
-    for it in payload.items:
-        cur.execute(
-            "UPDATE inventory SET stock=? WHERE sku=?",
-            (int(it.stock), str(it.sku)),
-        )
 
-    con.commit()
-    con.close()
+@app.patch("/api/inventory")
+def update_inventory(payload: InventoryUpdateBulk, _: None = Depends(require_admin)):
+    with db_write() as cur:
+        for it in payload.items:
+            cur.execute(
+                "UPDATE inventory SET stock=? WHERE sku=?",
+                (int(it.stock), str(it.sku)),
+            )
+        _stock_index_refresh(cur, [str(it.sku) for it in payload.items])
+        invalidate_catalog_snapshot()
     return {"ok": True}
 
 
 @app.get("/api/products")
-def get_products():
-    expire_reservations()
-    con = db()
-    rows = con.execute(
-        """
-        SELECT
-          sku,
-          name,
-          price,
-          weight,
-          shelf_life AS shelfLife,
-          description,
-          image_url AS imageUrl,
-          badge,
-          sort,
-          active,
-          catalog_override AS catalogOverride,
-          stock,
-          reserved,
-          (stock - reserved) AS available
-        FROM inventory
-        ORDER BY sort ASC, name ASC
-        """
-    ).fetchall()
-    con.close()
-    products = []
-    for row in rows:
-        item = dict(row)
-        item["imageUrl"] = _normalize_storefront_asset_url(item.get("imageUrl"))
-        products.append(item)
-    return products
+def get_products(request: Request, since: Optional[int] = None):
+    if since is not None:
+        return Response(content=catalog_delta(since), media_type="application/json")
+    rendered, seq = catalog_body()
+    response = _cached_json_response(request, rendered)
+    response.headers["X-Catalog-Seq"] = str(seq)
+    return response
 
 
 @app.get("/uploads/products/{filename}")
-def get_uploaded_product_image(filename: str):
+def get_uploaded_product_image(filename: str, request: Request):
     safe_name = os.path.basename(filename)
     path = os.path.join(PRODUCT_UPLOADS_DIR, safe_name)
-    if not os.path.isfile(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        st = None
+    if st is None or not stat.S_ISREG(st.st_mode):
         raise HTTPException(404, "Image not found")
-    return FileResponse(path)
+    etag = _file_etag(st)
+    cache_control = IMMUTABLE_CACHE_CONTROL if _HASHED_UPLOAD_RE.match(safe_name) else IMAGE_CACHE_CONTROL
+    not_modified = _not_modified(request, etag, cache_control)
+    if not_modified is not None:
+        return not_modified
+    return FileResponse(path, stat_result=st, headers={"ETag": etag, "Cache-Control": cache_control})
 
 
 @app.put("/api/products/{sku}")
@@ -2474,17 +5245,21 @@ def upsert_product_card_endpoint(sku: str, payload: ProductCardUpsert, _: None =
 
 @app.post("/api/products/image")
 async def upload_product_image(file: UploadFile = File(...), _: None = Depends(require_admin)):
-    os.makedirs(PRODUCT_UPLOADS_DIR, exist_ok=True)
     if not (file.content_type or "").startswith("image/"):
         raise HTTPException(400, "Можно загружать только изображения")
+    if file.size is not None and file.size > PRODUCT_UPLOAD_MAX_BYTES:
+        raise _upload_too_large()
 
-    safe_name = _safe_product_upload_name(file.filename or "image.jpg")
-    path = os.path.join(PRODUCT_UPLOADS_DIR, safe_name)
-
-    with open(path, "wb") as out:
-        shutil.copyfileobj(file.file, out)
+    ext = _product_upload_ext(file.filename or "image.jpg")
+    safe_name = await asyncio.to_thread(_store_product_upload, file.file, ext)
 
-    return {"ok": True, "imageUrl": _product_upload_public_url(safe_name), "filename": safe_name}
+    variants = _upload_image_variants(safe_name) or await render_product_image_variants(safe_name)
+    return {
+        "ok": True,
+        "imageUrl": _product_upload_public_url(safe_name),
+        "imageVariants": variants,
+        "filename": safe_name,
+    }
 
 
 @app.post("/api/leadteh/sync")
@@ -2497,9 +5272,21 @@ def sync_products_moysklad(_: None = Depends(require_admin)):
     return sync_moysklad_products()
 
 
+@app.get("/api/outbox")
+def get_outbox(_: None = Depends(require_admin)):
+    return outbox_stats()
+
+
+@app.post("/api/outbox/{job_id}/retry")
+def retry_outbox_job(job_id: int, _: None = Depends(require_admin)):
+    if not db_call(_retry_outbox_job_tx, job_id, int(time.time())):
+        raise HTTPException(404, "Dead outbox job not found")
+    return {"ok": True}
+
+
 @app.post("/api/leadteh/push")
-def push_products(_: None = Depends(require_admin)):
-    return push_products_to_leadteh()
+def push_products(force: bool = False, _: None = Depends(require_admin)):
+    return push_products_to_leadteh(force=force)
 
 
 @app.post("/api/products/seed")
@@ -2509,4 +5296,5 @@ def seed_products_endpoint(_: None = Depends(require_admin)):
 
 
 if os.path.isdir(FRONTEND_DIST_DIR):
-    app.mount("/", StaticFiles(directory=FRONTEND_DIST_DIR, html=True), name="frontend")
+    _frontend_static = PrecompressedStaticFiles(directory=FRONTEND_DIST_DIR, html=True)
+    app.mount("/", _frontend_static, name="frontend")
@@ -6,6 +6,7 @@ import {
   pushLeadteh,
   saveProductCard,
   seedProducts,
+  subscribeStock,
   syncLeadteh,
   syncMoySklad,
   updateInventory,
@@ -17,6 +18,12 @@ function rub(v) {
   return new Intl.NumberFormat("ru-RU").format(v) + " ₽";
 }
 
+function imageSrcSet(product) {
+  const variants = product?.imageVariants || [];
+  if (!variants.length) return undefined;
+  return variants.map((v) => `${v.webp} ${v.width}w`).join(", ");
+}
+
 function normalizePhoneForSend(value) {
   const digits = String(value || "").replace(/\D+/g, "");
   if (!digits) return "";
@@ -120,6 +127,22 @@ export default function App() {
     loadProducts().catch(() => {});
   }, [adminRoute]);
 
+  useEffect(() => {
+    if (adminRoute || typeof EventSource === "undefined") return;
+    return subscribeStock((available) => {
+      setProducts((rows) => {
+        let changed = false;
+        const nextRows = rows.map((p) => {
+          const value = available[p.sku];
+          if (value === undefined || value === p.available) return p;
+          changed = true;
+          return { ...p, available: value };
+        });
+        return changed ? nextRows : rows;
+      });
+    });
+  }, [adminRoute]);
+
   useEffect(() => {
     if (!adminRoute) return;
     const stocks = {};
@@ -707,7 +730,13 @@ export default function App() {
             return (
               <div key={p.sku} className={`card ${isOut ? "card--out" : ""}`}>
                 <div className="media">
-                  <img className="img" src={p.imageUrl} alt={p.name} />
+                  <img
+                    className="img"
+                    src={p.imageUrl}
+                    srcSet={imageSrcSet(p)}
+                    sizes="(max-width: 640px) 50vw, 320px"
+                    alt={p.name}
+                  />
                   {p.badge && <div className="badge">{p.badge}</div>}
                   {isOut && <div className="badge badge--out">Нет в наличии</div>}
                   <div className="priceTag">{rub(p.price)}</div>
@@ -965,7 +994,13 @@ export default function App() {
           <div className="modalBackdrop" onClick={() => setActiveSku("")} />
           <div className="modalCard">
             <button className="closeBtn" onClick={() => setActiveSku("")}>✕</button>
-            <img className="modalImg" src={activeProduct.imageUrl} alt={activeProduct.name} />
+            <img
+              className="modalImg"
+              src={activeProduct.imageUrl}
+              srcSet={imageSrcSet(activeProduct)}
+              sizes="100vw"
+              alt={activeProduct.name}
+            />
             <div className="modalBody">
               <div className="modalTitle">{activeProduct.name}</div>
               <div className="modalMeta">
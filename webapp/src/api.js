@@ -59,17 +59,78 @@ export async function createOrder(payload) {
 export async function getInventory() {
   const r = await request("/api/inventory", {
     headers: ngrokHeaders(),
-    cache: "no-store",
+    cache: "no-cache",
   });
   return await r.json();
 }
 
+const CATALOG_CACHE_KEY = "catalog-cache-v1";
+
+function readCatalogCache() {
+  try {
+    const cached = JSON.parse(window.localStorage.getItem(CATALOG_CACHE_KEY) || "null");
+    if (cached && Number.isInteger(cached.seq) && Array.isArray(cached.products)) return cached;
+  } catch {
+    // повреждённый кэш просто перезагружаем целиком
+  }
+  return null;
+}
+
+function writeCatalogCache(seq, products) {
+  try {
+    window.localStorage.setItem(CATALOG_CACHE_KEY, JSON.stringify({ seq, products }));
+  } catch {
+    // хранилище недоступно или переполнено — работаем без кэша
+  }
+}
+
+function compareCatalogRows(a, b) {
+  if (a.sort !== b.sort) return a.sort - b.sort;
+  return a.name < b.name ? -1 : a.name > b.name ? 1 : 0;
+}
+
+function mergeCatalog(rows, changed) {
+  const bySku = new Map(rows.map((p) => [p.sku, p]));
+  changed.forEach((p) => bySku.set(p.sku, p));
+  return Array.from(bySku.values()).sort(compareCatalogRows);
+}
+
 export async function getProducts() {
+  const cached = readCatalogCache();
+  if (cached) {
+    const r = await request(`/api/products?since=${cached.seq}`, {
+      headers: ngrokHeaders(),
+      cache: "no-store",
+    });
+    const delta = await r.json();
+    const products = delta.full ? delta.products : mergeCatalog(cached.products, delta.products);
+    writeCatalogCache(delta.seq, products);
+    return products;
+  }
+
   const r = await request("/api/products", {
     headers: ngrokHeaders(),
-    cache: "no-store",
+    cache: "no-cache",
   });
-  return await r.json();
+  const products = await r.json();
+  const seq = Number.parseInt(r.headers.get("X-Catalog-Seq") || "", 10);
+  if (Number.isInteger(seq)) writeCatalogCache(seq, products);
+  return products;
+}
+
+export function subscribeStock(onChange) {
+  // EventSource сам переподключается и передаёт Last-Event-ID, сервер досылает пропущенное.
+  const source = new EventSource(buildUrl("/api/stock/stream"));
+  const handle = (event) => {
+    try {
+      onChange(JSON.parse(event.data));
+    } catch {
+      // битое событие пропускаем, следующее придёт целиком
+    }
+  };
+  source.addEventListener("snapshot", handle);
+  source.addEventListener("stock", handle);
+  return () => source.close();
 }
 
 export async function updateInventory(authBasic, items) {